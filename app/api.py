@@ -1,91 +1,461 @@
 from __future__ import annotations
 from datetime import datetime, timezone
-from fastapi import APIRouter, HTTPException
-from sqlalchemy import select
+from typing import Literal
+from fastapi import APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncConnection
 import asyncio
-from .db import SessionLocal, engine
-from .models import Base, RecordingSession, MqttMessage
+import json
+import os
+import tempfile
+import uuid
+from .archive import archive_path, export_session, import_archive
+from .cluster import ClusterCoordinator, cluster_status, node_id
+from .config import settings
+from .db import AsyncSessionLocal, async_engine
+from .dedup import dedup_report
+from .metrics import instrument_pipelines
+from .export import encode_cursor, iter_export, messages_query
+from .models import RecordingSession
+from .partitions import apply_retention, create_session_payload_index, drop_session_messages, ensure_session_partition
+from .payloads import dumps_json, payload_for_api
+from .query import Explain, summarize_plan
 from .schemas import SessionCreate, SessionOut, MessageOut
-from .services import RecorderService, PlaybackService
+from .rollups import query_rollups
+from .services import RecorderManager, PlaybackService
+from .stats import stored_stats
+from .tail import follow
+from .topics import validate_topic_filter
 
 router = APIRouter()
-recorder = RecorderService()
+if settings.cluster_mode:
+    # Every process needs its own MQTT client ids; the coordinator decides what it records.
+    recorder = RecorderManager(client_id=f"{settings.mqtt_client_id}-{node_id()}")
+    coordinator = ClusterCoordinator(recorder, node_id())
+else:
+    recorder = RecorderManager()
+    coordinator = None
 player = PlaybackService()
+instrument_pipelines(recorder, player)
+
+async def _session_exists(conn: AsyncConnection, session_id: str) -> bool:
+    try:
+        sid = uuid.UUID(session_id)
+    except ValueError:
+        return False
+    return (await conn.execute(select(RecordingSession.id).where(RecordingSession.id == sid))).first() is not None
 
 @router.post("/sessions", response_model=SessionOut)
-def create_session(payload: SessionCreate):
+async def create_session(payload: SessionCreate):
     s = RecordingSession(node=payload.node, topic_filters=payload.topic_filters)
-    with SessionLocal() as db:
+    async with AsyncSessionLocal() as db:
         db.add(s)
-        db.commit()
-        db.refresh(s)
+        await db.commit()
+        await db.refresh(s)
     return SessionOut(id=str(s.id), state=s.state)
 
 @router.get("/sessions", response_model=list[SessionOut])
-def list_sessions():
-    with SessionLocal() as db:
-        rows = db.execute(select(RecordingSession).order_by(RecordingSession.created_at.desc())).scalars().all()
+async def list_sessions():
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(RecordingSession).order_by(RecordingSession.created_at.desc()))).scalars().all()
     return [SessionOut(id=str(r.id), state=r.state) for r in rows]
 
 @router.post("/sessions/{session_id}/record/start")
-async def start_record(session_id: str):
-    with SessionLocal() as db:
-        s = db.get(RecordingSession, session_id)
+async def start_record(session_id: str, shares: int = 1):
+    if shares < 1 or shares > 64:
+        raise HTTPException(400, "shares must be between 1 and 64")
+    if shares > 1 and coordinator is None:
+        raise HTTPException(400, "shares > 1 requires CLUSTER_MODE")
+    async with AsyncSessionLocal() as db:
+        s = await db.get(RecordingSession, session_id)
         if not s:
             raise HTTPException(404, "Session not found")
+        if s.state == "ARCHIVED":
+            raise HTTPException(409, "Session is archived; import it before recording into it")
+
+        await asyncio.to_thread(ensure_session_partition, session_id)
+        if coordinator is not None:
+            if s.state == "RECORDING":
+                raise HTTPException(409, f"Session {session_id} is already recording")
+            try:
+                for f in s.topic_filters:
+                    validate_topic_filter(f)
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+            # Some node claims it on its next heartbeat; this one right away if it has room.
+            s.state = "RECORDING"
+            s.shares = shares
+            s.started_at = datetime.now(timezone.utc)
+            await db.commit()
+            coordinator.kick()
+            return {"ok": True, "shares": shares}
+
+        try:
+            await recorder.start(session_id, s.topic_filters)
+        except RuntimeError as e:
+            raise HTTPException(409, str(e))
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+
         s.state = "RECORDING"
         s.started_at = datetime.now(timezone.utc)
-        db.commit()
-
-    try:
-        recorder.start(session_id)  # now runs in request loop context
-    except RuntimeError as e:
-        raise HTTPException(409, str(e))
+        await db.commit()
 
     return {"ok": True}
 
 @router.post("/sessions/{session_id}/record/stop")
 async def stop_record(session_id: str):
-    await recorder.stop()
-    with SessionLocal() as db:
-        s = db.get(RecordingSession, session_id)
+    await recorder.stop(session_id)
+    async with AsyncSessionLocal() as db:
+        s = await db.get(RecordingSession, session_id)
         if s:
             s.state = "STOPPED"
             s.stopped_at = datetime.now(timezone.utc)
-            db.commit()
+            await db.commit()
+    if coordinator is not None:
+        # The nodes holding it stop on their next heartbeat.
+        coordinator.kick()
     return {"ok": True}
 
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if recorder.is_recording(session_id):
+        raise HTTPException(409, "Session is recording")
+    async with AsyncSessionLocal() as db:
+        s = await db.get(RecordingSession, session_id)
+        if not s:
+            raise HTTPException(404, "Session not found")
+        if coordinator is not None and s.state == "RECORDING":
+            raise HTTPException(409, "Session is recording")
+    # Partition DDL and the derived tables go through the sync engine.
+    messages = await asyncio.to_thread(drop_session_messages, session_id)
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(RecordingSession).where(RecordingSession.id == session_id))
+        await db.commit()
+    return {"ok": True, "messages": messages}
+
+@router.post("/sessions/{session_id}/payload-index")
+async def create_payload_index(session_id: str):
+    try:
+        index = await asyncio.to_thread(create_session_payload_index, session_id)
+    except LookupError as e:
+        raise HTTPException(409, str(e))
+    return {"ok": True, "index": index}
+
+@router.post("/maintenance/retention")
+async def run_retention():
+    return await asyncio.to_thread(apply_retention)
+
+@router.post("/sessions/{session_id}/archive")
+async def archive_session(session_id: str, drop_messages: bool = False):
+    if recorder.is_recording(session_id):
+        raise HTTPException(409, "Session is recording")
+    if coordinator is not None:
+        async with AsyncSessionLocal() as db:
+            s = await db.get(RecordingSession, session_id)
+            if s is not None and s.state == "RECORDING":
+                raise HTTPException(409, "Session is recording")
+    try:
+        return await asyncio.to_thread(export_session, session_id, drop_messages=drop_messages)
+    except LookupError as e:
+        raise HTTPException(404, str(e))
+    except RuntimeError as e:
+        raise HTTPException(409, str(e))
+
+@router.get("/sessions/{session_id}/archive")
+async def download_archive(session_id: str):
+    path = archive_path(session_id)
+    if not path.is_file():
+        raise HTTPException(404, "Archive not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.name)
+
+@router.post("/archives/import")
+async def upload_archive(request: Request, as_new: bool = False):
+    os.makedirs(settings.archive_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".upload", dir=settings.archive_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for data in request.stream():
+                await run_in_threadpool(f.write, data)
+        try:
+            return await asyncio.to_thread(import_archive, tmp, as_new)
+        except RuntimeError as e:
+            raise HTTPException(409, str(e))
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+    finally:
+        os.unlink(tmp)
+
+@router.get("/sessions/{session_id}/dedup")
+async def session_dedup(session_id: str):
+    async with async_engine.connect() as conn:
+        if not await _session_exists(conn, session_id):
+            raise HTTPException(404, "Session not found")
+        report = await conn.run_sync(dedup_report, session_id)
+    return {"session_id": session_id, **report}
+
+@router.get("/sessions/{session_id}/stats")
+async def session_stats(session_id: str, limit: int = 1000):
+    if limit < 1 or limit > 100000:
+        raise HTTPException(400, "limit must be between 1 and 100000")
+    rec = recorder.get(session_id)
+    if rec is not None and rec.topic_stats is not None:
+        topics = rec.topic_stats.snapshot()
+    else:
+        async with async_engine.connect() as conn:
+            if not await _session_exists(conn, session_id):
+                raise HTTPException(404, "Session not found")
+            topics = await conn.run_sync(stored_stats, session_id)
+    topics.sort(key=lambda t: t["count"], reverse=True)
+    totals = {
+        "topics": len(topics),
+        "count": sum(t["count"] for t in topics),
+        "bytes": sum(t["bytes"] for t in topics),
+        "first_ts": min((t["first_ts"] for t in topics), default=None),
+        "last_ts": max((t["last_ts"] for t in topics), default=None),
+    }
+    if rec is not None and rec.topic_stats is not None:
+        totals["rate_per_s"] = sum(t["rate_per_s"] or 0 for t in topics)
+    return {"session_id": session_id, "live": rec is not None, "totals": totals, "topics": topics[:limit]}
+
+@router.get("/rollups")
+async def get_rollups(
+    field: str,
+    start: datetime,
+    end: datetime,
+    resolution: int | None = None,
+    topic: str | None = None,
+    topic_prefix: str | None = None,
+    session_id: str | None = None,
+):
+    # Naive timestamps are taken as UTC, like the recorded ones.
+    start = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+    end = end if end.tzinfo else end.replace(tzinfo=timezone.utc)
+    try:
+        async with async_engine.connect() as conn:
+            return await conn.run_sync(
+                query_rollups, field, start, end, resolution,
+                topic=topic, topic_prefix=topic_prefix, session_id=session_id,
+            )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@router.get("/cluster")
+async def get_cluster():
+    if coordinator is None:
+        raise HTTPException(404, "Cluster mode is off")
+    async with async_engine.connect() as conn:
+        status = await conn.run_sync(cluster_status)
+    return {"node_id": coordinator.node_id, **status}
+
+def _tail_source(session_id: str):
+    rec = recorder.get(session_id)
+    if rec is None:
+        raise HTTPException(404, "Session is not recording in this process")
+    return rec
+
+def _tail_options(topic: list[str], sample: int, max_rate: float | None) -> None:
+    if sample < 1:
+        raise HTTPException(400, "sample must be at least 1")
+    if max_rate is not None and max_rate <= 0:
+        raise HTTPException(400, "max_rate must be positive")
+    try:
+        for f in topic:
+            validate_topic_filter(f)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@router.get("/sessions/{session_id}/tail")
+async def tail_sse(
+    session_id: str,
+    topic: list[str] = Query(default=[]),
+    sample: int = 1,
+    max_rate: float | None = None,
+    coalesce: bool = False,
+):
+    _tail_options(topic, sample, max_rate)
+    rec = _tail_source(session_id)
+
+    async def events():
+        async for batch in follow(rec, topic, sample=sample, max_rate=max_rate, coalesce=coalesce):
+            yield b"data: " + dumps_json(batch) + b"\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.websocket("/sessions/{session_id}/tail/ws")
+async def tail_ws(
+    websocket: WebSocket,
+    session_id: str,
+    topic: list[str] = Query(default=[]),
+    sample: int = 1,
+    max_rate: float | None = None,
+    coalesce: bool = False,
+):
+    try:
+        _tail_options(topic, sample, max_rate)
+        rec = _tail_source(session_id)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+    try:
+        async for batch in follow(rec, topic, sample=sample, max_rate=max_rate, coalesce=coalesce):
+            await websocket.send_text(dumps_json(batch).decode())
+    except WebSocketDisconnect:
+        return
+    await websocket.close()
+
+@router.get("/recorder")
+async def recorder_status():
+    return {"sessions": recorder.sessions(), "pipelines": recorder.stats()}
+
 @router.post("/sessions/{session_id}/play/start")
-def start_play(session_id: str, speed: float = 1.0, topic_prefix: str | None = "replay/"):
+async def start_play(
+    session_id: str,
+    speed: float = 1.0,
+    topic_prefix: str | None = "replay/",
+    mode: Literal["timed", "max", "rate"] = "timed",
+    rate: float | None = None,
+    window: int | None = None,
+    source: Literal["auto", "db", "archive"] = "auto",
+    start: datetime | None = None,
+    end: datetime | None = None,
+    topic: list[str] = Query(default=[]),
+    connections: int = 1,
+    loop: bool = False,
+):
+    if source == "auto":
+        async with AsyncSessionLocal() as db:
+            s = await db.get(RecordingSession, session_id)
+        source = "archive" if s is not None and s.state == "ARCHIVED" else "db"
+    if start is not None and start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end is not None and end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
     try:
-        player.start(session_id, speed=speed, topic_prefix=topic_prefix)
+        playback_id = player.start(
+            session_id, speed=speed, topic_prefix=topic_prefix, mode=mode, rate=rate, window=window,
+            archive=archive_path(session_id) if source == "archive" else None, start=start, end=end,
+            topics=topic, connections=connections, loop=loop,
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
     except RuntimeError as e:
         raise HTTPException(409, str(e))
-    return {"ok": True}
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"ok": True, "playback_id": playback_id}
 
 @router.post("/sessions/{session_id}/play/stop")
-async def stop_play(session_id: str):
-    await player.stop()
-    return {"ok": True}
+async def stop_play(session_id: str, playback_id: str | None = None):
+    stopped = await player.stop(playback_id=playback_id, session_id=session_id)
+    return {"ok": True, "stopped": stopped}
+
+@router.get("/playback")
+async def playback_status():
+    return player.status()
+
+@router.get("/playback/{playback_id}")
+async def playback_detail(playback_id: str):
+    p = player.get(playback_id)
+    if p is None:
+        raise HTTPException(404, "Playback not found")
+    return p.status()
 
 @router.get("/sessions/{session_id}/messages", response_model=list[MessageOut])
-def list_messages(session_id: str, limit: int = 200, topic_prefix: str | None = None):
+async def list_messages(
+    session_id: str,
+    response: Response,
+    limit: int = 200,
+    topic_prefix: str | None = None,
+    after: str | None = None,
+):
     if limit < 1 or limit > 5000:
         raise HTTPException(400, "limit must be between 1 and 5000")
-    with SessionLocal() as db:
-        q = select(MqttMessage).where(MqttMessage.session_id == session_id)
-        if topic_prefix:
-            q = q.where(MqttMessage.topic.like(f"{topic_prefix}%"))
-        q = q.order_by(MqttMessage.ts.asc()).limit(limit)
-        rows = db.execute(q).scalars().all()
+    try:
+        q = messages_query(session_id, topic_prefix, after).limit(limit)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(q)).scalars().all()
+
+    # Pass the value back as ?after= to fetch the next page.
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].ts, rows[-1].id)
 
     return [
         MessageOut(
             ts=r.ts.isoformat(),
             topic=r.topic,
-            payload=r.payload_json,
+            payload=payload_for_api(*r.payload_parts()),
             qos=r.qos,
             retained=r.retained,
         )
         for r in rows
     ]
+
+@router.get("/sessions/{session_id}/messages/query")
+async def query_messages(
+    session_id: str,
+    response: Response,
+    topic: list[str] = Query(default=[]),
+    from_: datetime | None = Query(default=None, alias="from"),
+    to: datetime | None = None,
+    where: str | None = None,
+    limit: int = 200,
+    after: str | None = None,
+    explain: Literal["off", "plan", "analyze"] = "off",
+):
+    if limit < 1 or limit > 5000:
+        raise HTTPException(400, "limit must be between 1 and 5000")
+    if from_ is not None and from_.tzinfo is None:
+        from_ = from_.replace(tzinfo=timezone.utc)
+    if to is not None and to.tzinfo is None:
+        to = to.replace(tzinfo=timezone.utc)
+    try:
+        predicate = json.loads(where) if where is not None else None
+        q = messages_query(
+            session_id, after=after, topic_filters=topic, start=from_, end=to, payload_contains=predicate
+        ).limit(limit)
+    except ValueError as e:  # json.JSONDecodeError included
+        raise HTTPException(400, str(e))
+
+    if explain != "off":
+        async with AsyncSessionLocal() as db:
+            plan = (await db.execute(Explain(q, analyze=explain == "analyze"))).scalar_one()[0]
+        return {"summary": summarize_plan(plan), "plan": plan}
+
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(q)).scalars().all()
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].ts, rows[-1].id)
+    return [
+        MessageOut(
+            ts=r.ts.isoformat(),
+            topic=r.topic,
+            payload=payload_for_api(*r.payload_parts()),
+            qos=r.qos,
+            retained=r.retained,
+        )
+        for r in rows
+    ]
+
+@router.get("/sessions/{session_id}/export")
+async def export_messages(
+    session_id: str,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    gzip: bool = False,
+    topic_prefix: str | None = None,
+):
+    async with async_engine.connect() as conn:
+        if not await _session_exists(conn, session_id):
+            raise HTTPException(404, "Session not found")
+    filename = f"{session_id}.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        iter_export(session_id, format, gzip=gzip, topic_prefix=topic_prefix),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
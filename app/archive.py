@@ -0,0 +1,448 @@
+"""Compact, columnar session archives that playback can read without the database.
+
+An archive is one file::
+
+    <magic "MQTTARC1"> <codec:u8> <7 reserved bytes>
+    chunk*    <compressed length:u32> <crc32:u32> <rows:u32> <first_us:i64> <last_us:i64> <compressed body>
+    index     one <offset:u64> <compressed length:u32> <rows:u32> <first_us:i64> <last_us:i64> per chunk
+    metadata  JSON: session row, message count, time range
+    trailer   <index offset:u64> <chunks:u32> <metadata length:u32> <magic "MQTTEND1">
+
+A chunk body holds up to ``ARCHIVE_CHUNK_ROWS`` messages column by column:
+timestamp deltas in microseconds (i64), topic ids into a per-chunk topic table
+(u32), qos | retained << 2 (u8), payload end offsets (u32), the NUL-separated
+topic table and the concatenated payloads. Bodies are zstd-compressed when the
+``archive`` extra is installed, zlib otherwise; the codec is recorded per file.
+Payloads are stored as the bytes playback publishes (``encode_payload``).
+
+Readers mmap the file, binary-search the index for a start time and decompress
+one chunk at a time.
+
+    python -m app.archive export <SESSION_ID> [-o FILE] [--drop-messages]
+    python -m app.archive import FILE [--as-new]
+    python -m app.archive info FILE
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import uuid
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from pathlib import Path
+from typing import Iterator
+
+from sqlalchemy import select
+
+from .config import settings
+from .db import SessionLocal
+from .dedup import BLOB_KEY, REF_KEY, PayloadCache, payload_hash, with_blobs
+from .ingest import row_writer
+from .models import BLOB_JOIN, PAYLOAD_JSON, PAYLOAD_RAW, MqttMessage, PayloadBlob, RecordingSession
+from .partitions import drop_session_messages, ensure_session_partition
+from .payloads import decode_payload, encode_payload
+from .rollups import RULES, backfill
+from .stats import SessionStats, delete_session_stats
+
+try:
+    import zstandard
+except ImportError:  # optional, see the "archive" extra in pyproject.toml
+    zstandard = None
+
+MAGIC = b"MQTTARC1"
+_END_MAGIC = b"MQTTEND1"
+_FILE_HEADER = struct.Struct("<8sB7x")
+_CHUNK_HEADER = struct.Struct("<IIIqq")
+_INDEX_ENTRY = struct.Struct("<QIIqq")
+_TRAILER = struct.Struct("<QII8s")
+_BODY_HEADER = struct.Struct("<IIII")  # rows, topics, topic table bytes, payload bytes
+
+CODEC_ZLIB, CODEC_ZSTD = 0, 1
+_CODEC_NAMES = {CODEC_ZLIB: "zlib", CODEC_ZSTD: "zstd"}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = timedelta(microseconds=1)
+
+
+def archive_path(session_id: str | uuid.UUID) -> Path:
+    return Path(settings.archive_dir) / f"{session_id}.mqa"
+
+
+def _to_us(ts: datetime) -> int:
+    return (ts - _EPOCH) // _US
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _le(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_le(typecode: str, data) -> array:
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+class ArchiveWriter:
+    """Writes messages in time order to ``path``; the file only appears once ``close()`` succeeds."""
+
+    def __init__(self, path: str | Path, meta: dict, chunk_rows: int | None = None, codec: int | None = None):
+        self.path = Path(path)
+        self.meta = dict(meta)
+        self.chunk_rows = chunk_rows or settings.archive_chunk_rows
+        self.codec = codec if codec is not None else (CODEC_ZSTD if zstandard is not None else CODEC_ZLIB)
+        if self.codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstd archives need the 'zstandard' package (pip install '.[archive]')")
+            self._compress = zstandard.ZstdCompressor(level=9).compress
+        else:
+            self._compress = lambda data: zlib.compress(data, 6)
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._out = self._tmp.open("wb")
+        self._out.write(_FILE_HEADER.pack(MAGIC, self.codec))
+        self._index: list[bytes] = []
+        self._rows: list[tuple[int, str, bytes, int, bool]] = []
+        self.messages = 0
+        self.first_us: int | None = None
+        self.last_us: int | None = None
+
+    def append(self, ts: datetime, topic: str, payload: bytes, qos: int, retained: bool) -> None:
+        self._rows.append((_to_us(ts), topic, payload, qos, retained))
+        if len(self._rows) >= self.chunk_rows:
+            self._write_chunk()
+
+    def _write_chunk(self) -> None:
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        first_us, last_us = rows[0][0], rows[-1][0]
+        deltas = array("q")
+        topic_ids = array("I")
+        ends = array("I")
+        flags = bytearray()
+        topics: dict[str, int] = {}
+        prev = first_us
+        end = 0
+        for us, topic, payload, qos, retained in rows:
+            deltas.append(us - prev)
+            prev = us
+            tid = topics.get(topic)
+            if tid is None:
+                tid = topics[topic] = len(topics)
+            topic_ids.append(tid)
+            flags.append(qos | (retained << 2))
+            end += len(payload)
+            ends.append(end)
+        topic_table = b"\0".join(t.encode("utf-8") for t in topics)
+        body = b"".join(
+            (
+                _BODY_HEADER.pack(len(rows), len(topics), len(topic_table), end),
+                _le(deltas), _le(topic_ids), bytes(flags), _le(ends), topic_table,
+                *(r[2] for r in rows),
+            )
+        )
+        data = self._compress(body)
+        offset = self._out.tell()
+        self._out.write(_CHUNK_HEADER.pack(len(data), zlib.crc32(data), len(rows), first_us, last_us))
+        self._out.write(data)
+        self._index.append(_INDEX_ENTRY.pack(offset, len(data), len(rows), first_us, last_us))
+        self.messages += len(rows)
+        if self.first_us is None:
+            self.first_us = first_us
+        self.last_us = last_us
+
+    def close(self) -> dict:
+        self._write_chunk()
+        meta = {
+            **self.meta,
+            "format": 1,
+            "codec": _CODEC_NAMES[self.codec],
+            "messages": self.messages,
+            "first_ts": _from_us(self.first_us).isoformat() if self.first_us is not None else None,
+            "last_ts": _from_us(self.last_us).isoformat() if self.last_us is not None else None,
+        }
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        index_offset = self._out.tell()
+        self._out.write(b"".join(self._index))
+        self._out.write(meta_bytes)
+        self._out.write(_TRAILER.pack(index_offset, len(self._index), len(meta_bytes), _END_MAGIC))
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        self._out.close()
+        os.replace(self._tmp, self.path)
+        return meta
+
+    def abort(self) -> None:
+        self._out.close()
+        self._tmp.unlink(missing_ok=True)
+
+
+class ArchiveReader:
+    """Memory-mapped, read-only view of an archive; thread-confined like a DB cursor."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._open()
+        except Exception:
+            self._map.close()
+            raise
+
+    def _open(self) -> None:
+        m = self._map
+        if len(m) < _FILE_HEADER.size + _TRAILER.size:
+            raise ValueError(f"Not a session archive: {self.path}")
+        magic, self.codec = _FILE_HEADER.unpack_from(m, 0)
+        index_offset, chunks, meta_len, end_magic = _TRAILER.unpack_from(m, len(m) - _TRAILER.size)
+        if magic != MAGIC or end_magic != _END_MAGIC:
+            raise ValueError(f"Not a session archive or truncated: {self.path}")
+        if self.codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("This archive is zstd-compressed; install the 'zstandard' package")
+            self._decompress = zstandard.ZstdDecompressor().decompress
+        elif self.codec == CODEC_ZLIB:
+            self._decompress = zlib.decompress
+        else:
+            raise ValueError(f"Unknown archive codec {self.codec}")
+        meta_offset = index_offset + chunks * _INDEX_ENTRY.size
+        self.meta = json.loads(bytes(m[meta_offset:meta_offset + meta_len]))
+        self.index = [_INDEX_ENTRY.unpack_from(m, index_offset + i * _INDEX_ENTRY.size) for i in range(chunks)]
+        self._last_us = [entry[4] for entry in self.index]
+
+    def __enter__(self) -> ArchiveReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._map.close()
+
+    def _chunk_columns(self, i: int):
+        offset, length, _, first_us, _ = self.index[i]
+        crc = _CHUNK_HEADER.unpack_from(self._map, offset)[1]
+        data_start = offset + _CHUNK_HEADER.size
+        data = self._map[data_start:data_start + length]
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"Corrupt archive chunk {i} in {self.path}")
+        body = self._decompress(data)
+        n, _, topics_len, _ = _BODY_HEADER.unpack_from(body, 0)
+        pos = _BODY_HEADER.size
+        us = list(accumulate(_from_le("q", body[pos:pos + 8 * n]), initial=first_us))[1:]
+        pos += 8 * n
+        topic_ids = _from_le("I", body[pos:pos + 4 * n])
+        pos += 4 * n
+        flags = body[pos:pos + n]
+        pos += n
+        ends = _from_le("I", body[pos:pos + 4 * n])
+        pos += 4 * n
+        topic_table = [t.decode("utf-8") for t in body[pos:pos + topics_len].split(b"\0")]
+        pos += topics_len
+        payloads = []
+        start = pos
+        for end in ends:
+            payloads.append(body[start:pos + end])
+            start = pos + end
+        topics = [topic_table[t] for t in topic_ids]
+        return us, topics, payloads, flags
+
+    def iter_chunks(self, start: datetime | None = None, end: datetime | None = None) -> Iterator[list[tuple]]:
+        """Playback rows ``(ts, topic, payload, None, qos)`` in [start, end), one list per chunk."""
+        start_us = _to_us(start) if start is not None else None
+        end_us = _to_us(end) if end is not None else None
+        first = bisect_left(self._last_us, start_us) if start_us is not None else 0
+        for i in range(first, len(self.index)):
+            if end_us is not None and self.index[i][3] >= end_us:
+                return
+            us, topics, payloads, flags = self._chunk_columns(i)
+            lo = bisect_left(us, start_us) if start_us is not None and i == first else 0
+            hi = bisect_left(us, end_us) if end_us is not None else len(us)
+            rows = [(_from_us(us[j]), topics[j], payloads[j], None, flags[j] & 0x03) for j in range(lo, hi)]
+            if rows:
+                yield rows
+
+    def iter_messages(self) -> Iterator[list[tuple[datetime, str, bytes, int, bool]]]:
+        """All messages as ``(ts, topic, payload, qos, retained)``, one list per chunk."""
+        for i in range(len(self.index)):
+            us, topics, payloads, flags = self._chunk_columns(i)
+            yield [(_from_us(u), t, p, f & 0x03, bool(f & 0x04)) for u, t, p, f in zip(us, topics, payloads, flags)]
+
+
+def stream_archive(path: str | Path, start: datetime | None = None, end: datetime | None = None) -> Iterator[list]:
+    """Chunks of playback rows read from an archive; the file is unmapped when the generator closes."""
+    with ArchiveReader(path) as reader:
+        yield from reader.iter_chunks(start, end)
+
+
+def _iso(value: datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def export_session(session_id: str, path: str | Path | None = None, drop_messages: bool = False) -> dict:
+    """Write a session to an archive; with ``drop_messages`` its rows leave Postgres and it becomes ARCHIVED."""
+    path = Path(path) if path is not None else archive_path(session_id)
+    with SessionLocal() as db:
+        s = db.get(RecordingSession, session_id)
+        if s is None:
+            raise LookupError("Session not found")
+        if s.state == "ARCHIVED":
+            raise RuntimeError("Session is already archived")
+        meta = {
+            "session_id": str(s.id),
+            "node": s.node,
+            "topic_filters": s.topic_filters,
+            "created_at": _iso(s.created_at),
+            "started_at": _iso(s.started_at),
+            "stopped_at": _iso(s.stopped_at),
+        }
+        writer = ArchiveWriter(path, meta)
+        try:
+            result = db.execute(
+                select(
+                    MqttMessage.ts, MqttMessage.topic, PAYLOAD_RAW, PAYLOAD_JSON, MqttMessage.qos, MqttMessage.retained
+                )
+                .outerjoin(PayloadBlob, BLOB_JOIN)
+                .where(MqttMessage.session_id == session_id)
+                .order_by(MqttMessage.ts.asc(), MqttMessage.id.asc())
+                .execution_options(yield_per=writer.chunk_rows)
+            )
+            for rows in result.partitions():
+                for ts, topic, raw, payload_json, qos, retained in rows:
+                    writer.append(ts, topic, encode_payload(raw, payload_json), qos, retained)
+        except BaseException:
+            writer.abort()
+            raise
+        meta = writer.close()
+
+    if drop_messages:
+        # Stats, rollups and routed rows stay: they are what is still queried for cold sessions.
+        drop_session_messages(session_id, derived=False)
+        with SessionLocal() as db:
+            s = db.get(RecordingSession, session_id)
+            s.state = "ARCHIVED"
+            db.commit()
+    return {**meta, "path": str(path), "size_bytes": path.stat().st_size}
+
+
+def import_archive(path: str | Path, as_new: bool = False) -> dict:
+    """Load an archive back into mqtt_message.
+
+    By default the messages go back to the archived session (which is created
+    again if it was deleted); ``as_new`` imports them as a new session.
+    """
+    with ArchiveReader(path) as reader:
+        meta = reader.meta
+        session_id = str(uuid.uuid4()) if as_new else meta["session_id"]
+        with SessionLocal() as db:
+            s = db.get(RecordingSession, session_id)
+            if s is not None and s.state != "ARCHIVED":
+                raise RuntimeError("Session already exists with its messages; import with as_new")
+            if s is None:
+                s = RecordingSession(id=uuid.UUID(session_id), node=meta["node"], topic_filters=meta["topic_filters"])
+                if meta.get("started_at"):
+                    s.started_at = datetime.fromisoformat(meta["started_at"])
+                if meta.get("stopped_at"):
+                    s.stopped_at = datetime.fromisoformat(meta["stopped_at"])
+                db.add(s)
+            s.state = "IMPORTING"
+            db.commit()
+
+        ensure_session_partition(session_id)
+        session_uuid = uuid.UUID(session_id)
+        write = row_writer(MqttMessage.__table__)
+        store_json = settings.payload_storage != "raw"
+        store_raw = settings.payload_storage != "json"
+        dedup = PayloadCache(settings.payload_dedup_cache_size) if settings.payload_dedup else None
+        if dedup is not None:
+            write = with_blobs(write)
+        delete_session_stats(session_id)
+        stats = SessionStats(session_uuid)
+        imported = 0
+        try:
+            for chunk in reader.iter_messages():
+                rows = []
+                for ts, topic, payload, qos, retained in chunk:
+                    row = {"session_id": session_uuid, "ts": ts, "topic": topic, "qos": qos, "retained": retained}
+                    if dedup is not None:
+                        h = row["payload_hash"] = payload_hash(payload)
+                        if dedup.seen(h):
+                            row[REF_KEY] = payload
+                        else:
+                            row[BLOB_KEY] = (
+                                h, decode_payload(payload) if store_json else None, payload if store_raw else None
+                            )
+                    else:
+                        if store_json:
+                            row["payload_json"] = decode_payload(payload)
+                        if store_raw:
+                            row["payload_raw"] = payload
+                    rows.append(row)
+                    stats.observe(topic, ts, len(payload))
+                write(rows)
+                imported += len(rows)
+        except BaseException:
+            drop_session_messages(session_id, derived=False)
+            with SessionLocal() as db:
+                db.get(RecordingSession, session_id).state = "ARCHIVED"
+                db.commit()
+            raise
+
+    stats.flush()
+    if RULES:
+        backfill(session_id)
+    with SessionLocal() as db:
+        db.get(RecordingSession, session_id).state = "STOPPED"
+        db.commit()
+    return {"session_id": session_id, "messages": imported}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Export, import and inspect session archives.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    ex = sub.add_parser("export", help="write a session to an archive file")
+    ex.add_argument("session_id")
+    ex.add_argument("-o", "--output", help="default: ARCHIVE_DIR/<SESSION_ID>.mqa")
+    ex.add_argument("--drop-messages", action="store_true", help="delete the messages from Postgres afterwards")
+    im = sub.add_parser("import", help="load an archive back into Postgres")
+    im.add_argument("path")
+    im.add_argument("--as-new", action="store_true", help="import as a new session")
+    info = sub.add_parser("info", help="print the metadata and chunk layout of an archive")
+    info.add_argument("path")
+    args = ap.parse_args()
+
+    if args.command == "export":
+        result = export_session(args.session_id, args.output, drop_messages=args.drop_messages)
+    elif args.command == "import":
+        result = import_archive(args.path, as_new=args.as_new)
+    else:
+        with ArchiveReader(args.path) as reader:
+            rows = [entry[2] for entry in reader.index]
+            result = {
+                **reader.meta,
+                "size_bytes": reader.path.stat().st_size,
+                "chunks": len(rows),
+                "rows_per_chunk": max(rows, default=0),
+            }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
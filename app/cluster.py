@@ -0,0 +1,309 @@
+"""Cluster mode: any number of API processes share the recording work through leases in Postgres.
+
+With ``CLUSTER_MODE=true`` the record start/stop endpoints only set the desired
+state of a session. Every process runs a ``ClusterCoordinator`` that, every
+``CLUSTER_HEARTBEAT_S``:
+
+- refreshes its ``recorder_node`` row: heartbeat plus per-session ingest rates,
+- renews its leases and stops recording sessions that were stopped or whose lease it lost,
+- claims free or expired slots of RECORDING sessions: one slot per session and
+  node, and no more than its fair share ceil(slots / live nodes) in total,
+- starts recording what it claimed.
+
+A session started with ``shares=N`` has N slots. Every holder subscribes via
+``$share/<CLUSTER_SHARE_GROUP>-<session_id>/<filter>`` on a connection of its
+own, so the broker splits the session's messages between the nodes. Claims are
+serialized with a transaction-level advisory lock. A node that cannot renew
+for ``CLUSTER_LEASE_TTL_S`` stops recording on its own, and the others take
+its slots over once the leases have expired.
+"""
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import logging
+import math
+import os
+import socket
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import IO
+
+from sqlalchemy import Connection, delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from .config import settings
+from .db import engine
+from .ingest import replay_journals
+from .models import RecorderLease, RecorderNode, RecordingSession
+from .services import RecorderManager
+
+logger = logging.getLogger(__name__)
+
+_CLAIM_LOCK = 0x6D717474  # pg_advisory_xact_lock key serializing lease claims
+_NODE_EXPIRY_TTLS = 10  # node rows silent for this many lease TTLs are removed
+
+
+def node_id() -> str:
+    return settings.cluster_node_id or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def share_group(session_id: str) -> str:
+    return f"{settings.cluster_share_group}-{session_id}"
+
+
+def claim_journal_dir(root: str | Path, node: str) -> tuple[Path, IO]:
+    """Create ``<root>/<node>`` and hold a lock on it for the lifetime of the process."""
+    path = Path(root) / node
+    path.mkdir(parents=True, exist_ok=True)
+    lock = (path / ".lock").open("a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise RuntimeError(f"Journal directory {path} is in use; CLUSTER_NODE_ID must be unique per process")
+    return path, lock
+
+
+def replay_orphaned_journals(root: str | Path, own: Path) -> int:
+    """Replay the journals of nodes on this host that are gone (their lock is free); returns rows written."""
+    total = 0
+    # Node directories are the ones with a lock file; anything else is not ours to touch.
+    for path in sorted(p for p in Path(root).iterdir() if (p / ".lock").is_file() and p != own):
+        with (path / ".lock").open("a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # a live process owns it
+            total += replay_journals(path)
+            for sub in path.iterdir():
+                if sub.is_dir():
+                    try:
+                        sub.rmdir()
+                    except OSError:
+                        pass
+        try:
+            (path / ".lock").unlink()
+            path.rmdir()
+        except OSError:
+            pass
+    return total
+
+
+@dataclass(frozen=True)
+class _Claim:
+    session_id: str
+    topic_filters: list[str]
+    shares: int
+
+
+class ClusterCoordinator:
+    def __init__(self, recorder: RecorderManager, node: str):
+        self.recorder = recorder
+        self.node_id = node
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._renewed_at: float | None = None
+        self._rates_base: tuple[float, dict[str, int]] = (time.monotonic(), {})
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def kick(self) -> None:
+        """Run the next heartbeat now, e.g. after a session was started or stopped."""
+        self._wake.set()
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.recorder.stop_all()
+        try:
+            await asyncio.to_thread(self._release_all)
+        except Exception:
+            logger.exception("Failed to release cluster leases", extra={"node_id": self.node_id})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cluster heartbeat failed", extra={"node_id": self.node_id})
+                await self._fence()
+            try:
+                await asyncio.wait_for(self._wake.wait(), settings.cluster_heartbeat_s)
+            except TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _fence(self) -> None:
+        # Past the TTL other nodes may already own our slots; recording on would duplicate messages.
+        if self._renewed_at is None or time.monotonic() - self._renewed_at < settings.cluster_lease_ttl_s:
+            return
+        if self.recorder.sessions():
+            logger.warning("Leases expired without renewal, stopping all recordings", extra={"node_id": self.node_id})
+            await self.recorder.stop_all()
+
+    async def _heartbeat(self) -> None:
+        stats = self._node_stats()
+        held, claims = await asyncio.to_thread(self._sync, stats, set(self.recorder.sessions()))
+        self._renewed_at = time.monotonic()
+        for session_id in self.recorder.sessions():
+            if session_id not in held:
+                logger.info("Session released by this node", extra={"session_id": session_id, "node_id": self.node_id})
+                await self.recorder.stop(session_id)
+        for claim in claims:
+            group = share_group(claim.session_id) if claim.shares > 1 else None
+            try:
+                await self.recorder.start(claim.session_id, claim.topic_filters, share_group=group)
+            except (ValueError, RuntimeError):
+                logger.exception("Cannot record claimed session", extra={"session_id": claim.session_id})
+                await asyncio.to_thread(self._release, claim.session_id)
+                continue
+            logger.info(
+                "Session claimed by this node",
+                extra={"session_id": claim.session_id, "node_id": self.node_id, "shares": claim.shares},
+            )
+
+    def _node_stats(self) -> dict:
+        now = time.monotonic()
+        since, base = self._rates_base
+        elapsed = now - since
+        sessions = {}
+        for rec in self.recorder.recorders():
+            rate = (rec.received - base.get(rec.session_id, rec.received)) / elapsed if elapsed > 0 else 0.0
+            sessions[rec.session_id] = {
+                "received": rec.received,
+                "rate_per_s": round(rate, 1),
+                "queued": sum(sink.queue_depth for sink in rec.sinks()),
+            }
+        self._rates_base = (now, {sid: s["received"] for sid, s in sessions.items()})
+        return {"sessions": sessions, "rate_per_s": round(sum(s["rate_per_s"] for s in sessions.values()), 1)}
+
+    def _sync(self, stats: dict, recording: set[str]) -> tuple[dict[str, int], list[_Claim]]:
+        """One heartbeat transaction; returns the slots this node holds and the sessions to start."""
+        ttl = timedelta(seconds=settings.cluster_lease_ttl_s)
+        lease = RecorderLease.__table__.c
+        with engine.begin() as conn:
+            conn.execute(select(func.pg_advisory_xact_lock(_CLAIM_LOCK)))
+            now = conn.execute(select(func.now())).scalar_one()
+            conn.execute(
+                insert(RecorderNode)
+                .values(node_id=self.node_id, heartbeat_at=now, stats=stats)
+                .on_conflict_do_update(index_elements=[RecorderNode.node_id], set_={"heartbeat_at": now, "stats": stats})
+            )
+            conn.execute(delete(RecorderNode).where(RecorderNode.heartbeat_at < now - _NODE_EXPIRY_TTLS * ttl))
+
+            wanted = {
+                str(r.id): r
+                for r in conn.execute(
+                    select(RecordingSession.id, RecordingSession.topic_filters, RecordingSession.shares)
+                    .where(RecordingSession.state == "RECORDING")
+                )
+            }
+            # Leases of sessions that were stopped (or rows whose session is gone) are dropped by whoever sees them.
+            conn.execute(
+                delete(RecorderLease).where(
+                    RecorderLease.session_id.not_in(select(RecordingSession.id).where(RecordingSession.state == "RECORDING"))
+                )
+            )
+            held = {
+                str(sid): slot
+                for sid, slot in conn.execute(
+                    update(RecorderLease)
+                    .where(RecorderLease.node_id == self.node_id)
+                    .values(expires_at=now + ttl)
+                    .returning(RecorderLease.session_id, RecorderLease.slot)
+                )
+            }
+
+            live_nodes = conn.execute(
+                select(func.count()).select_from(RecorderNode).where(RecorderNode.heartbeat_at > now - ttl)
+            ).scalar_one()
+            fair = math.ceil(sum(r.shares for r in wanted.values()) / max(live_nodes, 1))
+            taken: dict[str, set[int]] = {}
+            for sid, slot in conn.execute(
+                select(lease.session_id, lease.slot).where(lease.expires_at > now, lease.node_id != self.node_id)
+            ):
+                taken.setdefault(str(sid), set()).add(slot)
+
+            # Sessions nobody records come first, then the least covered ones.
+            for sid in sorted(wanted, key=lambda s: (len(taken.get(s, ())), s)):
+                if len(held) >= fair:
+                    break
+                if sid in held:
+                    continue
+                for slot in range(wanted[sid].shares):
+                    if slot in taken.get(sid, ()):
+                        continue
+                    stmt = insert(RecorderLease).values(
+                        session_id=wanted[sid].id, slot=slot, node_id=self.node_id, expires_at=now + ttl
+                    )
+                    claimed = conn.execute(
+                        stmt.on_conflict_do_update(
+                            index_elements=[RecorderLease.session_id, RecorderLease.slot],
+                            set_={"node_id": stmt.excluded.node_id, "expires_at": stmt.excluded.expires_at},
+                            where=RecorderLease.expires_at <= now,
+                        ).returning(RecorderLease.slot)
+                    ).first()
+                    if claimed is not None:
+                        held[sid] = slot
+                        break
+
+        claims = [
+            _Claim(sid, list(wanted[sid].topic_filters), wanted[sid].shares)
+            for sid in held
+            if sid not in recording and sid in wanted
+        ]
+        return held, claims
+
+    def _release(self, session_id: str) -> None:
+        with engine.begin() as conn:
+            conn.execute(
+                delete(RecorderLease).where(
+                    RecorderLease.session_id == session_id, RecorderLease.node_id == self.node_id
+                )
+            )
+
+    def _release_all(self) -> None:
+        # Lets the other nodes take over on their next heartbeat instead of waiting for the TTL.
+        with engine.begin() as conn:
+            conn.execute(delete(RecorderLease).where(RecorderLease.node_id == self.node_id))
+            conn.execute(delete(RecorderNode).where(RecorderNode.node_id == self.node_id))
+
+
+def cluster_status(conn: Connection) -> dict:
+    ttl = timedelta(seconds=settings.cluster_lease_ttl_s)
+    now = conn.execute(select(func.now())).scalar_one()
+    nodes = conn.execute(select(RecorderNode.__table__).order_by(RecorderNode.node_id)).all()
+    leases = conn.execute(
+        select(RecorderLease.__table__).order_by(RecorderLease.session_id, RecorderLease.slot)
+    ).all()
+    return {
+        "nodes": [
+            {
+                "node_id": n.node_id,
+                "alive": n.heartbeat_at > now - ttl,
+                "heartbeat_age_s": round((now - n.heartbeat_at).total_seconds(), 1),
+                "started_at": n.started_at.isoformat(),
+                **n.stats,
+            }
+            for n in nodes
+        ],
+        "leases": [
+            {
+                "session_id": str(lease.session_id),
+                "slot": lease.slot,
+                "node_id": lease.node_id,
+                "expires_in_s": round((lease.expires_at - now).total_seconds(), 1),
+            }
+            for lease in leases
+        ],
+    }
@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import os
 import ssl
+import threading
+import time
 from pathlib import Path
+from typing import Any, Callable, Literal
 from pydantic_settings import BaseSettings
 
 def _read_secret(path: str | None) -> str | None:
@@ -12,6 +16,43 @@ def _read_secret(path: str | None) -> str | None:
         return None
     return p.read_text(encoding="utf-8").strip()
 
+class _FileCache:
+    """Values derived from files, rebuilt only when one of the files changed.
+
+    The files are stat()ed at most every ``interval`` seconds, so a rotated
+    secret or certificate is picked up without re-reading it on every use.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._entries: dict[Any, tuple[float, tuple, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(paths: tuple[str | None, ...]) -> tuple:
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path) if path else None
+            except FileNotFoundError:
+                st = None
+            stamps.append((st.st_ino, st.st_mtime_ns, st.st_size) if st else None)
+        return tuple(stamps)
+
+    def get(self, key: Any, paths: tuple[str | None, ...], load: Callable[[], Any]) -> Any:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[0] < self.interval:
+            return entry[2]
+        with self._lock:
+            stamp = self._stamp(paths)
+            if entry is None or entry[1] != stamp:
+                entry = (now, stamp, load())
+            else:
+                entry = (now, stamp, entry[2])
+            self._entries[key] = entry
+        return entry[2]
+
 class Settings(BaseSettings):
     # DB
     db_host: str = "localhost"
@@ -19,6 +60,12 @@ class Settings(BaseSettings):
     db_name: str = "mqtt"
     db_user: str = "mqtt"
     db_password_file: str | None = None
+    # Applied to both the sync engine (recorder writers, playback, jobs) and the async one (API handlers)
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 10.0  # seconds to wait for a free connection before failing
+    db_pool_recycle: int = 1800  # seconds after which a pooled connection is replaced
+    db_pool_pre_ping: bool = True
 
     # MQTT
     mqtt_host: str = "localhost"
@@ -32,21 +79,82 @@ class Settings(BaseSettings):
     mqtt_tls_ca_file: str | None = None
     mqtt_tls_cert_file: str | None = None
     mqtt_tls_key_file: str | None = None
+    secrets_reload_interval_s: float = 5.0  # how often secret and certificate files are checked for changes
+
+    # Recorder write path
+    recorder_queue_size: int = 5000
+    recorder_batch_size: int = 500
+    recorder_flush_interval: float = 0.2  # seconds a partial batch may wait before it is committed
+    recorder_pipeline_depth: int = 2  # batches committed concurrently while the next one fills
+    # Spill-to-disk journal used while Postgres is slow or down; unset disables it (a full queue then drops
+    # new messages and counts them, see "dropped" in /v1/recorder).
+    # The image sets it to /app/journal, which the compose files mount as a volume.
+    recorder_journal_dir: str | None = None
+    recorder_journal_high_water: float = 0.8  # fraction of the queue above which new messages are journaled
+    recorder_journal_segment_bytes: int = 64 * 1024 * 1024
+    ingest_backend: Literal["insert", "copy"] = "insert"  # "copy" streams batches with COPY ... FROM STDIN
+    ingest_copy_format: Literal["binary", "text"] = "binary"
+    # json: parsed JSONB only; raw: original bytes only (JSON decoded on read); both: bytes + JSONB
+    payload_storage: Literal["json", "raw", "both"] = "json"
+    payload_dedup: bool = False  # store each distinct payload once in payload_blob, see app/dedup.py
+    payload_dedup_cache_size: int = 100_000  # recently seen payload hashes kept in memory
+    recorder_topic_stats: bool = True  # per-topic aggregates in session_topic_stats, see app/stats.py
+    sink_routes_file: str | None = None  # JSON list of topic-routed sink tables, see app/routing.py
+    rollup_rules_file: str | None = None  # JSON list of numeric fields to roll up, see app/rollups.py
+
+    # mqtt_message storage layout (applied when the table is first created)
+    mqtt_message_partitioning: Literal["none", "time", "session"] = "none"
+    mqtt_message_partition_interval: Literal["day", "week", "month"] = "day"
+    mqtt_message_partition_premake: int = 2  # future time partitions created ahead of need
+    mqtt_message_gin_index: bool = True  # GIN index on payload_json (roughly doubles write cost)
+    retention_days: int | None = None  # drop messages older than this (partitions or whole sessions)
+    maintenance_interval_s: float = 3600.0
+    archive_dir: str = "/app/archive"  # session archives written by POST /sessions/{id}/archive, see app/archive.py
+    archive_chunk_rows: int = 10000  # messages per compressed archive chunk (the unit of seek and decompression)
+
+    # Live tail (GET /sessions/{id}/tail, WS /sessions/{id}/tail/ws), see app/tail.py
+    tail_buffer_size: int = 10000  # recent messages kept per watched session; a viewer further behind skips ahead
+    tail_poll_interval_s: float = 0.1
+    tail_keepalive_s: float = 15.0
+
+    # Cluster mode: sessions are claimed through leases in Postgres by any number of processes, see app/cluster.py
+    cluster_mode: bool = False
+    cluster_node_id: str | None = None  # defaults to <hostname>-<pid>
+    cluster_heartbeat_s: float = 5.0
+    cluster_lease_ttl_s: float = 15.0  # a node that missed heartbeats this long loses its sessions
+    cluster_share_group: str = "mqtt-recorder"  # prefix of the $share groups of sessions recorded by several nodes
+
+    # Playback
+    playback_chunk_size: int = 2000  # rows fetched per server-side cursor round trip
+    playback_readahead_chunks: int = 4  # chunks buffered ahead of the publisher
+    playback_publish_window: int = 100  # publishes awaiting broker acknowledgement at once, per connection
+    playback_max_concurrent: int = 8  # playbacks running at the same time
+    playback_max_connections: int = 16  # publisher connections one playback may open
 
     log_level: str = "INFO"
     otel_service_name: str = "mqtt-recorder"
     otel_log_file: str = "/app/logs/otel.log"
+    otel_log_max_bytes: int = 100 * 1024 * 1024  # rotate at this size, 0 disables
+    otel_log_rotate_interval_s: float = 86400.0  # rotate at least this often, 0 disables
+    otel_log_backups: int = 10  # gzipped rotated files kept
+
+    _files: _FileCache  # private attribute, see model_post_init
+
+    def model_post_init(self, __context: Any) -> None:
+        self._files = _FileCache(self.secrets_reload_interval_s)
 
     @property
     def db_password(self) -> str:
-        v = _read_secret(self.db_password_file)
+        path = self.db_password_file
+        v = self._files.get(("secret", path), (path,), lambda: _read_secret(path))
         if not v:
             raise RuntimeError("DB password missing (set DB_PASSWORD_FILE to a mounted secret).")
         return v
 
     @property
     def mqtt_password(self) -> str | None:
-        return _read_secret(self.mqtt_password_file)
+        path = self.mqtt_password_file
+        return self._files.get(("secret", path), (path,), lambda: _read_secret(path))
 
     @property
     def db_url(self) -> str:
@@ -59,6 +167,10 @@ class Settings(BaseSettings):
         if not self.mqtt_tls_ca_file:
             raise RuntimeError("MQTT_TLS_CA_FILE must be set when MQTT_TLS=true")
 
+        files = (self.mqtt_tls_ca_file, self.mqtt_tls_cert_file, self.mqtt_tls_key_file)
+        return self._files.get(("mqtt_tls", files, self.mqtt_tls_insecure), files, self._build_ssl_context)
+
+    def _build_ssl_context(self) -> ssl.SSLContext:
         ctx = ssl.create_default_context(cafile=self.mqtt_tls_ca_file)
 
         # Optional client cert auth
@@ -1,9 +1,30 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 from .config import settings
 
-engine = create_engine(settings.db_url, pool_pre_ping=True)
+_pool = dict(
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
+)
+
+# Sync engine: recorder writers, playback read-ahead and background jobs run in threads.
+engine = create_engine(settings.db_url, **_pool)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+# Async engine (psycopg's async driver) for the API handlers, so they never block the event loop.
+async_engine = create_async_engine(settings.db_url, **_pool)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+@event.listens_for(engine, "do_connect")
+@event.listens_for(async_engine.sync_engine, "do_connect")
+def _current_password(dialect, conn_rec, cargs, cparams):
+    # New connections use the password file as it is now, so a rotated secret needs no restart.
+    cparams["password"] = settings.db_password
+
 class Base(DeclarativeBase):
     pass
@@ -0,0 +1,174 @@
+"""Content-addressed payload storage for repetitive telemetry (``PAYLOAD_DEDUP=true``).
+
+The recorder hashes every payload. A payload whose hash is in the in-process
+LRU of recently seen hashes is stored as a bare reference (``payload_hash``)
+and is not parsed; otherwise the row also carries the body, which the writer
+inserts into ``payload_blob`` right before the batch. What a blob holds
+follows ``PAYLOAD_STORAGE`` like a regular row. Readers resolve payloads
+through ``MqttMessage.payload_parts()`` or the ``PAYLOAD_*`` columns.
+
+Blobs are shared by all sessions and nodes; ``gc_payload_blobs()`` (run by
+maintenance) removes those no message refers to any more. The LRU is only an
+optimisation: before a batch is written, every blob it refers to is marked as
+referenced (``referenced_at``), and a blob that is gone is stored again from
+the raw payload each bare reference keeps until it is written. GC leaves
+blobs referenced within the last hour alone, which covers the time between
+storing the blobs of a batch and committing its rows.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from sqlalchemy import Connection, delete, exists, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from .config import settings
+from .db import engine
+from .models import MqttMessage, PayloadBlob
+from .payloads import decode_payload
+
+if TYPE_CHECKING:
+    from .ingest import RowWriter
+
+logger = logging.getLogger(__name__)
+
+# Rows that introduce a payload carry (hash, payload_json, payload_raw) under this key until written.
+BLOB_KEY = "_blob"
+# Bare references keep their raw payload under this key until written, see store_blobs().
+REF_KEY = "_ref"
+
+# referenced_at is refreshed once it is older than _TOUCH_AFTER; GC only removes blobs older than _GC_GRACE.
+_TOUCH_AFTER = text("interval '10 minutes'")
+_GC_GRACE = text("interval '1 hour'")
+
+
+def payload_hash(raw: bytes) -> bytes:
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+class PayloadCache:
+    """LRU of payload hashes already sent to payload_blob; only touched on the event loop."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._hashes: OrderedDict[bytes, None] = OrderedDict()
+
+    def seen(self, h: bytes) -> bool:
+        """True if ``h`` was seen recently; otherwise remember it and return False."""
+        hashes = self._hashes
+        if h in hashes:
+            hashes.move_to_end(h)
+            return True
+        hashes[h] = None
+        if len(hashes) > self.maxsize:
+            hashes.popitem(last=False)
+        return False
+
+    def clear(self) -> None:
+        self._hashes.clear()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+
+payload_cache = PayloadCache(settings.payload_dedup_cache_size)
+
+
+def _blob_row(h: bytes, raw: bytes) -> tuple[bytes, object, bytes | None]:
+    storage = settings.payload_storage
+    return h, decode_payload(raw) if storage != "raw" else None, raw if storage != "json" else None
+
+
+def store_blobs(blobs: list[tuple[bytes, object, bytes | None]], refs: dict[bytes, bytes] | None = None) -> None:
+    """Make sure payload_blob holds every payload a batch refers to, marked as referenced now.
+
+    ``blobs`` are the bodies sent along, ``refs`` maps the hashes of bare
+    references to their raw payload, which is stored again if GC removed it.
+    """
+    unique = {h: (h, payload_json, raw) for h, payload_json, raw in blobs}
+    refs = {h: raw for h, raw in (refs or {}).items() if h not in unique}
+    if not unique and not refs:
+        return
+    fresh = PayloadBlob.referenced_at >= func.now() - _TOUCH_AFTER
+    with engine.begin() as conn:
+        if refs:
+            # Touching a blob takes its row lock, so a concurrent GC re-checks referenced_at and keeps it.
+            hashes = sorted(refs)
+            conn.execute(
+                update(PayloadBlob).where(PayloadBlob.hash.in_(hashes), ~fresh).values(referenced_at=func.now())
+            )
+            present = set(conn.execute(select(PayloadBlob.hash).where(PayloadBlob.hash.in_(hashes))).scalars())
+            for h in hashes:
+                if h not in present:
+                    unique[h] = _blob_row(h, refs[h])
+        if unique:
+            stmt = insert(PayloadBlob)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[PayloadBlob.hash], set_={"referenced_at": func.now()}, where=~fresh
+            )
+            conn.execute(
+                stmt,
+                # Sorted so concurrent batches take the row locks in the same order.
+                [
+                    {"hash": h, "payload_json": j, "payload_raw": r}
+                    for h, j, r in sorted(unique.values(), key=lambda b: b[0])
+                ],
+            )
+
+
+def with_blobs(write: RowWriter) -> RowWriter:
+    """Wrap a mqtt_message writer so the payload bodies of a batch are stored before its rows."""
+
+    def write_with_blobs(rows: list[dict]) -> None:
+        blobs = [(i, row.pop(BLOB_KEY)) for i, row in enumerate(rows) if BLOB_KEY in row]
+        refs = [(i, row.pop(REF_KEY)) for i, row in enumerate(rows) if REF_KEY in row]
+        try:
+            store_blobs([b for _, b in blobs], {rows[i]["payload_hash"]: raw for i, raw in refs})
+            write(rows)
+        except Exception:
+            # Failed rows are retried later (journal), so they keep their bodies.
+            for i, blob in blobs:
+                rows[i][BLOB_KEY] = blob
+            for i, raw in refs:
+                rows[i][REF_KEY] = raw
+            raise
+
+    return write_with_blobs
+
+
+def gc_payload_blobs() -> int:
+    """Delete blobs no message refers to; returns how many were removed."""
+    with engine.begin() as conn:
+        # Blobs of a batch that has not committed yet were referenced recently; leave them alone.
+        result = conn.execute(
+            delete(PayloadBlob).where(
+                PayloadBlob.referenced_at < func.now() - _GC_GRACE,
+                ~exists().where(MqttMessage.payload_hash == PayloadBlob.hash),
+            )
+        )
+    if result.rowcount:
+        logger.info("Removed unreferenced payload blobs", extra={"blobs": result.rowcount})
+    return result.rowcount
+
+
+def dedup_report(conn: Connection, session_id: str) -> dict:
+    """Messages, deduplicated messages and distinct payloads of a session (scans its rows)."""
+    row = conn.execute(
+        select(
+            func.count(),
+            func.count(MqttMessage.payload_hash),
+            func.count(MqttMessage.payload_hash.distinct()),
+        ).where(MqttMessage.session_id == session_id)
+    ).one()
+    messages, hashed, distinct = row
+    # The first message of each distinct payload carries it; only the later ones were saved.
+    deduplicated = hashed - distinct
+    return {
+        "messages": messages,
+        "deduplicated_messages": deduplicated,
+        "distinct_payloads": distinct,
+        "dedup_ratio": round(hashed / distinct, 2) if distinct else None,  # messages per distinct payload
+    }
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import base64
+import csv
+import io
+import zlib
+from datetime import datetime
+from typing import Iterator
+
+from sqlalchemy import Select, and_, or_, select
+from sqlalchemy.orm import selectinload
+
+from .db import SessionLocal
+from .models import MqttMessage
+from .payloads import dumps_json, payload_for_api
+from .query import like_prefix, payload_contains_condition, topic_filters_condition
+
+EXPORT_CHUNK_ROWS = 5000
+
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{row_id}".encode()).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        ts, row_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode().split("|")
+        return datetime.fromisoformat(ts), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def messages_query(
+    session_id: str,
+    topic_prefix: str | None = None,
+    after: str | None = None,
+    *,
+    topic_filters: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    payload_contains: dict | None = None,
+) -> Select:
+    """Messages of a session in (ts, id) order, optionally continuing after a keyset cursor.
+
+    ``start`` is inclusive, ``end`` exclusive; see app/query.py for the topic and payload predicates.
+    """
+    # Blobs of deduplicated rows come in one extra IN query per chunk; inline rows are not joined at all.
+    q = select(MqttMessage).options(selectinload(MqttMessage.blob)).where(MqttMessage.session_id == session_id)
+    if topic_prefix:
+        q = q.where(MqttMessage.topic.like(like_prefix(topic_prefix)))
+    if topic_filters:
+        q = q.where(topic_filters_condition(topic_filters))
+    if start is not None:
+        q = q.where(MqttMessage.ts >= start)
+    if end is not None:
+        q = q.where(MqttMessage.ts < end)
+    if payload_contains is not None:
+        q = q.where(payload_contains_condition(payload_contains))
+    if after:
+        ts, row_id = decode_cursor(after)
+        # The plain ts >= bound lets ix_msg_session_ts drive the scan; the OR resolves ties on ts.
+        q = q.where(
+            MqttMessage.ts >= ts,
+            or_(MqttMessage.ts > ts, and_(MqttMessage.ts == ts, MqttMessage.id > row_id)),
+        )
+    return q.order_by(MqttMessage.ts.asc(), MqttMessage.id.asc())
+
+
+def _stream(session_id: str, topic_prefix: str | None) -> Iterator[list[MqttMessage]]:
+    with SessionLocal() as db:
+        result = db.execute(
+            messages_query(session_id, topic_prefix).execution_options(yield_per=EXPORT_CHUNK_ROWS)
+        ).scalars()
+        yield from result.partitions()
+
+
+def _ndjson(rows: list[MqttMessage]) -> bytes:
+    return b"".join(
+        dumps_json(
+            {
+                "ts": r.ts.isoformat(),
+                "topic": r.topic,
+                "payload": payload_for_api(*r.payload_parts()),
+                "qos": r.qos,
+                "retained": r.retained,
+            }
+        )
+        + b"\n"
+        for r in rows
+    )
+
+
+def _csv(rows: list[MqttMessage]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for r in rows:
+        payload = dumps_json(payload_for_api(*r.payload_parts())).decode("utf-8")
+        w.writerow([r.ts.isoformat(), r.topic, r.qos, r.retained, payload])
+    return buf.getvalue().encode("utf-8")
+
+
+def iter_export(session_id: str, fmt: str, gzip: bool = False, topic_prefix: str | None = None) -> Iterator[bytes]:
+    """Encoded export of a session, one chunk per server-side cursor fetch."""
+    encode = _csv if fmt == "csv" else _ndjson
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+
+    def out(data: bytes) -> bytes:
+        return gz.compress(data) if gz else data
+
+    if fmt == "csv":
+        yield out(b"ts,topic,qos,retained,payload\r\n")
+    for rows in _stream(session_id, topic_prefix):
+        data = out(encode(rows))
+        if data:
+            yield data
+    if gz:
+        yield gz.flush()
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import Table, insert
+from sqlalchemy.dialects import postgresql
+
+from . import metrics
+from .config import settings
+from .db import Base, SessionLocal, engine
+from .dedup import with_blobs
+from .journal import Journal
+from .models import MqttMessage
+from .rollups import RULES, ROLLUP_KEY, RollupAggregator
+from .stats import SessionStats
+
+logger = logging.getLogger(__name__)
+
+RowWriter = Callable[[list[dict]], None]
+# Called with the rows of a committed batch and their payload sizes; must not raise, the rows are stored already.
+CommitHook = Callable[[list[dict], list[int]], None]
+
+# Queued rows may carry their MQTT payload size under this key; it is removed before the write.
+SIZE_KEY = "_bytes"
+
+
+def insert_rows(rows: list[dict], table: Table = MqttMessage.__table__) -> None:
+    with SessionLocal() as db:
+        db.execute(insert(table), rows)
+        db.commit()
+
+
+def copy_rows(rows: list[dict], table: Table = MqttMessage.__table__, binary: bool = True) -> None:
+    # Rows of one batch share their keys, so the column list comes from the first row.
+    columns = list(rows[0])
+    types = [table.c[name].type.compile(dialect=postgresql.dialect()).lower() for name in columns]
+    quote = engine.dialect.identifier_preparer
+    fmt = " (FORMAT BINARY)" if binary else ""
+    sql = f"COPY {quote.format_table(table)} ({', '.join(quote.quote(c) for c in columns)}) FROM STDIN{fmt}"
+    with engine.begin() as conn:
+        with conn.connection.driver_connection.cursor() as cur:
+            with cur.copy(sql) as copy:
+                copy.set_types(types)
+                for row in rows:
+                    copy.write_row([row[name] for name in columns])
+
+
+def commit_hooks(*hooks: CommitHook | None) -> CommitHook | None:
+    """One hook calling each of ``hooks`` in turn, or None if none is set."""
+    hooks = [h for h in hooks if h is not None]
+    if len(hooks) <= 1:
+        return hooks[0] if hooks else None
+
+    def call_all(rows: list[dict], sizes: list[int]) -> None:
+        for hook in hooks:
+            hook(rows, sizes)
+
+    return call_all
+
+
+def write_counted(write: RowWriter, rows: list[dict], on_committed: CommitHook | None = None) -> int:
+    """Write ``rows`` with ``write`` and return the payload bytes they carried under ``SIZE_KEY``.
+
+    Rollup values under ``ROLLUP_KEY`` are kept out of the write and are still on the rows ``on_committed`` sees.
+    """
+    sizes = [row.pop(SIZE_KEY, 0) for row in rows]
+    rolled = [(row, row.pop(ROLLUP_KEY)) for row in rows if ROLLUP_KEY in row]
+    try:
+        write(rows)
+    except Exception:
+        # Failed rows are retried later (journal), so they keep their size.
+        for row, size in zip(rows, sizes):
+            if size:
+                row[SIZE_KEY] = size
+        raise
+    finally:
+        for row, values in rolled:
+            row[ROLLUP_KEY] = values
+    if on_committed is not None:
+        on_committed(rows, sizes)
+    return sum(sizes)
+
+
+def row_writer(table: Table = MqttMessage.__table__) -> RowWriter:
+    """Return the batch write function for ``table`` according to ``settings.ingest_backend``."""
+    if settings.ingest_backend == "copy":
+        if engine.dialect.driver == "psycopg":
+            return partial(copy_rows, table=table, binary=settings.ingest_copy_format == "binary")
+        logger.warning(
+            "COPY ingest requires the psycopg driver, falling back to INSERT",
+            extra={"driver": engine.dialect.driver, "table": table.name},
+        )
+    return partial(insert_rows, table=table)
+
+
+class BatchWriter:
+    """Drains a queue into batches and commits them on a dedicated thread pool.
+
+    Up to ``pipeline_depth`` batches are committed concurrently while the next
+    one keeps filling, so a slow commit never blocks the event loop. Without
+    ``on_failed`` the first failed batch stops the writer; with it, failed
+    batches are handed over (on the event loop) and writing continues.
+    ``on_committed`` sees every committed batch on its writer thread.
+    """
+
+    def __init__(
+        self,
+        write: RowWriter,
+        *,
+        name: str = "mqtt_message",
+        batch_size: int | None = None,
+        flush_interval: float | None = None,
+        pipeline_depth: int | None = None,
+        on_failed: Callable[[list[dict]], None] | None = None,
+        on_committed: CommitHook | None = None,
+    ):
+        self.name = name
+        self.batch_size = max(1, batch_size or settings.recorder_batch_size)
+        self.flush_interval = flush_interval if flush_interval is not None else settings.recorder_flush_interval
+        self.pipeline_depth = max(1, pipeline_depth or settings.recorder_pipeline_depth)
+        self._write = write
+        self._on_failed = on_failed
+        self._on_committed = on_committed
+        self._executor = ThreadPoolExecutor(max_workers=self.pipeline_depth, thread_name_prefix=f"db-writer-{name}")
+        self._slots = asyncio.Semaphore(self.pipeline_depth)
+        self._inflight: set[asyncio.Future] = set()
+        self._error: BaseException | None = None
+        self._attrs = {"sink": name}
+        self.persisted_rows = 0
+        self.persisted_bytes = 0
+
+    async def run(self, queue: asyncio.Queue[dict]) -> None:
+        loop = asyncio.get_running_loop()
+        batch: list[dict] = []
+        deadline = 0.0
+        done = False
+        try:
+            while not done:
+                if batch:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        await self._submit(batch)
+                        batch = []
+                        continue
+                else:
+                    item = await queue.get()
+                    deadline = loop.time() + self.flush_interval
+
+                # Take whatever is already queued without yielding to the loop again.
+                while True:
+                    if item.get("_flush"):
+                        done = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        await self._submit(batch)
+                        batch = []
+                        deadline = loop.time() + self.flush_interval
+                    try:
+                        item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+
+            await self._submit(batch)
+        finally:
+            await self._drain()
+            self._executor.shutdown(wait=False)
+
+    async def _submit(self, batch: list[dict]) -> None:
+        if not batch:
+            return
+        self._raise_if_failed()
+        await self._slots.acquire()
+        fut = asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, batch)
+        self._inflight.add(fut)
+        fut.add_done_callback(partial(self._on_done, batch))
+
+    def _on_done(self, batch: list[dict], fut: asyncio.Future) -> None:
+        self._inflight.discard(fut)
+        self._slots.release()
+        if fut.cancelled():
+            return
+        if fut.exception() is None:
+            self.persisted_rows += len(batch)
+            self.persisted_bytes += fut.result()
+            return
+        if self._on_failed is not None:
+            self._on_failed(batch)
+        elif self._error is None:
+            self._error = fut.exception()
+
+    async def _drain(self) -> None:
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        self._raise_if_failed()
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _write_batch(self, batch: list[dict]) -> int:
+        started = time.perf_counter()
+        try:
+            size = write_counted(self._write, batch, self._on_committed)
+        except Exception:
+            logger.exception("Failed to persist MQTT batch", extra={"rows": len(batch), "sink": self.name})
+            raise
+        elapsed = time.perf_counter() - started
+        metrics.batch_rows.record(len(batch), self._attrs)
+        metrics.batch_commit_seconds.record(elapsed, self._attrs)
+        logger.info(
+            "Persisted MQTT batch",
+            extra={"rows": len(batch), "sink": self.name, "commit_ms": round(elapsed * 1000, 2)},
+        )
+        return size
+
+
+def replay_journals(root: str | Path) -> int:
+    """Replay journals left behind by an earlier run (``<root>/<table>/<session_id>``); returns rows written."""
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+    total = 0
+    for path in sorted(p for p in root.glob("*/*") if p.is_dir()):
+        table = Base.metadata.tables.get(path.parent.name)
+        if table is None:
+            logger.warning("Journal for unknown table left untouched", extra={"journal": str(path)})
+            continue
+        journal = Journal(path, settings.recorder_journal_segment_bytes)
+        write = row_writer(table)
+        on_committed = None
+        if table is MqttMessage.__table__:
+            write = with_blobs(write)  # rows recorded with PAYLOAD_DEDUP may still carry their payload body
+            session_uuid = uuid.UUID(path.name)
+            on_committed = commit_hooks(
+                SessionStats(session_uuid).committed if settings.recorder_topic_stats else None,
+                RollupAggregator(session_uuid).committed if RULES else None,
+            )
+        replayed = 0
+        try:
+            while (rows := journal.read_head()) is not None:
+                write_counted(write, rows, on_committed)
+                journal.ack()
+                replayed += len(rows)
+        finally:
+            journal.close()
+        if replayed:
+            logger.info("Replayed leftover journal", extra={"journal": str(path), "rows": replayed})
+        total += replayed
+    return total
@@ -0,0 +1,222 @@
+"""Append-only on-disk journal the recorder spills to when Postgres falls behind.
+
+A journal is a directory of numbered segment files. Each segment holds frames::
+
+    <length:u32> <crc32:u32> <rows:u32> <written_at:f64> <pickled list of row dicts>
+
+Frames are replayed oldest first and a segment is deleted once all of its
+frames have been acknowledged, i.e. committed to the database. Every ack
+also records the position of the next unacknowledged frame in the ``ack``
+file (``<segment:i64> <offset:u64>``, fsynced), so frames committed before a
+crash or an interrupted replay are skipped when the journal is reopened.
+Frames are only ever read back by the process that owns ``RECORDER_JOURNAL_DIR``.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<IIId")
+_ACK = struct.Struct("<qQ")
+_SUFFIX = ".seg"
+_ACK_FILE = "ack"
+
+
+def prepare_journal_root(path: str | Path) -> Path:
+    """Create the journal root and check that it is writable, at startup rather than on the first spill."""
+    root = Path(path)
+    try:
+        root.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryFile(dir=root):
+            pass
+    except OSError as e:
+        raise RuntimeError(
+            f"RECORDER_JOURNAL_DIR={path} is not usable ({e.strerror}); "
+            "point it to a writable directory or unset it to disable the journal"
+        ) from e
+    return root
+
+
+@dataclass(frozen=True)
+class _Frame:
+    segment: int
+    offset: int
+    length: int
+    crc: int
+    rows: int
+    written_at: float
+
+
+class Journal:
+    """Segmented frame log; thread-safe, all methods block on file I/O."""
+
+    def __init__(self, path: str | Path, segment_bytes: int):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._frames: deque[_Frame] = deque()
+        self._segment_sizes: dict[int, int] = {}
+        self._out = None
+        self._dirty = False
+        self.pending_rows = 0
+        self.size_bytes = 0
+        self._ack_fd = os.open(self.path / _ACK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        acked = os.pread(self._ack_fd, _ACK.size, 0)
+        self._acked = _ACK.unpack(acked) if len(acked) == _ACK.size else (-1, 0)
+        # New segments are numbered after the acked position even when every segment file is gone.
+        self._out_segment = self._acked[0]
+        for segment in sorted(int(p.stem) for p in self.path.glob(f"*{_SUFFIX}")):
+            self._scan(segment)
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.path / f"{segment:012d}{_SUFFIX}"
+
+    def _scan(self, segment: int) -> None:
+        """Index the unacknowledged frames of a segment left over from an earlier run; a torn tail is cut off."""
+        path = self._segment_path(segment)
+        acked_segment, acked_offset = self._acked
+        offset = 0
+        pending = 0
+        with path.open("rb") as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc, rows, written_at = _HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                if segment > acked_segment or (segment == acked_segment and offset >= acked_offset):
+                    self._frames.append(_Frame(segment, offset, length, crc, rows, written_at))
+                    self.pending_rows += rows
+                    pending += 1
+                offset += _HEADER.size + length
+        if offset < path.stat().st_size:
+            logger.warning("Truncating torn journal segment", extra={"segment": str(path), "valid_bytes": offset})
+            os.truncate(path, offset)
+        self._out_segment = max(self._out_segment, segment)
+        if not pending:
+            # Empty, or fully replayed before the crash; reopened segments are never appended to.
+            path.unlink()
+            return
+        self._segment_sizes[segment] = offset
+        self.size_bytes += offset
+
+    @property
+    def segments(self) -> int:
+        return len(self._segment_sizes)
+
+    def oldest_written_at(self) -> float | None:
+        frames = self._frames
+        return frames[0].written_at if frames else None
+
+    def append(self, rows: list[dict], frame_rows: int) -> None:
+        """Write ``rows`` as frames of up to ``frame_rows`` rows and fsync once for all of them."""
+        if not rows:
+            return
+        with self._lock:
+            for start in range(0, len(rows), frame_rows):
+                chunk = rows[start:start + frame_rows]
+                body = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+                out = self._writable()
+                offset = self._segment_sizes[self._out_segment]
+                crc = zlib.crc32(body)
+                written_at = time.time()
+                out.write(_HEADER.pack(len(body), crc, len(chunk), written_at))
+                out.write(body)
+                size = _HEADER.size + len(body)
+                self._frames.append(_Frame(self._out_segment, offset, len(body), crc, len(chunk), written_at))
+                self._segment_sizes[self._out_segment] = offset + size
+                self.pending_rows += len(chunk)
+                self.size_bytes += size
+            self._dirty = True
+            self._sync()
+
+    def _writable(self):
+        size = self._segment_sizes.get(self._out_segment)
+        if self._out is not None and size is not None and size < self.segment_bytes:
+            return self._out
+        self._close_out()
+        self._out_segment += 1
+        self._out = self._segment_path(self._out_segment).open("ab")
+        self._segment_sizes[self._out_segment] = 0
+        return self._out
+
+    def _sync(self) -> None:
+        if self._out is not None and self._dirty:
+            self._out.flush()
+            os.fsync(self._out.fileno())
+            self._dirty = False
+
+    def _close_out(self) -> None:
+        if self._out is not None:
+            self._sync()
+            self._out.close()
+            self._out = None
+
+    def read_head(self) -> list[dict] | None:
+        """Rows of the oldest unacknowledged frame, or None when the journal is empty."""
+        with self._lock:
+            if not self._frames:
+                return None
+            frame = self._frames[0]
+            if frame.segment == self._out_segment and self._out is not None:
+                self._out.flush()
+        with self._segment_path(frame.segment).open("rb") as f:
+            f.seek(frame.offset + _HEADER.size)
+            body = f.read(frame.length)
+        if zlib.crc32(body) != frame.crc:
+            raise ValueError(f"Corrupt journal frame in segment {frame.segment} at offset {frame.offset}")
+        return pickle.loads(body)
+
+    def ack(self) -> None:
+        """Drop the oldest frame after it was committed; deletes segments that are fully replayed."""
+        with self._lock:
+            frame = self._frames.popleft()
+            self.pending_rows -= frame.rows
+            self._acked = (frame.segment, frame.offset + _HEADER.size + frame.length)
+            os.pwrite(self._ack_fd, _ACK.pack(*self._acked), 0)
+            os.fsync(self._ack_fd)
+            if self._frames and self._frames[0].segment == frame.segment:
+                return
+            # The segment is done; the one being written to is only removed once the journal is empty.
+            if frame.segment == self._out_segment:
+                if self._frames:
+                    return
+                self._close_out()
+            self._segment_path(frame.segment).unlink(missing_ok=True)
+            self.size_bytes -= self._segment_sizes.pop(frame.segment)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_out()
+            if self._ack_fd is not None:
+                os.close(self._ack_fd)
+                self._ack_fd = None
+        if not self._segment_sizes:
+            try:
+                (self.path / _ACK_FILE).unlink(missing_ok=True)
+                self.path.rmdir()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        oldest = self.oldest_written_at()
+        return {
+            "pending_rows": self.pending_rows,
+            "size_bytes": self.size_bytes,
+            "segments": self.segments,
+            "lag_s": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+        }
@@ -1,14 +1,65 @@
-from fastapi import FastAPI
-from .api import router
-from .db import engine
-from .models import Base
-from .telemetry import setup_observability
+import asyncio
+from fastapi import FastAPI, Response
+from sqlalchemy import text
+from .api import coordinator, recorder, router
+from .cluster import claim_journal_dir, replay_orphaned_journals
+from .config import settings
+from .db import async_engine, engine
+from .ingest import replay_journals
+from .journal import prepare_journal_root
+from .metrics import render_prometheus
+from .models import Base, ONLINE_INDEX_UPGRADES, SCHEMA_UPGRADES
+from . import routing  # noqa: F401  registers the sink route tables on Base.metadata
+from .partitions import bootstrap_partitions, create_index_online, maintenance_loop
+from .telemetry import setup_observability, shutdown_observability
 
 app = FastAPI(title="MQTT Recorder/Playback")
 app.include_router(router, prefix="/v1")
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Collected on the event loop so the observable callbacks see the pipelines in a consistent state.
+    return Response(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.on_event("startup")
 def on_startup():
     setup_observability()
     # Simple bootstrap: create tables if they do not exist
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for stmt in SCHEMA_UPGRADES:
+            conn.execute(text(stmt))
+    bootstrap_partitions()
+    for index in ONLINE_INDEX_UPGRADES:
+        create_index_online(*index)
+    if settings.recorder_journal_dir:
+        prepare_journal_root(settings.recorder_journal_dir)
+    if settings.recorder_journal_dir and coordinator is not None:
+        # Each node journals into a directory of its own and picks up those of nodes that died on this host.
+        root = settings.recorder_journal_dir
+        own, app.state.journal_lock = claim_journal_dir(root, coordinator.node_id)
+        replay_orphaned_journals(root, own)
+        settings.recorder_journal_dir = str(own)
+    elif settings.recorder_journal_dir:
+        # Messages spilled before a crash or an unclean stop; recording must not start before they are in.
+        replay_journals(settings.recorder_journal_dir)
+
+@app.on_event("startup")
+async def start_maintenance():
+    if settings.mqtt_message_partitioning != "none" or settings.retention_days or settings.payload_dedup:
+        app.state.maintenance = asyncio.create_task(maintenance_loop())
+    if coordinator is not None:
+        coordinator.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    maintenance = getattr(app.state, "maintenance", None)
+    if maintenance:
+        maintenance.cancel()
+    # Flush every active recording before the process exits.
+    if coordinator is not None:
+        await coordinator.shutdown()
+    else:
+        await recorder.stop_all()
+    await async_engine.dispose()
+    shutdown_observability()
@@ -0,0 +1,169 @@
+"""OpenTelemetry metrics for the recorder and player, rendered for Prometheus at ``/metrics``.
+
+Per-message counts are plain integers kept by the pipelines and read by
+observable instruments only when metrics are collected, so the hot loops pay
+one integer increment per message. Histograms are recorded once per batch,
+except playback lag, which is recorded per message in ``timed`` mode.
+"""
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING, Iterable
+
+from opentelemetry.metrics import CallbackOptions, Observation
+from opentelemetry.sdk.metrics import AlwaysOffExemplarFilter, MeterProvider
+from opentelemetry.sdk.metrics import Histogram as HistogramInstrument
+from opentelemetry.sdk.metrics.export import Gauge, Histogram, InMemoryMetricReader, Sum
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation, View
+from opentelemetry.sdk.resources import Resource
+
+from .config import settings
+
+if TYPE_CHECKING:
+    from .services import PlaybackService, RecorderManager
+
+_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_ROWS_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2000, 5000, 10000)
+
+reader = InMemoryMetricReader()
+provider = MeterProvider(
+    metric_readers=[reader],
+    resource=Resource.create({"service.name": settings.otel_service_name}),
+    exemplar_filter=AlwaysOffExemplarFilter(),
+    views=[
+        View(
+            instrument_type=HistogramInstrument, instrument_name="*_seconds",
+            aggregation=ExplicitBucketHistogramAggregation(_SECONDS_BUCKETS),
+        ),
+        View(
+            instrument_type=HistogramInstrument, instrument_name="*_rows",
+            aggregation=ExplicitBucketHistogramAggregation(_ROWS_BUCKETS),
+        ),
+    ],
+)
+meter = provider.get_meter("mqtt_recorder")
+
+batch_rows = meter.create_histogram(
+    "mqtt_recorder_batch_rows", unit="1", description="Rows per committed batch"
+)
+batch_commit_seconds = meter.create_histogram(
+    "mqtt_recorder_batch_commit_seconds", unit="s", description="Time to write and commit one batch"
+)
+playback_lag_seconds = meter.create_histogram(
+    "mqtt_playback_schedule_lag_seconds", unit="s", description="How late messages were published in timed playback"
+)
+
+
+def instrument_pipelines(recorder: RecorderManager, player: PlaybackService) -> None:
+    """Register the observable instruments that read the live counters of ``recorder`` and ``player``."""
+
+    def sessions(options: CallbackOptions, field: str) -> Iterable[Observation]:
+        for rec in recorder.recorders():
+            yield Observation(getattr(rec, field), {"session_id": rec.session_id})
+
+    def sinks(options: CallbackOptions, field: str) -> Iterable[Observation]:
+        for rec in recorder.recorders():
+            for sink in rec.sinks():
+                yield Observation(getattr(sink, field), {"session_id": rec.session_id, "sink": sink.name})
+
+    def published(options: CallbackOptions) -> Iterable[Observation]:
+        for status in player.status():
+            yield Observation(status["published"], {"session_id": status["session_id"], "playback_id": status["playback_id"]})
+
+    def observe(fn, field):
+        return [lambda options: fn(options, field)]
+
+    meter.create_observable_counter(
+        "mqtt_recorder_messages_received", observe(sessions, "received"), unit="1",
+        description="MQTT messages routed to a recording session",
+    )
+    meter.create_observable_counter(
+        "mqtt_recorder_bytes_received", observe(sessions, "received_bytes"), unit="By",
+        description="Payload bytes routed to a recording session",
+    )
+    meter.create_observable_counter(
+        "mqtt_recorder_messages_deduplicated", observe(sessions, "deduplicated"), unit="1",
+        description="Messages stored as a reference to an already stored payload (PAYLOAD_DEDUP)",
+    )
+    meter.create_observable_counter(
+        "mqtt_recorder_rows_persisted", observe(sinks, "persisted_rows"), unit="1",
+        description="Rows committed per session and sink table",
+    )
+    meter.create_observable_counter(
+        "mqtt_recorder_bytes_persisted", observe(sinks, "persisted_bytes"), unit="By",
+        description="Payload bytes committed per session and sink table",
+    )
+    meter.create_observable_gauge(
+        "mqtt_recorder_queue_depth", observe(sinks, "queue_depth"), unit="1",
+        description="Rows waiting in the in-memory queue",
+    )
+    meter.create_observable_counter(
+        "mqtt_recorder_messages_dropped", observe(sinks, "dropped"), unit="1",
+        description="Messages dropped because the queue was full and no journal is configured",
+    )
+    meter.create_observable_gauge(
+        "mqtt_recorder_journal_pending_rows", observe(sinks, "journal_pending_rows"), unit="1",
+        description="Rows spilled to the journal and not yet replayed",
+    )
+    meter.create_observable_counter(
+        "mqtt_playback_messages_published", [published], unit="1",
+        description="Messages published per playback",
+    )
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(attributes, extra: tuple[str, str] | None = None) -> str:
+    items = [(k, _escape(v)) for k, v in (attributes or {}).items()]
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+    return repr(value)
+
+
+def render_prometheus() -> str:
+    """Collect all instruments and render them in the Prometheus text exposition format."""
+    data = reader.get_metrics_data()
+    lines: list[str] = []
+    for resource_metrics in data.resource_metrics if data else ():
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                name = metric.name.replace(".", "_")
+                points = metric.data.data_points
+                if isinstance(metric.data, Sum):
+                    kind = "counter" if metric.data.is_monotonic else "gauge"
+                    if kind == "counter" and not name.endswith("_total"):
+                        name += "_total"
+                elif isinstance(metric.data, Gauge):
+                    kind = "gauge"
+                elif isinstance(metric.data, Histogram):
+                    kind = "histogram"
+                else:
+                    continue
+                if metric.description:
+                    lines.append(f"# HELP {name} {metric.description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for point in points:
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(point.attributes)} {_number(point.value)}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*point.explicit_bounds, math.inf), point.bucket_counts):
+                        cumulative += count
+                        le = ("le", _number(float(bound)))
+                        lines.append(f"{name}_bucket{_labels(point.attributes, le)} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(point.attributes)} {_number(point.sum)}")
+                    lines.append(f"{name}_count{_labels(point.attributes)} {point.count}")
+    return "\n".join(lines) + "\n"
@@ -1,11 +1,15 @@
 import uuid
 from sqlalchemy import (
-    BigInteger, Boolean, DateTime, ForeignKey, Index, SmallInteger, Text, func
+    BigInteger, Boolean, DateTime, ForeignKey, Index, LargeBinary, SmallInteger, Text, func
 )
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from .config import settings
 from .db import Base
 
+_partitioning = settings.mqtt_message_partitioning
+_partition_by = {"time": "RANGE (ts)", "session": "LIST (session_id)"}
+
 class RecordingSession(Base):
     __tablename__ = "recording_session"
 
@@ -13,6 +17,7 @@ class RecordingSession(Base):
     node: Mapped[str] = mapped_column(Text, nullable=False)
     topic_filters: Mapped[list] = mapped_column(JSONB, nullable=False)  # JSON list of topic filters
     state: Mapped[str] = mapped_column(Text, nullable=False, default="CREATED")
+    shares: Mapped[int] = mapped_column(SmallInteger, nullable=False, default=1)  # cluster nodes splitting the recording
 
     created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     started_at: Mapped[DateTime | None] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -20,20 +25,108 @@ class RecordingSession(Base):
 
     messages = relationship("MqttMessage", back_populates="session")
 
+class PayloadBlob(Base):
+    """Distinct payload bodies of deduplicated messages, keyed by hash (see app/dedup.py)."""
+    __tablename__ = "payload_blob"
+
+    hash: Mapped[bytes] = mapped_column(LargeBinary, primary_key=True)
+    payload_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+    payload_raw: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    # Last time a batch referring to it was written; GC keeps recently referenced blobs.
+    referenced_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
 class MqttMessage(Base):
     __tablename__ = "mqtt_message"
+    # Partitioned tables need the partition key in the primary key (see app/partitions.py).
+    __table_args__ = {"postgresql_partition_by": _partition_by[_partitioning]} if _partitioning in _partition_by else {}
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
-    session_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("recording_session.id"), index=True)
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("recording_session.id"), index=True, primary_key=_partitioning == "session"
+    )
 
-    ts: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+    ts: Mapped[DateTime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), index=True, primary_key=_partitioning == "time"
+    )
     topic: Mapped[str] = mapped_column(Text, nullable=False, index=True)
-    payload_json: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    payload_json: Mapped[dict | None] = mapped_column(JSONB, nullable=True)  # NULL when only raw bytes are stored
+    payload_raw: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)  # original payload bytes
     qos: Mapped[int] = mapped_column(SmallInteger, nullable=False, default=0)
     retained: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    payload_hash: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)  # set instead of payload_* when deduplicated
 
     session = relationship("RecordingSession", back_populates="messages")
+    # Loaded only where payloads are resolved, see export.messages_query.
+    blob = relationship(
+        PayloadBlob, primaryjoin="foreign(MqttMessage.payload_hash) == PayloadBlob.hash", lazy="raise", viewonly=True
+    )
+
+    def payload_parts(self) -> tuple[bytes | None, dict | None]:
+        """(payload_raw, payload_json), from payload_blob when the row is deduplicated."""
+        if self.payload_hash is not None and self.blob is not None:
+            return self.blob.payload_raw, self.blob.payload_json
+        return self.payload_raw, self.payload_json
+
+class SessionTopicStats(Base):
+    """Running per-topic aggregates of a session, maintained by the recorder (see app/stats.py)."""
+    __tablename__ = "session_topic_stats"
+
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("recording_session.id"), primary_key=True
+    )
+    topic: Mapped[str] = mapped_column(Text, primary_key=True)
+    message_count: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    payload_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    first_ts: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+    last_ts: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+    interval_hist: Mapped[list] = mapped_column(ARRAY(BigInteger), nullable=False)  # see stats.INTERVAL_BOUNDS_S
+
+class RecorderNode(Base):
+    """A process taking part in cluster recording (see app/cluster.py)."""
+    __tablename__ = "recorder_node"
+
+    node_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    started_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    heartbeat_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
+    stats: Mapped[dict] = mapped_column(JSONB, nullable=False, default=dict)
+
+class RecorderLease(Base):
+    """Claim of one share (slot) of a recording session by a node, valid until ``expires_at``."""
+    __tablename__ = "recorder_lease"
+
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("recording_session.id", ondelete="CASCADE"), primary_key=True
+    )
+    slot: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    node_id: Mapped[str] = mapped_column(Text, nullable=False)
+    expires_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=False)
 
 Index("ix_msg_session_ts", MqttMessage.session_id, MqttMessage.ts)
-Index("ix_msg_session_topic", MqttMessage.session_id, MqttMessage.topic)
-Index("ix_msg_payload_gin", MqttMessage.payload_json, postgresql_using="gin")
+# text_pattern_ops so topic LIKE 'prefix%' can use it whatever the database collation; it serves equality as well.
+Index("ix_msg_session_topic_pattern", MqttMessage.session_id, MqttMessage.topic, postgresql_ops={"topic": "text_pattern_ops"})
+Index("ix_msg_payload_hash", MqttMessage.payload_hash, postgresql_where=MqttMessage.payload_hash.isnot(None))
+if settings.mqtt_message_gin_index:
+    Index("ix_msg_payload_gin", MqttMessage.payload_json, postgresql_using="gin")
+    Index("ix_payload_blob_gin", PayloadBlob.payload_json, postgresql_using="gin")
+
+# Payload of any row, deduplicated or not, for column selects outer-joined with PayloadBlob on BLOB_JOIN.
+BLOB_JOIN = PayloadBlob.hash == MqttMessage.payload_hash
+PAYLOAD_RAW = func.coalesce(MqttMessage.payload_raw, PayloadBlob.payload_raw).label("payload_raw")
+PAYLOAD_JSON = func.coalesce(MqttMessage.payload_json, PayloadBlob.payload_json).label("payload_json")
+
+# Idempotent changes for databases created by older versions (create_all only adds missing tables).
+SCHEMA_UPGRADES = [
+    "ALTER TABLE mqtt_message ADD COLUMN IF NOT EXISTS payload_raw bytea",
+    "ALTER TABLE mqtt_message ALTER COLUMN payload_json DROP NOT NULL",
+    "ALTER TABLE mqtt_message ADD COLUMN IF NOT EXISTS payload_hash bytea",
+    "ALTER TABLE payload_blob ADD COLUMN IF NOT EXISTS referenced_at timestamptz NOT NULL DEFAULT now()",
+    "ALTER TABLE recording_session ADD COLUMN IF NOT EXISTS shares smallint NOT NULL DEFAULT 1",
+]
+
+# Indexes added to an existing mqtt_message without blocking writes (see partitions.create_index_online):
+# (name, short name for per-partition indexes, columns and predicate, index it replaces)
+ONLINE_INDEX_UPGRADES = [
+    ("ix_msg_session_topic_pattern", "topic_pattern", "(session_id, topic text_pattern_ops)", "ix_msg_session_topic"),
+    ("ix_msg_payload_hash", "payload_hash", "(payload_hash) WHERE payload_hash IS NOT NULL", None),
+]
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+
+from sqlalchemy import Connection, delete, select, text
+
+from .config import settings
+from .db import engine
+from .models import ONLINE_INDEX_UPGRADES, MqttMessage, RecordingSession
+from .dedup import gc_payload_blobs
+from .rollups import delete_session_rollups
+from .routing import delete_routed_rows
+from .stats import delete_session_stats
+
+logger = logging.getLogger(__name__)
+
+PARENT = MqttMessage.__tablename__
+DEFAULT_PARTITION = f"{PARENT}_default"
+
+
+def is_partitioned(conn: Connection) -> bool:
+    kind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {"t": PARENT}).scalar()
+    return kind == "p"
+
+
+def list_partitions(conn: Connection) -> list[str]:
+    return list(
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:t) ORDER BY c.relname"
+            ),
+            {"t": PARENT},
+        ).scalars()
+    )
+
+
+def _interval_start(d: date) -> date:
+    interval = settings.mqtt_message_partition_interval
+    if interval == "week":
+        return d - timedelta(days=d.weekday())
+    if interval == "month":
+        return d.replace(day=1)
+    return d
+
+
+def _next_start(start: date) -> date:
+    interval = settings.mqtt_message_partition_interval
+    if interval == "week":
+        return start + timedelta(days=7)
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def time_partition_name(start: date) -> str:
+    return f"{PARENT}_p{start:%Y%m%d}"
+
+
+def session_partition_name(session_id: str | uuid.UUID) -> str:
+    return f"{PARENT}_s{uuid.UUID(str(session_id)).hex}"
+
+
+def _time_partition_start(name: str) -> date | None:
+    prefix = f"{PARENT}_p"
+    if not name.startswith(prefix):
+        return None
+    try:
+        return datetime.strptime(name[len(prefix):], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def _create_time_partition(conn: Connection, name: str, start: date, end: date, has_default: bool) -> int:
+    """Create one time partition; returns the rows moved into it from the default partition."""
+    bounds = f"FOR VALUES FROM ('{start.isoformat()} 00:00+00') TO ('{end.isoformat()} 00:00+00')"
+    window = {"start": datetime.combine(start, time(), timezone.utc), "end": datetime.combine(end, time(), timezone.utc)}
+    in_window = "ts >= :start AND ts < :end"
+    stranded = has_default and conn.execute(
+        text(f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE {in_window})'), window
+    ).scalar()
+    if not stranded:
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT}" {bounds}'))
+        return 0
+    # The default partition already holds rows of this range (downtime, a missed maintenance run, clock
+    # skew), so the partition cannot be attached next to it. Detach it, move the rows, attach it again;
+    # the parent stays locked until the transaction commits.
+    conn.execute(text(f'ALTER TABLE "{PARENT}" DETACH PARTITION "{DEFAULT_PARTITION}"'))
+    conn.execute(text(f'CREATE TABLE "{name}" PARTITION OF "{PARENT}" {bounds}'))
+    moved = conn.execute(
+        text(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE {in_window} RETURNING *) '
+            f'INSERT INTO "{name}" SELECT * FROM moved'
+        ),
+        window,
+    ).rowcount
+    conn.execute(text(f'ALTER TABLE "{PARENT}" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT'))
+    logger.warning("Moved rows from the default partition", extra={"partition": name, "rows": moved})
+    return moved
+
+
+def ensure_time_partitions(conn: Connection, now: datetime | None = None) -> list[str]:
+    """Create the partition for ``now`` plus ``mqtt_message_partition_premake`` future ones."""
+    now = now or datetime.now(timezone.utc)
+    start = _interval_start(now.astimezone(timezone.utc).date())
+    existing = set(list_partitions(conn))
+    has_default = DEFAULT_PARTITION in existing
+    created = []
+    for _ in range(settings.mqtt_message_partition_premake + 1):
+        end = _next_start(start)
+        name = time_partition_name(start)
+        if name not in existing:
+            _create_time_partition(conn, name, start, end, has_default)
+            created.append(name)
+        start = end
+    return created
+
+
+def ensure_session_partition(session_id: str | uuid.UUID) -> None:
+    if settings.mqtt_message_partitioning != "session":
+        return
+    name = session_partition_name(session_id)
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return
+        conn.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT}" '
+                f"FOR VALUES IN ('{uuid.UUID(str(session_id))}')"
+            )
+        )
+
+
+def create_session_payload_index(session_id: str | uuid.UUID) -> str:
+    """Add a GIN index on payload_json for a single session partition."""
+    name = session_partition_name(session_id)
+    with engine.begin() as conn:
+        if name not in list_partitions(conn):
+            raise LookupError("Session has no partition of its own")
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "ix_{name}_payload_gin" ON "{name}" USING gin (payload_json)'))
+    return f"ix_{name}_payload_gin"
+
+
+def bootstrap_partitions() -> None:
+    """Called at startup: create the default partition and the upcoming time partitions."""
+    if settings.mqtt_message_partitioning == "none":
+        return
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            logger.warning(
+                "mqtt_message already exists unpartitioned, partitioning setting ignored",
+                extra={"partitioning": settings.mqtt_message_partitioning},
+            )
+            return
+        # Catches rows that have no partition yet instead of failing the insert.
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{PARENT}" DEFAULT'))
+        if settings.mqtt_message_partitioning == "time":
+            created = ensure_time_partitions(conn)
+            if created:
+                logger.info("Created mqtt_message partitions", extra={"partitions": created})
+
+
+def _index_valid(conn: Connection, name: str) -> bool | None:
+    """None if the index does not exist; False if it does but an earlier build did not finish."""
+    return conn.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+
+
+def create_index_online(name: str, short_name: str, columns: str, replaces: str | None = None) -> bool:
+    """Build an index on mqtt_message without blocking writes; returns True if it was built now.
+
+    A plain table is indexed ``CONCURRENTLY``. A partitioned one cannot be, so
+    the index is created on the parent only, built concurrently on every
+    partition and attached; the parent index becomes valid with the last one.
+    ``replaces`` is dropped once the new index is valid.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT to_regclass(:t) IS NOT NULL"), {"t": PARENT}).scalar():
+            return False
+        built = False
+        if not _index_valid(conn, name):
+            logger.info("Building index, writes continue meanwhile", extra={"index": name})
+            built = True
+            partitioned = is_partitioned(conn)
+            if not partitioned:
+                # A failed build leaves an invalid index behind, which IF NOT EXISTS would keep.
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+                conn.execute(text(f'CREATE INDEX CONCURRENTLY "{name}" ON "{PARENT}" {columns}'))
+            else:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{name}" ON ONLY "{PARENT}" {columns}'))
+                covered = set(
+                    conn.execute(
+                        text(
+                            "SELECT t.relname FROM pg_inherits i "
+                            "JOIN pg_index x ON x.indexrelid = i.inhrelid "
+                            "JOIN pg_class t ON t.oid = x.indrelid "
+                            "WHERE i.inhparent = to_regclass(:name)"
+                        ),
+                        {"name": name},
+                    ).scalars()
+                )
+                for part in list_partitions(conn):
+                    if part in covered:
+                        continue
+                    part_index = f"ix_{part}_{short_name}"
+                    conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{part_index}"'))
+                    conn.execute(text(f'CREATE INDEX CONCURRENTLY "{part_index}" ON "{part}" {columns}'))
+                    conn.execute(text(f'ALTER INDEX "{name}" ATTACH PARTITION "{part_index}"'))
+            logger.info("Built index", extra={"index": name})
+        if replaces and _index_valid(conn, name) and _index_valid(conn, replaces) is not None:
+            # Partitioned indexes cannot be dropped concurrently; dropping is quick either way.
+            concurrently = "" if is_partitioned(conn) else " CONCURRENTLY"
+            conn.execute(text(f'DROP INDEX{concurrently} IF EXISTS "{replaces}"'))
+            logger.info("Dropped replaced index", extra={"index": replaces})
+        return built
+
+
+def drop_session_messages(session_id: str | uuid.UUID, derived: bool = True) -> str:
+    """Remove all messages of a session; O(1) when the session has its own partition.
+
+    ``derived`` also removes its routed rows, topic stats and rollups.
+    """
+    if derived:
+        delete_routed_rows(session_id)
+        delete_session_stats(session_id)
+        delete_session_rollups(session_id)
+    name = session_partition_name(session_id)
+    with engine.begin() as conn:
+        if settings.mqtt_message_partitioning == "session" and name in list_partitions(conn):
+            conn.execute(text(f'DROP TABLE "{name}"'))
+            return "partition_dropped"
+        conn.execute(delete(MqttMessage).where(MqttMessage.session_id == session_id))
+        return "rows_deleted"
+
+
+def apply_retention(now: datetime | None = None) -> dict:
+    """Drop data older than ``retention_days``.
+
+    With time partitioning whole partitions older than the cutoff are
+    dropped and old rows left in the default partition are deleted. In every
+    mode, sessions stopped before the cutoff are removed with their messages,
+    routed rows, stats and rollups: O(1) per session with session
+    partitioning, a row delete otherwise.
+    """
+    if not settings.retention_days:
+        return {"dropped_partitions": [], "dropped_sessions": []}
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=settings.retention_days)
+    dropped_partitions: list[str] = []
+    dropped_sessions: list[str] = []
+    default_rows = 0
+
+    if settings.mqtt_message_partitioning == "time":
+        with engine.begin() as conn:
+            if is_partitioned(conn):
+                partitions = list_partitions(conn)
+                for name in partitions:
+                    start = _time_partition_start(name)
+                    if start is not None and _next_start(start) <= cutoff.date():
+                        conn.execute(text(f'DROP TABLE "{name}"'))
+                        dropped_partitions.append(name)
+                if DEFAULT_PARTITION in partitions:
+                    default_rows = conn.execute(
+                        text(f'DELETE FROM "{DEFAULT_PARTITION}" WHERE ts < :cutoff'), {"cutoff": cutoff}
+                    ).rowcount
+
+    with engine.begin() as conn:
+        old = conn.execute(
+            select(RecordingSession.id).where(
+                RecordingSession.state == "STOPPED", RecordingSession.stopped_at < cutoff
+            )
+        ).scalars().all()
+    for session_id in old:
+        drop_session_messages(session_id)
+        with engine.begin() as conn:
+            conn.execute(delete(RecordingSession).where(RecordingSession.id == session_id))
+        dropped_sessions.append(str(session_id))
+
+    if dropped_partitions or dropped_sessions or default_rows:
+        logger.info(
+            "Applied retention",
+            extra={
+                "cutoff": cutoff.isoformat(),
+                "partitions": dropped_partitions,
+                "sessions": dropped_sessions,
+                "default_partition_rows": default_rows,
+            },
+        )
+    return {"dropped_partitions": dropped_partitions, "dropped_sessions": dropped_sessions}
+
+
+def run_maintenance() -> None:
+    if settings.mqtt_message_partitioning == "time":
+        with engine.begin() as conn:
+            if is_partitioned(conn):
+                created = ensure_time_partitions(conn)
+                if created:
+                    logger.info("Created mqtt_message partitions", extra={"partitions": created})
+    apply_retention()
+
+
+async def maintenance_loop() -> None:
+    while True:
+        await asyncio.sleep(settings.maintenance_interval_s)
+        try:
+            await asyncio.to_thread(run_maintenance)
+        except Exception:
+            logger.exception("Partition maintenance failed")
+        if settings.payload_dedup:
+            try:
+                await asyncio.to_thread(gc_payload_blobs)
+            except Exception:
+                logger.exception("Payload blob cleanup failed")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="mqtt_message maintenance.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    sub.add_parser("build-indexes", help="build the indexes the API would otherwise build at startup")
+    ap.parse_args()
+    for index in ONLINE_INDEX_UPGRADES:
+        print(f"{index[0]}: {'built' if create_index_online(*index) else 'already present'}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
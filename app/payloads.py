@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import base64
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional, see the "fast" extra in pyproject.toml
+    orjson = None
+
+
+if orjson is not None:
+    _loads = orjson.loads
+    dumps_json = orjson.dumps
+else:
+    def _loads(raw: bytes) -> Any:
+        return json.loads(raw.decode("utf-8"))
+
+    def dumps_json(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _b64(raw: bytes) -> dict:
+    return {"_raw_b64": base64.b64encode(raw).decode("ascii"), "_encoding": "base64"}
+
+
+def decode_payload(raw: bytes) -> dict:
+    """Turn an MQTT payload into the JSON object stored in ``payload_json``.
+
+    Non-JSON payloads and payloads Postgres JSONB cannot hold (NUL bytes,
+    ``\\u0000`` escapes) are wrapped as base64; non-object JSON values are
+    wrapped as ``{"value": ...}``.
+    """
+    if b"\x00" in raw or b"\\u0000" in raw:
+        return _b64(raw)
+    try:
+        obj = _loads(raw)
+    except ValueError:
+        return _b64(raw)
+    return obj if isinstance(obj, dict) else {"value": obj}
+
+
+def payload_for_api(raw: bytes | None, payload_json: Any) -> Any:
+    """JSON view of a stored message; raw-only rows are decoded lazily on read."""
+    if payload_json is not None:
+        return payload_json
+    if raw is None:
+        return None
+    return decode_payload(raw)
+
+
+def encode_payload(raw: bytes | None, payload_json: Any) -> bytes:
+    """Bytes to publish on playback: the original payload when it was stored."""
+    if raw is not None:
+        return raw
+    if (
+        isinstance(payload_json, dict)
+        and payload_json.get("_encoding") == "base64"
+        and "_raw_b64" in payload_json
+        and len(payload_json) == 2
+    ):
+        return base64.b64decode(payload_json["_raw_b64"])
+    return dumps_json(payload_json)
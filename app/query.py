@@ -0,0 +1,110 @@
+"""Index-friendly message predicates: MQTT topic filters, payload containment and EXPLAIN.
+
+Topic filters become an equality, or a ``LIKE 'literal/prefix%'`` that
+``ix_msg_session_topic_pattern`` (``text_pattern_ops``) can range-scan, plus an
+anchored regex with the exact MQTT semantics (``+`` matches one level, ``#``
+the parent level and everything below, wildcards at the first level skip
+``$`` topics). Payload predicates are ``payload_json @> ...``, which the GIN
+index ``ix_msg_payload_gin`` serves when ``MQTT_MESSAGE_GIN_INDEX`` is on.
+"""
+from __future__ import annotations
+
+import re
+
+from sqlalchemy import and_, not_, or_, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement, ColumnElement
+
+from .config import settings
+from .models import MqttMessage, PayloadBlob
+from .topics import validate_topic_filter
+
+_REGEX_SPECIAL = re.compile(r"([.^$*+?()\[\]{}|\\])")
+
+
+def like_prefix(prefix: str) -> str:
+    """LIKE pattern matching strings that start with ``prefix`` literally."""
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _topic_regex(levels: list[str]) -> str:
+    out = "^"
+    for i, level in enumerate(levels):
+        if level == "#":
+            out += "(/.*)?"
+        elif level == "+":
+            out += "([^/$][^/]*)?" if i == 0 else "/[^/]*"
+        else:
+            out += ("/" if i else "") + _REGEX_SPECIAL.sub(r"\\\1", level)
+    return out + "$"
+
+
+def topic_filter_condition(topic_filter: str) -> ColumnElement[bool]:
+    validate_topic_filter(topic_filter)
+    topic = MqttMessage.topic
+    levels = topic_filter.split("/")
+    if topic_filter == "#":
+        return not_(topic.startswith("$", autoescape=True))
+    wild = next((i for i, level in enumerate(levels) if level in ("+", "#")), None)
+    if wild is None:
+        return topic == topic_filter
+    exact = topic.regexp_match(_topic_regex(levels))
+    if wild == 0:
+        return exact
+    # '#' also matches the parent level, so its prefix stops before the separator.
+    prefix = "/".join(levels[:wild]) + ("/" if levels[wild] == "+" else "")
+    return and_(topic.like(like_prefix(prefix)), exact)
+
+
+def topic_filters_condition(topic_filters: list[str]) -> ColumnElement[bool]:
+    return or_(*(topic_filter_condition(f) for f in topic_filters))
+
+
+def payload_contains_condition(predicate: dict) -> ColumnElement[bool]:
+    """``payload_json @> predicate``, also through payload_blob when payloads are deduplicated."""
+    if not isinstance(predicate, dict):
+        raise ValueError("Payload predicate must be a JSON object")
+    cond = MqttMessage.payload_json.contains(predicate)
+    if settings.payload_dedup:
+        cond = or_(
+            cond,
+            MqttMessage.payload_hash.in_(select(PayloadBlob.hash).where(PayloadBlob.payload_json.contains(predicate))),
+        )
+    return cond
+
+
+class Explain(Executable, ClauseElement):
+    """``EXPLAIN (FORMAT JSON)`` of a statement, with ANALYZE and BUFFERS if ``analyze``."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: ClauseElement, analyze: bool = False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element: Explain, compiler, **kw) -> str:
+    options = "FORMAT JSON, ANALYZE, BUFFERS" if element.analyze else "FORMAT JSON"
+    return f"EXPLAIN ({options}) " + compiler.process(element.statement, **kw)
+
+
+def summarize_plan(plan: dict) -> dict:
+    """Scan nodes of an EXPLAIN JSON plan: which indexes were used and which tables were read in full."""
+    indexes, seq_scans = [], []
+
+    def walk(node: dict) -> None:
+        if "Index Name" in node:
+            indexes.append(node["Index Name"])
+        if node["Node Type"] == "Seq Scan":
+            seq_scans.append(node["Relation Name"])
+        for child in node.get("Plans", ()):
+            walk(child)
+
+    walk(plan["Plan"])
+    summary = {"indexes": sorted(set(indexes)), "seq_scans": sorted(set(seq_scans)), "total_cost": plan["Plan"]["Total Cost"]}
+    if "Execution Time" in plan:
+        summary["execution_ms"] = plan["Execution Time"]
+        summary["rows"] = plan["Plan"]["Actual Rows"]
+    return summary
@@ -0,0 +1,423 @@
+"""Time-bucketed count/sum/min/max of numeric payload fields per session, topic and field.
+
+Rules are read from ``ROLLUP_RULES_FILE``, a JSON list such as::
+
+    [
+      {
+        "topic_filters": ["plant/+/status/#"],
+        "fields": {"temperature": "$.data.temp", "pressure": "$.p"}
+      }
+    ]
+
+The recorder extracts the values when a message arrives and carries them with
+its row under ``ROLLUP_KEY``; once the mqtt_message batch is committed they are
+aggregated into 1 s buckets and added to ``rollup_1s``, ``rollup_1m`` and
+``rollup_1h`` with additive upserts, so dropped rows are never counted and
+journaled rows are counted when they are replayed. Values that are missing or not numeric
+are skipped. If a topic matches several rules defining the same field, the
+first rule in the file wins. Sessions recorded before a rule existed are
+filled in from mqtt_message with::
+
+    python -m app.rollups backfill <SESSION_ID> [<SESSION_ID> ...]
+    python -m app.rollups backfill --all
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+from sqlalchemy import BigInteger, Column, Connection, DateTime, Double, Index, Table, Text, delete, func, select, union_all
+from sqlalchemy.dialects.postgresql import UUID, insert
+
+from .config import settings
+from .db import Base, SessionLocal, engine
+from .models import BLOB_JOIN, PAYLOAD_JSON, PAYLOAD_RAW, MqttMessage, PayloadBlob, RecordingSession
+from .payloads import payload_for_api
+from .routing import compile_path, to_float
+from .topics import TopicTrie, validate_topic_filter
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MAX_POINTS = 100_000  # per topic and query
+_DEFAULT_POINTS = 500  # target points per topic when no resolution is requested
+
+# Queued mqtt_message rows carry their extracted (field, value) pairs under this key; it is never written.
+ROLLUP_KEY = "_rollup"
+
+
+def _rollup_table(name: str) -> Table:
+    return Table(
+        name,
+        Base.metadata,
+        Column("session_id", UUID(as_uuid=True), primary_key=True),
+        Column("topic", Text, primary_key=True),
+        Column("field", Text, primary_key=True),
+        Column("bucket", DateTime(timezone=True), primary_key=True),
+        Column("count", BigInteger, nullable=False),
+        Column("sum", Double, nullable=False),
+        Column("min", Double, nullable=False),
+        Column("max", Double, nullable=False),
+        # Dashboards query one field across sessions; the primary key covers per-session access.
+        Index(f"ix_{name}_field_bucket", "field", "bucket"),
+    )
+
+
+# Bucket width in seconds and table, finest first.
+LEVELS: tuple[tuple[int, Table], ...] = (
+    (1, _rollup_table("rollup_1s")),
+    (60, _rollup_table("rollup_1m")),
+    (3600, _rollup_table("rollup_1h")),
+)
+
+
+@dataclass(frozen=True, eq=False)
+class RollupRule:
+    index: int
+    topic_filters: tuple[str, ...]
+    fields: tuple[tuple[str, Callable[[Any], Any]], ...]
+
+
+def _build_rule(index: int, spec: dict) -> RollupRule:
+    filters = tuple(spec["topic_filters"])
+    if not filters:
+        raise ValueError(f"Rollup rule {index} needs at least one topic filter")
+    for f in filters:
+        validate_topic_filter(f)
+    fields = spec["fields"]
+    if not isinstance(fields, dict) or not fields:
+        raise ValueError(f"Rollup rule {index} needs a non-empty 'fields' object")
+    return RollupRule(
+        index=index,
+        topic_filters=filters,
+        fields=tuple((name, compile_path(path)) for name, path in fields.items()),
+    )
+
+
+def load_rules(path: str | None) -> list[RollupRule]:
+    if not path:
+        return []
+    specs = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(specs, list):
+        raise ValueError("ROLLUP_RULES_FILE must contain a JSON list of rules")
+    return [_build_rule(i, spec) for i, spec in enumerate(specs)]
+
+
+RULES: list[RollupRule] = load_rules(settings.rollup_rules_file)
+
+
+def rule_trie(rules: list[RollupRule] = RULES) -> TopicTrie[RollupRule]:
+    trie: TopicTrie[RollupRule] = TopicTrie()
+    for rule in rules:
+        trie.add_many(rule.topic_filters, rule)
+    return trie
+
+
+def extract_values(rules: frozenset[RollupRule], payload: Any) -> list[tuple[str, float]]:
+    """Numeric values of all fields of the matched ``rules``; NaN and infinities are skipped."""
+    ordered = sorted(rules, key=lambda r: r.index) if len(rules) > 1 else rules
+    values: dict[str, float] = {}
+    for rule in ordered:
+        for name, get in rule.fields:
+            if name in values:
+                continue
+            v = to_float(get(payload))
+            if v is not None and math.isfinite(v):
+                values[name] = v
+    return list(values.items())
+
+
+def _merge(into: dict, key: tuple, agg: list[float]) -> None:
+    cur = into.get(key)
+    if cur is None:
+        into[key] = list(agg)
+        return
+    cur[0] += agg[0]
+    cur[1] += agg[1]
+    if agg[2] < cur[2]:
+        cur[2] = agg[2]
+    if agg[3] > cur[3]:
+        cur[3] = agg[3]
+
+
+def upsert_buckets(conn, session_id: uuid.UUID, seconds: dict[tuple[str, str, int], list[float]]) -> None:
+    """Add 1 s aggregates keyed by (topic, field, epoch second) to every rollup level."""
+    for width, table in LEVELS:
+        if width == 1:
+            buckets = seconds
+        else:
+            buckets = {}
+            for (topic, field, second), agg in seconds.items():
+                _merge(buckets, (topic, field, second - second % width), agg)
+        # Sorted so concurrent flushes of one session lock the rows in the same order.
+        values = [
+            {
+                "session_id": session_id,
+                "topic": topic,
+                "field": field,
+                "bucket": _EPOCH + timedelta(seconds=second),
+                "count": agg[0],
+                "sum": agg[1],
+                "min": agg[2],
+                "max": agg[3],
+            }
+            for (topic, field, second), agg in sorted(buckets.items())
+        ]
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.session_id, table.c.topic, table.c.field, table.c.bucket],
+            set_={
+                "count": table.c.count + stmt.excluded.count,
+                "sum": table.c.sum + stmt.excluded.sum,
+                "min": func.least(table.c.min, stmt.excluded.min),
+                "max": func.greatest(table.c.max, stmt.excluded.max),
+            },
+        )
+        conn.execute(stmt, values)
+
+
+class RollupAggregator:
+    """1 s buckets of one session that have not been written yet."""
+
+    def __init__(self, session_id: uuid.UUID):
+        self.session_id = session_id
+        self._pending: dict[tuple[str, str, int], list[float]] = {}  # [count, sum, min, max]
+        self._lock = threading.Lock()  # committed() and flush() run on concurrent writer threads
+
+    def observe(self, topic: str, ts: datetime, values: list[tuple[str, float]]) -> None:
+        with self._lock:
+            self._add(topic, ts, values)
+
+    def committed(self, rows: list[dict], sizes: list[int]) -> None:
+        """Aggregate the values carried by the rows of a committed batch and write the pending buckets."""
+        with self._lock:
+            for row in rows:
+                values = row.get(ROLLUP_KEY)
+                if values:
+                    self._add(row["topic"], row["ts"], values)
+        self.flush()
+
+    def _add(self, topic: str, ts: datetime, values: list[tuple[str, float]]) -> None:
+        second = math.floor(ts.timestamp())
+        pending = self._pending
+        for field, v in values:
+            key = (topic, field, second)
+            agg = pending.get(key)
+            if agg is None:
+                pending[key] = [1, v, v, v]
+                continue
+            agg[0] += 1
+            agg[1] += v
+            if v < agg[2]:
+                agg[2] = v
+            if v > agg[3]:
+                agg[3] = v
+
+    def take(self) -> dict[tuple[str, str, int], list[float]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self) -> None:
+        # Never raises: the batch itself is already committed; the buckets are kept for the next try.
+        pending = self.take()
+        if not pending:
+            return
+        try:
+            with engine.begin() as conn:
+                upsert_buckets(conn, self.session_id, pending)
+        except Exception:
+            logger.exception("Failed to store rollups", extra={"session_id": str(self.session_id)})
+            with self._lock:
+                for key, agg in pending.items():
+                    _merge(self._pending, key, agg)
+
+
+def delete_session_rollups(session_id: str | uuid.UUID) -> None:
+    with engine.begin() as conn:
+        for _, table in LEVELS:
+            conn.execute(delete(table).where(table.c.session_id == session_id))
+
+
+def backfill(session_id: str | uuid.UUID, chunk_size: int = 5000) -> int:
+    """Rebuild the rollups of a session from mqtt_message; returns the number of values aggregated."""
+    if not RULES:
+        raise RuntimeError("No rollup rules configured (set ROLLUP_RULES_FILE)")
+    session_uuid = uuid.UUID(str(session_id))
+    match = rule_trie().match
+    agg = RollupAggregator(session_uuid)
+    observed = 0
+    # One transaction: readers keep seeing the old rollups until the rebuild is complete.
+    with SessionLocal() as db, engine.begin() as conn:
+        for _, table in LEVELS:
+            conn.execute(delete(table).where(table.c.session_id == session_uuid))
+        result = db.execute(
+            select(MqttMessage.ts, MqttMessage.topic, PAYLOAD_RAW, PAYLOAD_JSON)
+            .outerjoin(PayloadBlob, BLOB_JOIN)
+            .where(MqttMessage.session_id == session_uuid)
+            .execution_options(yield_per=chunk_size)
+        )
+        for rows in result.partitions():
+            for ts, topic, raw, payload_json in rows:
+                rules = match(topic)
+                if not rules:
+                    continue
+                values = extract_values(rules, payload_for_api(raw, payload_json))
+                if values:
+                    agg.observe(topic, ts, values)
+                    observed += len(values)
+            pending = agg.take()
+            if pending:
+                upsert_buckets(conn, session_uuid, pending)
+    return observed
+
+
+def resolve_resolution(start: datetime, end: datetime, resolution_s: int | None) -> int:
+    """Bucket width to return; without ``resolution_s`` about ``_DEFAULT_POINTS`` buckets, on a level boundary."""
+    span = (end - start).total_seconds()
+    if span <= 0:
+        raise ValueError("end must be after start")
+    if resolution_s is None:
+        resolution_s = max(1, math.ceil(span / _DEFAULT_POINTS))
+        for width, _ in reversed(LEVELS):
+            if resolution_s >= width:
+                resolution_s = math.ceil(resolution_s / width) * width
+                break
+    elif resolution_s < 1:
+        raise ValueError("resolution must be at least 1 second")
+    if span / resolution_s > _MAX_POINTS:
+        raise ValueError(f"Range and resolution give more than {_MAX_POINTS} points per topic")
+    return resolution_s
+
+
+def rollup_plan(start: datetime, end: datetime, resolution_s: int) -> list[tuple[Table, datetime, datetime]]:
+    """Split [start, end) into ranges, each read from the coarsest level that covers it exactly.
+
+    Only levels whose width divides ``resolution_s`` are used. The aligned
+    middle comes from the coarsest of them and the unaligned edges from finer
+    ones, so no bucket reaches across ``start`` or ``end``. A 1 s bucket counts
+    when it starts in [start, end).
+    """
+    widths = [(width, table) for width, table in LEVELS if resolution_s % width == 0]
+    lo = math.ceil((start - _EPOCH).total_seconds())
+    hi = math.ceil((end - _EPOCH).total_seconds())
+
+    def cover(a: int, b: int, levels: list[tuple[int, Table]]) -> list[tuple[Table, datetime, datetime]]:
+        for i in range(len(levels) - 1, -1, -1):
+            width, table = levels[i]
+            first = -(-a // width) * width
+            last = b // width * width
+            if first < last:
+                return (
+                    cover(a, first, levels[:i])
+                    + [(table, _EPOCH + timedelta(seconds=first), _EPOCH + timedelta(seconds=last))]
+                    + cover(last, b, levels[:i])
+                )
+        return []
+
+    return cover(lo, hi, widths)
+
+
+def query_rollups(
+    conn: Connection,
+    field: str,
+    start: datetime,
+    end: datetime,
+    resolution_s: int | None = None,
+    topic: str | None = None,
+    topic_prefix: str | None = None,
+    session_id: str | None = None,
+) -> dict:
+    """Per-topic series of count/min/max/avg of ``field`` in [start, end), merged across sessions."""
+    resolution_s = resolve_resolution(start, end, resolution_s)
+    plan = rollup_plan(start, end, resolution_s)
+    parts = []
+    for table, lo, hi in plan:
+        t = table.c
+        q = select(
+            t.topic,
+            func.date_bin(timedelta(seconds=resolution_s), t.bucket, _EPOCH).label("bucket"),
+            t.count,
+            t.sum,
+            t.min,
+            t.max,
+        ).where(t.field == field, t.bucket >= lo, t.bucket < hi)
+        if topic is not None:
+            q = q.where(t.topic == topic)
+        if topic_prefix:
+            q = q.where(t.topic.startswith(topic_prefix, autoescape=True))
+        if session_id is not None:
+            q = q.where(t.session_id == uuid.UUID(session_id))
+        parts.append(q)
+
+    series: dict[str, list[dict]] = {}
+    if parts:
+        u = union_all(*parts).subquery() if len(parts) > 1 else parts[0].subquery()
+        q = (
+            select(
+                u.c.topic,
+                u.c.bucket,
+                func.sum(u.c.count).label("count"),
+                func.sum(u.c.sum).label("sum"),
+                func.min(u.c.min).label("min"),
+                func.max(u.c.max).label("max"),
+            )
+            .group_by(u.c.topic, u.c.bucket)
+            .order_by(u.c.topic, u.c.bucket)
+        )
+        for row in conn.execute(q):
+            series.setdefault(row.topic, []).append(
+                {
+                    "ts": row.bucket.isoformat(),
+                    "count": int(row.count),
+                    "min": row.min,
+                    "max": row.max,
+                    "avg": row.sum / int(row.count),
+                }
+            )
+    return {
+        "field": field,
+        "resolution_s": resolution_s,
+        "sources": sorted({table.name for table, _, _ in plan}),
+        "series": [{"topic": name, "points": points} for name, points in series.items()],
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Rebuild rollups from recorded messages.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    bf = sub.add_parser("backfill", help="rebuild the rollups of stopped sessions")
+    bf.add_argument("session_ids", nargs="*")
+    bf.add_argument("--all", action="store_true", help="every session that is not recording")
+    bf.add_argument("--chunk-size", type=int, default=5000)
+    args = ap.parse_args()
+
+    with SessionLocal() as db:
+        q = select(RecordingSession.id, RecordingSession.state)
+        if not args.all:
+            if not args.session_ids:
+                ap.error("give session ids or --all")
+            q = q.where(RecordingSession.id.in_([uuid.UUID(s) for s in args.session_ids]))
+        sessions = db.execute(q).all()
+    if not args.all and len(sessions) != len(args.session_ids):
+        found = {str(s.id) for s in sessions}
+        ap.error(f"unknown sessions: {', '.join(s for s in args.session_ids if s not in found)}")
+
+    for session_id, state in sessions:
+        if state == "RECORDING":
+            # The running recorder adds to the same buckets; a rebuild now would count messages twice.
+            print(f"{session_id}: skipped, still recording")
+            continue
+        print(f"{session_id}: {backfill(session_id, args.chunk_size)} values", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Topic-routed sink tables with typed columns extracted from the payload.
+
+Routes are read from ``SINK_ROUTES_FILE``, a JSON list such as::
+
+    [
+      {
+        "name": "plant_status",
+        "table": "sink_plant_status",
+        "topic_filters": ["plant/+/status/#"],
+        "columns": {
+          "temperature": {"path": "$.data.temp", "type": "float"},
+          "line": {"path": "$.line", "type": "text"}
+        }
+      }
+    ]
+
+Every route gets a table with ``id``, ``session_id``, ``ts``, ``topic`` and one
+nullable column per entry in ``columns``. Paths support ``$``, ``.key``,
+``['key']`` and ``[index]``; they are compiled once when the routes are loaded.
+Types: ``float``, ``int``, ``text``, ``bool``, ``json``.
+"""
+from __future__ import annotations
+
+import json
+import re
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Double, Index, Table, Text, delete
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+
+from .config import settings
+from .db import Base, engine
+from .payloads import dumps_json
+from .topics import validate_topic_filter
+
+_IDENT = re.compile(r"^[a-z_][a-z0-9_]*$")
+_RESERVED = {"id", "session_id", "ts", "topic"}
+_PATH_TOKEN = re.compile(r"\.([A-Za-z_][A-Za-z0-9_\-]*)|\[(\d+)\]|\['([^']*)'\]|\[\"([^\"]*)\"\]")
+
+
+def compile_path(path: str) -> Callable[[Any], Any]:
+    """Compile a JSONPath-like expression into a getter returning None when the path is missing."""
+    if not path.startswith("$"):
+        raise ValueError(f"Path must start with '$': {path!r}")
+    steps: list[str | int] = []
+    pos = 1
+    while pos < len(path):
+        m = _PATH_TOKEN.match(path, pos)
+        if not m:
+            raise ValueError(f"Unsupported path syntax at {path[pos:]!r} in {path!r}")
+        key, index, quoted, dquoted = m.groups()
+        steps.append(int(index) if index is not None else (key or quoted or dquoted or ""))
+        pos = m.end()
+    steps_t = tuple(steps)
+
+    def get(obj: Any) -> Any:
+        for step in steps_t:
+            if isinstance(step, int):
+                if not isinstance(obj, list) or step >= len(obj):
+                    return None
+            elif not isinstance(obj, dict):
+                return None
+            try:
+                obj = obj[step]
+            except (KeyError, IndexError):
+                return None
+        return obj
+
+    return get
+
+
+def to_float(v: Any) -> float | None:
+    """``v`` as a float if it is a number or a numeric string, else None (booleans included)."""
+    if isinstance(v, bool) or v is None:
+        return None
+    if isinstance(v, (int, float)):
+        return float(v)
+    if isinstance(v, str):
+        try:
+            return float(v)
+        except ValueError:
+            return None
+    return None
+
+
+def _to_int(v: Any) -> int | None:
+    if isinstance(v, bool) or v is None:
+        return None
+    if isinstance(v, int):
+        return v
+    if isinstance(v, float):
+        return int(v) if v.is_integer() else None
+    if isinstance(v, str):
+        try:
+            return int(v)
+        except ValueError:
+            return None
+    return None
+
+
+def _to_text(v: Any) -> str | None:
+    if v is None or isinstance(v, str):
+        return v
+    return dumps_json(v).decode("utf-8")
+
+
+def _to_bool(v: Any) -> bool | None:
+    if isinstance(v, bool) or v is None:
+        return v
+    if isinstance(v, (int, float)):
+        return bool(v)
+    if isinstance(v, str):
+        return {"true": True, "false": False, "1": True, "0": False}.get(v.strip().lower())
+    return None
+
+
+_TYPES: dict[str, tuple[Any, Callable[[Any], Any]]] = {
+    "float": (Double, to_float),
+    "int": (BigInteger, _to_int),
+    "text": (Text, _to_text),
+    "bool": (Boolean, _to_bool),
+    "json": (JSONB, lambda v: v),
+}
+
+
+@dataclass(frozen=True, eq=False)
+class SinkRoute:
+    name: str
+    table: Table
+    topic_filters: tuple[str, ...]
+    fields: tuple[tuple[str, Callable[[Any], Any], Callable[[Any], Any]], ...]
+
+    def extract(self, payload: Any) -> dict:
+        return {column: cast(get(payload)) for column, get, cast in self.fields}
+
+
+def _build_route(spec: dict) -> SinkRoute:
+    name = spec["name"]
+    table_name = spec.get("table", f"sink_{name}")
+    if not _IDENT.match(table_name):
+        raise ValueError(f"Invalid table name for route {name!r}: {table_name!r}")
+    filters = tuple(spec["topic_filters"])
+    if not filters:
+        raise ValueError(f"Route {name!r} needs at least one topic filter")
+    for f in filters:
+        validate_topic_filter(f)
+
+    columns = []
+    fields = []
+    for column, col_spec in spec["columns"].items():
+        if not _IDENT.match(column) or column in _RESERVED:
+            raise ValueError(f"Invalid column name for route {name!r}: {column!r}")
+        type_name = col_spec.get("type", "text")
+        if type_name not in _TYPES:
+            raise ValueError(f"Unknown column type {type_name!r} in route {name!r}")
+        sa_type, cast = _TYPES[type_name]
+        columns.append(Column(column, sa_type, nullable=True))
+        fields.append((column, compile_path(col_spec["path"]), cast))
+
+    table = Table(
+        table_name,
+        Base.metadata,
+        Column("id", BigInteger, primary_key=True, autoincrement=True),
+        Column("session_id", UUID(as_uuid=True), nullable=False),
+        Column("ts", DateTime(timezone=True), nullable=False),
+        Column("topic", Text, nullable=False),
+        *columns,
+        Index(f"ix_{table_name}_session_ts", "session_id", "ts"),
+    )
+    return SinkRoute(name=name, table=table, topic_filters=filters, fields=tuple(fields))
+
+
+def load_routes(path: str | None) -> list[SinkRoute]:
+    if not path:
+        return []
+    specs = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(specs, list):
+        raise ValueError("SINK_ROUTES_FILE must contain a JSON list of routes")
+    routes = [_build_route(spec) for spec in specs]
+    names = [r.name for r in routes]
+    if len(set(names)) != len(names):
+        raise ValueError("Route names must be unique")
+    return routes
+
+
+# Loaded at import so the route tables are part of Base.metadata before create_all runs.
+ROUTES: list[SinkRoute] = load_routes(settings.sink_routes_file)
+
+
+def delete_routed_rows(session_id: str | uuid.UUID) -> None:
+    if not ROUTES:
+        return
+    with engine.begin() as conn:
+        for route in ROUTES:
+            conn.execute(delete(route.table).where(route.table.c.session_id == session_id))
@@ -1,10 +1,18 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Any
+from .topics import validate_topic_filter
 
 class SessionCreate(BaseModel):
     node: str
     topic_filters: list[str] = Field(min_length=1)
 
+    @field_validator("topic_filters")
+    @classmethod
+    def _valid_filters(cls, v: list[str]) -> list[str]:
+        for f in v:
+            validate_topic_filter(f)
+        return v
+
 class SessionOut(BaseModel):
     id: str
     state: str
@@ -1,223 +1,955 @@
 from __future__ import annotations
 import asyncio
-import base64
-import json
 import logging
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
 from datetime import datetime, timezone
-from asyncio_mqtt import Client, MqttError
-from sqlalchemy import insert, select
+from pathlib import Path
+from typing import Callable, Iterator, Sequence
+from aiomqtt import Client, MqttError
+from sqlalchemy import Table, select
 from .config import settings
 from .db import SessionLocal
-from .models import RecordingSession, MqttMessage
+from .dedup import BLOB_KEY, REF_KEY, payload_cache, payload_hash, with_blobs
+from . import metrics
+from .archive import stream_archive
+from .ingest import SIZE_KEY, BatchWriter, CommitHook, RowWriter, commit_hooks, row_writer, write_counted
+from .journal import Journal
+from .models import BLOB_JOIN, PAYLOAD_JSON, PAYLOAD_RAW, MqttMessage, PayloadBlob
+from .payloads import decode_payload, encode_payload
+from .query import topic_filters_condition
+from .rollups import ROLLUP_KEY, RULES, RollupAggregator, extract_values, rule_trie
+from .routing import ROUTES, SinkRoute
+from .stats import SessionStats
+from .tail import TailBuffer
+from .topics import TopicMapper, TopicTrie, minimal_cover, validate_topic_filter
 
 logger = logging.getLogger(__name__)
 
-class RecorderService:
-    def __init__(self):
-        self._task: asyncio.Task | None = None
-        self._stop = asyncio.Event()
-        self._session_id: str | None = None
+_REPLAY_RATE_WINDOW_S = 10.0
+
+def _mqtt_client(client_id: str, max_inflight_messages: int | None = None) -> Client:
+    client = Client(
+        hostname=settings.mqtt_host,
+        port=settings.mqtt_port,
+        username=settings.mqtt_username or None,
+        password=settings.mqtt_password,
+        client_id=client_id,
+        tls_context=settings.mqtt_ssl_context(),
+        # paho allows 20 QoS>0 messages in flight by default; publishers raise it to their window.
+        max_inflight_messages=max_inflight_messages,
+        max_queued_messages=max_inflight_messages,
+    )
+    if max_inflight_messages is not None:
+        # Warn about calls piling up only beyond the window.
+        client.pending_calls_threshold = max_inflight_messages
+    return client
+
+
+class _Sink:
+    """A bounded queue drained into one table by a BatchWriter.
+
+    With a journal configured, messages arriving while the queue is above the
+    high-water mark, and batches that fail to commit, are appended to the
+    journal instead; it is replayed into the table in order once the queue has
+    drained, and new messages keep going to the journal until it is empty.
+    Without one, messages arriving while the queue is full are dropped and
+    counted, so a slow sink never holds up the receive loop shared by all
+    sessions.
+    """
+
+    def __init__(self, session_id: str, name: str, write: RowWriter, on_committed: CommitHook | None = None):
+        self.session_id = session_id
+        self.name = name
+        self._write = write
+        self._on_committed = on_committed
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=settings.recorder_queue_size)
+        self._writer: asyncio.Task | None = None
+        self._batch_writer: BatchWriter | None = None
+        self._journal: Journal | None = None
+        if settings.recorder_journal_dir:
+            self._journal = Journal(
+                Path(settings.recorder_journal_dir) / name / session_id, settings.recorder_journal_segment_bytes
+            )
+        self._journal_task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._spill: list[dict] = []
+        self._spilling = False
+        self._closing = False
+        self._high_water = max(1, int(settings.recorder_queue_size * settings.recorder_journal_high_water))
+        self._low_water = self._high_water // 2
+        self._replayed: deque[tuple[float, int]] = deque()
+        self.replayed_rows = 0
+        self.replayed_bytes = 0
+        self.dropped = 0
+        self._dropping = False
+
+    def start(self):
+        on_failed = self._spill_batch if self._journal is not None else None
+        self._batch_writer = BatchWriter(
+            self._write, name=self.name, on_failed=on_failed, on_committed=self._on_committed
+        )
+        self._writer = asyncio.create_task(self._batch_writer.run(self._queue))
+        self._writer.add_done_callback(self._on_writer_done)
+        if self._journal is not None:
+            # Frames left over from a crash are replayed before anything new is queued.
+            self._spilling = self._journal.pending_rows > 0
+            self._journal_task = asyncio.create_task(self._run_journal())
 
     def is_running(self) -> bool:
-        return self._task is not None and not self._task.done()
-    
-    def start(self, session_id: str):
+        return self._writer is not None and not self._writer.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def journal_pending_rows(self) -> int:
+        return self._journal.pending_rows if self._journal is not None else 0
+
+    @property
+    def persisted_rows(self) -> int:
+        written = self._batch_writer.persisted_rows if self._batch_writer else 0
+        return written + self.replayed_rows
+
+    @property
+    def persisted_bytes(self) -> int:
+        written = self._batch_writer.persisted_bytes if self._batch_writer else 0
+        return written + self.replayed_bytes
+
+    def put(self, item: dict) -> None:
+        # Never waits: the receive loop is shared by all sessions. A dead writer would never drain the queue.
+        if not self.is_running():
+            return
+        if self._journal is not None and (self._spilling or self._queue.qsize() >= self._high_water):
+            self._spill_item(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self._journal is not None:
+                self._spill_item(item)
+                return
+            self.dropped += 1
+            if not self._dropping:
+                self._dropping = True
+                logger.warning(
+                    "Recorder queue full, dropping messages",
+                    extra={"session_id": self.session_id, "sink": self.name, "queued": self._queue.qsize()},
+                )
+            return
+        if self._dropping:
+            self._dropping = False
+            logger.info(
+                "Recorder queue accepting messages again",
+                extra={"session_id": self.session_id, "sink": self.name, "dropped": self.dropped},
+            )
+
+    def _spill_item(self, item: dict) -> None:
+        if not self._spilling:
+            self._spilling = True
+            logger.warning(
+                "Recorder queue above high-water mark, spilling to journal",
+                extra={"session_id": self.session_id, "sink": self.name, "queued": self._queue.qsize()},
+            )
+        self._spill.append(item)
+        self._wakeup.set()
+
+    def _spill_batch(self, batch: list[dict]) -> None:
+        self._spilling = True
+        self._spill.extend(batch)
+        self._wakeup.set()
+
+    async def _run_journal(self):
+        journal = self._journal
+        backoff = 0.5
+        while True:
+            if self._spill:
+                rows, self._spill = self._spill, []
+                # One fsync per round: everything spilled while the previous round ran shares it.
+                await asyncio.to_thread(journal.append, rows, settings.recorder_batch_size)
+            if journal.pending_rows and (self._closing or self._queue.qsize() <= self._low_water):
+                if await self._replay_frame():
+                    backoff = 0.5
+                    continue
+                if self._closing and not self.is_running():
+                    logger.warning(
+                        "Journal kept on disk, it is replayed on the next start",
+                        extra={"session_id": self.session_id, "sink": self.name, **journal.stats()},
+                    )
+                    return
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+                continue
+            if not journal.pending_rows and not self._spill:
+                if self._spilling:
+                    self._spilling = False
+                    logger.info("Journal drained", extra={"session_id": self.session_id, "sink": self.name})
+                if self._closing and not self.is_running():
+                    return
+            self._wakeup.clear()
+            try:
+                # While frames wait for the queue to drain, poll instead of waiting for the next message.
+                await asyncio.wait_for(self._wakeup.wait(), 0.05 if journal.pending_rows else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _replay_frame(self) -> bool:
+        try:
+            rows = await asyncio.to_thread(self._journal.read_head)
+            size = 0
+            if rows:
+                started = time.perf_counter()
+                size = await asyncio.to_thread(write_counted, self._write, rows, self._on_committed)
+                logger.info(
+                    "Replayed journal frame",
+                    extra={
+                        "rows": len(rows),
+                        "sink": self.name,
+                        "commit_ms": round((time.perf_counter() - started) * 1000, 2),
+                    },
+                )
+            await asyncio.to_thread(self._journal.ack)
+        except ValueError:
+            logger.exception("Skipping corrupt journal frame", extra={"session_id": self.session_id, "sink": self.name})
+            await asyncio.to_thread(self._journal.ack)
+            return True
+        except Exception:
+            logger.exception("Journal replay failed", extra={"session_id": self.session_id, "sink": self.name})
+            return False
+        now = time.monotonic()
+        self.replayed_rows += len(rows or ())
+        self.replayed_bytes += size
+        self._replayed.append((now, len(rows or ())))
+        return True
+
+    def stats(self) -> dict:
+        stats = {"queued": self._queue.qsize(), "spilling": self._spilling, "dropped": self.dropped}
+        if self._journal is not None:
+            cutoff = time.monotonic() - _REPLAY_RATE_WINDOW_S
+            while self._replayed and self._replayed[0][0] < cutoff:
+                self._replayed.popleft()
+            stats["journal"] = {
+                **self._journal.stats(),
+                "spill_buffered": len(self._spill),
+                "replayed_rows": self.replayed_rows,
+                "replay_rows_per_s": round(sum(n for _, n in self._replayed) / _REPLAY_RATE_WINDOW_S, 1),
+            }
+        return stats
+
+    async def stop(self):
         if self.is_running():
-            raise RuntimeError("Recorder already running")
-        self._stop.clear()
-        self._session_id = session_id
-        loop = asyncio.get_running_loop()
-        self._task = loop.create_task(self._run(session_id))
+            await self._queue.put({"_flush": True})
+        if self._writer:
+            try:
+                await self._writer
+            except Exception:
+                logger.exception("Recorder writer failed", extra={"session_id": self.session_id, "sink": self.name})
+        if self._journal_task:
+            # Flush whatever was spilled and replay it; if the DB is still down the journal stays on disk.
+            self._closing = True
+            self._wakeup.set()
+            await self._journal_task
+            self._journal.close()
+
+    def _on_writer_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Recorder writer stopped after a DB error, dropping further messages",
+                extra={"session_id": self.session_id, "sink": self.name},
+            )
+
+
+class RecorderService:
+    """Write pipeline of one recording session: mqtt_message plus one sink per matched route."""
+
+    def __init__(
+        self,
+        session_id: str,
+        topic_filters: list[str],
+        writer_factory: Callable[[Table], RowWriter] = row_writer,
+    ):
+        self.session_id = session_id
+        self.session_uuid = uuid.UUID(session_id)
+        self.topic_filters = list(topic_filters)
+        self._writer_factory = writer_factory
+        self.topic_stats = SessionStats(self.session_uuid) if settings.recorder_topic_stats else None
+        write = writer_factory(MqttMessage.__table__)
+        if settings.payload_dedup:
+            write = with_blobs(write)
+        self.rollups = RollupAggregator(self.session_uuid) if RULES else None
+        on_committed = commit_hooks(
+            self.topic_stats.committed if self.topic_stats is not None else None,
+            self.rollups.committed if self.rollups is not None else None,
+        )
+        self._messages = _Sink(session_id, MqttMessage.__tablename__, write, on_committed)
+        self._routed: dict[str, _Sink] = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.deduplicated = 0  # messages stored as a reference to an already stored payload
+        self.tail: TailBuffer | None = None  # only while someone watches, see app/tail.py
+
+    def open_tail(self) -> TailBuffer:
+        if self.tail is None:
+            self.tail = TailBuffer(settings.tail_buffer_size)
+        self.tail.viewers += 1
+        return self.tail
 
+    def close_tail(self) -> None:
+        self.tail.viewers -= 1
+        if not self.tail.viewers:
+            self.tail = None
 
-    # def start(self, session_id: str):
-    #     if self.is_running():
-    #         raise RuntimeError("Recorder already running")
-    #     self._stop.clear()
-    #     self._session_id = session_id
-    #     self._task = asyncio.create_task(self._run(session_id))
+    def start(self):
+        self._messages.start()
+
+    def is_running(self) -> bool:
+        return self._messages.is_running()
+
+    def put(self, item: dict) -> None:
+        self._messages.put(item)
+
+    def put_routed(self, route: SinkRoute, item: dict) -> None:
+        sink = self._routed.get(route.name)
+        if sink is None:
+            # Route writers are created on first use; most sessions only ever match a few routes.
+            sink = self._routed[route.name] = _Sink(self.session_id, route.table.name, self._writer_factory(route.table))
+            sink.start()
+        sink.put(item)
+
+    def sinks(self) -> list[_Sink]:
+        return [self._messages, *self._routed.values()]
+
+    def stats(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "received": self.received,
+            "deduplicated": self.deduplicated,
+            "tail_viewers": self.tail.viewers if self.tail is not None else 0,
+            "sinks": {sink.name: sink.stats() for sink in (self._messages, *self._routed.values())},
+        }
 
     async def stop(self):
-        self._stop.set()
+        await self._messages.stop()
+        for sink in self._routed.values():
+            await sink.stop()
+        if self.topic_stats is not None:
+            await asyncio.to_thread(self.topic_stats.flush)
+        if self.rollups is not None:
+            await asyncio.to_thread(self.rollups.flush)
+        logger.info("Recorder stopped", extra={"session_id": self.session_id})
+
+
+class RecorderManager:
+    """Records any number of sessions over one shared MQTT connection.
+
+    The connection subscribes to the union of all sessions' topic filters and a
+    TopicTrie routes each received message to the sessions whose filters match.
+    ``writer_factory`` returns the batch write function for a table; benchmarks
+    pass one that does not touch the database.
+
+    Sessions started with a ``share_group`` get a connection of their own that
+    subscribes to ``$share/<group>/<filter>``, so the broker splits their
+    messages between all clients in the group. It must be separate: a client
+    cannot tell which of its subscriptions a message was delivered for.
+    """
+
+    def __init__(
+        self,
+        writer_factory: Callable[[Table], RowWriter] = row_writer,
+        client_id: str | None = None,
+        share_group: str | None = None,
+    ):
+        self._writer_factory = writer_factory
+        self.client_id = client_id or settings.mqtt_client_id
+        self.share_group = share_group
+        self._groups: dict[str, RecorderManager] = {}
+        self._sessions: dict[str, RecorderService] = {}
+        self._trie: TopicTrie[RecorderService] = TopicTrie()
+        self._routes: TopicTrie[SinkRoute] = TopicTrie()
+        for route in ROUTES:
+            self._routes.add_many(route.topic_filters, route)
+        self._rollup_rules = rule_trie()
+        self._lock = asyncio.Lock()
+        self._client: Client | None = None
+        self._subscribed: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    def is_recording(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def sessions(self) -> list[str]:
+        return [rec.session_id for rec in self.recorders()]
+
+    def get(self, session_id: str) -> RecorderService | None:
+        rec = self._sessions.get(session_id)
+        if rec is None:
+            for group in self._groups.values():
+                if (rec := group.get(session_id)) is not None:
+                    break
+        return rec
+
+    def recorders(self) -> list[RecorderService]:
+        recs = list(self._sessions.values())
+        for group in self._groups.values():
+            recs.extend(group.recorders())
+        return recs
+
+    def stats(self) -> list[dict]:
+        return [rec.stats() for rec in self.recorders()]
+
+    async def start(self, session_id: str, topic_filters: list[str], share_group: str | None = None):
+        if not isinstance(topic_filters, list) or not topic_filters:
+            raise ValueError("topic_filters must be a non-empty JSON list")
+        for f in topic_filters:
+            validate_topic_filter(f)
+        if share_group is not None and share_group != self.share_group:
+            if any(c in share_group for c in "/+#") or not share_group:
+                raise ValueError(f"Invalid share group name: {share_group!r}")
+            if self.is_recording(session_id):
+                raise RuntimeError("Session already recording")
+            group = self._groups.get(share_group)
+            if group is None:
+                group = self._groups[share_group] = RecorderManager(
+                    self._writer_factory, f"{self.client_id}-{share_group}", share_group
+                )
+            await group.start(session_id, topic_filters, share_group)
+            return
+
+        async with self._lock:
+            if self.is_recording(session_id):
+                raise RuntimeError("Session already recording")
+            logger.info("Recorder starting", extra={"session_id": session_id})
+            rec = RecorderService(session_id, topic_filters, self._writer_factory)
+            if rec.topic_stats is not None:
+                await asyncio.to_thread(rec.topic_stats.load)
+            rec.start()
+            self._sessions[session_id] = rec
+            self._trie.add_many(rec.topic_filters, rec)
+
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self._run())
+            else:
+                await self._sync_subscriptions()
+
+    async def stop(self, session_id: str):
+        for name, group in list(self._groups.items()):
+            if group.is_recording(session_id):
+                await group.stop(session_id)
+                if not group.recorders():
+                    self._groups.pop(name, None)
+                return
+        async with self._lock:
+            rec = self._sessions.pop(session_id, None)
+            if rec is None:
+                return
+            # Stop routing to this session first; the other sessions keep receiving.
+            self._trie.remove_many(rec.topic_filters, rec)
+            if self._sessions:
+                await self._sync_subscriptions()
+            else:
+                await self._disconnect()
+        await rec.stop()
+
+    async def stop_all(self):
+        for session_id in self.sessions():
+            await self.stop(session_id)
+
+    async def _disconnect(self):
         if self._task:
             self._task.cancel()
             try:
                 await self._task
             except asyncio.CancelledError:
-                logger.info("Recorder task cancelled", extra={"session_id": self._session_id})
+                logger.info("Recorder connection closed")
             except Exception:
-                logger.exception("Recorder task failed while stopping", extra={"session_id": self._session_id})
+                logger.exception("Recorder connection failed while stopping")
         self._task = None
-        self._session_id = None
-
-    async def _run(self, session_id: str):
-        logger.info("Recorder starting", extra={"session_id": session_id})
-        # load topic filters from DB
-        with SessionLocal() as db:
-            sess = db.get(RecordingSession, session_id)
-            if not sess:
-                raise RuntimeError("Session not found")
-            topic_filters = sess.topic_filters
-            if not isinstance(topic_filters, list) or not topic_filters:
-                raise RuntimeError("topic_filters must be a non-empty JSON list")
-
-        queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=5000)
-        writer = asyncio.create_task(self._db_writer(queue))
 
-        try:
-            ssl_ctx = settings.mqtt_ssl_context()
-            async with Client(
-                hostname=settings.mqtt_host,
-                port=settings.mqtt_port,
-                username=settings.mqtt_username or None,
-                password=settings.mqtt_password,
-                client_id=settings.mqtt_client_id,
-                tls_context=ssl_ctx,
-            ) as client:
-                logger.info(
-                    "Connected to MQTT broker",
-                    extra={"session_id": session_id, "mqtt_host": settings.mqtt_host, "mqtt_port": settings.mqtt_port},
-                )
+    async def _sync_subscriptions(self):
+        client = self._client
+        if client is None:
+            return  # (re)connect subscribes to the full set
+        # Partially overlapping filters (e.g. a/+/c and a/b/+) can still yield duplicates on brokers
+        # that deliver once per matching subscription; MQTT 3.1.1 gives no way to tell them apart.
+        wanted = minimal_cover(self._trie.filters())
+        if self.share_group is not None:
+            wanted = {f"$share/{self.share_group}/{t}" for t in wanted}
+        for t in sorted(wanted - self._subscribed):
+            await client.subscribe(t)
+            self._subscribed.add(t)
+            logger.info("Subscribed topic filter", extra={"topic_filter": t})
+        for t in sorted(self._subscribed - wanted):
+            await client.unsubscribe(t)
+            self._subscribed.discard(t)
+            logger.info("Unsubscribed topic filter", extra={"topic_filter": t})
 
-                async with client.messages() as messages:
-                    for t in topic_filters:
-                        await client.subscribe(t)
-                        logger.info("Subscribed topic filter", extra={"session_id": session_id, "topic_filter": t})
-
-                    async for msg in messages:
-                        if self._stop.is_set():
-                            break
-
-                        raw_payload = bytes(msg.payload)
-
-                        # Enforce JSON storage. For binary/non-JSON payloads (including NUL bytes),
-                        # store as base64 to avoid Postgres JSONB text constraints.
-                        try:
-                            text_payload = raw_payload.decode("utf-8")
-                            if "\x00" in text_payload:
-                                raise ValueError("NUL byte in UTF-8 payload")
-                            payload_obj = json.loads(text_payload)
-                            if not isinstance(payload_obj, (dict, list, str, int, float, bool, type(None))):
-                                payload_obj = {
-                                    "_raw_b64": base64.b64encode(raw_payload).decode("ascii"),
-                                    "_encoding": "base64",
-                                }
-                        except Exception:
-                            payload_obj = {
-                                "_raw_b64": base64.b64encode(raw_payload).decode("ascii"),
-                                "_encoding": "base64",
-                            }
-
-                        item = {
-                            "session_id": session_id,
-                            "ts": datetime.now(timezone.utc),
-                            "topic": str(msg.topic),
-                            "payload_json": payload_obj if isinstance(payload_obj, dict) else {"value": payload_obj},
-                            "qos": int(msg.qos),
-                            "retained": bool(getattr(msg, "retain", False)),
-                        }
-                        await queue.put(item)
-
-        except MqttError as e:
-            logger.exception("MQTT error in recorder", extra={"session_id": session_id, "error": str(e)})
-            raise
-        except asyncio.CancelledError:
-            logger.info("Recorder receive loop cancelled", extra={"session_id": session_id})
-            raise
-        except Exception:
-            logger.exception("Unexpected recorder failure", extra={"session_id": session_id})
-            raise
-        finally:
-            await queue.put({"_flush": True})
-            await writer
-            logger.info("Recorder stopped", extra={"session_id": session_id})
-
-    async def _db_writer(self, queue: asyncio.Queue[dict]):
-        batch: list[dict] = []
-        BATCH_SIZE = 500
-        FLUSH_INTERVAL = 0.2
-        loop = asyncio.get_event_loop()
-        last_flush = loop.time()
-
-        async def flush():
-            nonlocal batch
-            if not batch:
-                return
+    async def _run(self):
+        backoff = 1.0
+        while self._sessions:
             try:
-                with SessionLocal() as db:
-                    db.execute(insert(MqttMessage), batch)
-                    db.commit()
-                logger.info("Persisted MQTT batch", extra={"rows": len(batch)})
+                async with _mqtt_client(self.client_id) as client:
+                    logger.info(
+                        "Connected to MQTT broker",
+                        extra={
+                            "mqtt_host": settings.mqtt_host,
+                            "mqtt_port": settings.mqtt_port,
+                            "client_id": self.client_id,
+                        },
+                    )
+                    async with client.messages() as messages:
+                        async with self._lock:
+                            self._client = client
+                            await self._sync_subscriptions()
+                        backoff = 1.0
+                        await self._dispatch(messages)
+            except MqttError as e:
+                logger.exception("MQTT error in recorder, reconnecting", extra={"error": str(e), "retry_in_s": backoff})
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            except asyncio.CancelledError:
+                logger.info("Recorder receive loop cancelled")
+                raise
             except Exception:
-                logger.exception("Failed to persist MQTT batch", extra={"rows": len(batch)})
+                logger.exception("Unexpected recorder failure")
                 raise
-            batch = []
+            finally:
+                self._client = None
+                self._subscribed.clear()
 
-        while True:
-            item = await queue.get()
-            if item.get("_flush"):
-                await flush()
-                return
-            batch.append(item)
-            now = loop.time()
-            if len(batch) >= BATCH_SIZE or (now - last_flush) >= FLUSH_INTERVAL:
-                await flush()
-                last_flush = now
+    async def _dispatch(self, messages):
+        match = self._trie.match
+        match_routes = self._routes.match if len(self._routes) else None
+        match_rules = self._rollup_rules.match if len(self._rollup_rules) else None
+        store_json = settings.payload_storage != "raw"
+        store_raw = settings.payload_storage != "json"
+        dedup = payload_cache if settings.payload_dedup else None
+        async for msg in messages:
+            topic = str(msg.topic)
+            targets = match(topic)
+            if not targets:
+                continue
 
+            raw = bytes(msg.payload)
+            size = len(raw)
+            ts = datetime.now(timezone.utc)
+            row = {
+                "ts": ts,
+                "topic": topic,
+                "qos": int(msg.qos),
+                "retained": bool(getattr(msg, "retain", False)),
+                SIZE_KEY: size,
+            }
+            payload = None
+            deduplicated = False
+            if dedup is not None:
+                # A recently seen payload is stored as a reference only and not parsed at all.
+                h = row["payload_hash"] = payload_hash(raw)
+                deduplicated = dedup.seen(h)
+                if deduplicated:
+                    row[REF_KEY] = raw
+                else:
+                    if store_json:
+                        payload = decode_payload(raw)
+                    row[BLOB_KEY] = (h, payload, raw if store_raw else None)
+            else:
+                if store_json:
+                    payload = row["payload_json"] = decode_payload(raw)
+                if store_raw:
+                    row["payload_raw"] = raw
 
-class PlaybackService:
-    def __init__(self):
-        self._task: asyncio.Task | None = None
+            # Parse at most once and extract once per route and rollup rule; the result is shared by all sessions.
+            routed = ()
+            routes = match_routes(topic) if match_routes else None
+            if routes:
+                if payload is None:
+                    payload = decode_payload(raw)
+                routed = [(route, {**route.extract(payload), "ts": ts, "topic": topic}) for route in routes]
+            rules = match_rules(topic) if match_rules else None
+            if rules:
+                if payload is None:
+                    payload = decode_payload(raw)
+                rolled = extract_values(rules, payload)
+                if rolled:
+                    row[ROLLUP_KEY] = rolled
+
+            for rec in targets:
+                rec.received += 1
+                rec.received_bytes += size
+                if deduplicated:
+                    rec.deduplicated += 1
+                if rec.tail is not None:
+                    rec.tail.append((ts, topic, raw, row["qos"], row["retained"]))
+                rec.put({**row, "session_id": rec.session_uuid})
+                for route, values in routed:
+                    rec.put_routed(route, {**values, "session_id": rec.session_uuid})
+
+
+def _stream_rows(
+    session_id: str,
+    chunk_size: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    topic_filters: list[str] | None = None,
+) -> Iterator[Sequence]:
+    # yield_per makes psycopg use a server-side cursor, so only one chunk is held client-side.
+    # The time window is a range on ix_msg_session_ts, which also delivers the rows in order.
+    q = (
+        select(MqttMessage.ts, MqttMessage.topic, PAYLOAD_RAW, PAYLOAD_JSON, MqttMessage.qos)
+        .outerjoin(PayloadBlob, BLOB_JOIN)
+        .where(MqttMessage.session_id == session_id)
+        .order_by(MqttMessage.ts.asc(), MqttMessage.id.asc())
+        .execution_options(yield_per=chunk_size)
+    )
+    if start is not None:
+        q = q.where(MqttMessage.ts >= start)
+    if end is not None:
+        q = q.where(MqttMessage.ts < end)
+    if topic_filters:
+        q = q.where(topic_filters_condition(topic_filters))
+    with SessionLocal() as db:
+        yield from db.execute(q).partitions()
+
+
+class _PublishWindow:
+    """Keeps up to ``size`` publishes outstanding instead of awaiting each broker ack in turn.
+
+    The client should allow as many messages in flight, see ``_mqtt_client``.
+    """
+
+    def __init__(self, client: Client, size: int):
+        self._client = client
+        self._slots = asyncio.Semaphore(size)
+        self._pending: set[asyncio.Task] = set()
+        self._error: BaseException | None = None
+
+    async def publish(self, topic: str, payload: bytes, qos: int):
+        if self._error is not None:
+            raise self._error
+        await self._slots.acquire()
+        task = asyncio.create_task(self._client.publish(topic, payload=payload, qos=qos))
+        self._pending.add(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: asyncio.Task):
+        self._pending.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+
+    async def drain(self):
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._error is not None:
+            raise self._error
+
+    async def close(self):
+        for task in list(self._pending):
+            task.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float | None = None):
+        self._rate = rate
+        # A small burst lets high rates sleep in ~10 ms steps instead of once per message.
+        self._capacity = burst if burst is not None else max(1.0, rate * 0.01)
+        self._tokens = self._capacity
+        self._last = asyncio.get_running_loop().time()
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class _Playback:
+    """One replay of a session: its own reader thread, MQTT connections and status.
+
+    Messages are spread over ``connections`` publisher connections by output
+    topic, so the order within each topic is kept. With ``loop`` the rows are read
+    again from the start of the window after the last one, until stopped.
+    """
+
+    def __init__(
+        self,
+        playback_id: str,
+        session_id: str,
+        open_rows: Callable[[], Iterator[Sequence]],
+        status: dict,
+        speed: float,
+        topic_prefix: str | None,
+        topics: TopicMapper | None,
+        mode: str,
+        rate: float | None,
+        window_size: int,
+        connections: int,
+        loop: bool,
+    ):
+        self.playback_id = playback_id
+        self.session_id = session_id
+        self._open_rows = open_rows
+        self._status = status
+        self._speed = speed if speed > 0 else 1.0
+        self._topic_prefix = topic_prefix
+        self._topics = topics
+        self._mode = mode
+        self._rate = rate
+        self._window_size = window_size
+        self._connections = connections
+        self._loop = loop
         self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
 
     def is_running(self) -> bool:
-        return self._task is not None and not self._task.done()
+        return not self._task.done()
 
-    def start(self, session_id: str, speed: float = 1.0, topic_prefix: str | None = "replay/"):
-        if self.is_running():
-            raise RuntimeError("Playback already running")
-        self._stop.clear()
-        self._task = asyncio.create_task(self._run(session_id, speed, topic_prefix))
+    def status(self) -> dict:
+        return dict(self._status, running=self.is_running())
 
     async def stop(self):
         self._stop.set()
-        if self._task:
+        # Cancel rather than wait: the task may be sleeping until a far-away timestamp.
+        self._task.cancel()
+        try:
             await self._task
-        self._task = None
+        except asyncio.CancelledError:
+            logger.info("Playback cancelled", extra=self._status)
+        except Exception:
+            logger.exception("Playback failed while stopping", extra=self._status)
+
+    async def _read_ahead(self, chunks: asyncio.Queue):
+        # None marks the end of a pass; a pass without rows ends the playback even when looping.
+        loop = asyncio.get_running_loop()
+        # One dedicated thread: the DB cursor (or archive mapping) must not be used concurrently.
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="playback-reader") as pool:
+            try:
+                while True:
+                    rows = await loop.run_in_executor(pool, self._open_rows)
+                    empty = True
+                    try:
+                        while True:
+                            chunk = await loop.run_in_executor(pool, next, rows, None)
+                            await chunks.put(chunk)
+                            if chunk is None:
+                                break
+                            empty = False
+                    finally:
+                        await loop.run_in_executor(pool, rows.close)
+                    if empty or not self._loop:
+                        return
+            except BaseException as e:
+                if not isinstance(e, asyncio.CancelledError):
+                    await chunks.put(e)
+                raise
 
-    async def _run(self, session_id: str, speed: float, topic_prefix: str | None):
-        if speed <= 0:
-            speed = 1.0
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        status = self._status
+        timed = self._mode == "timed"
+        speed = self._speed
+        prefix = self._topic_prefix
+        topics = self._topics
+        record_lag = metrics.playback_lag_seconds.record
+        lag_attrs = {"session_id": self.session_id}
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=max(1, settings.playback_readahead_chunks))
+        reader = asyncio.create_task(self._read_ahead(chunks))
 
-        with SessionLocal() as db:
-            rows = db.execute(
-                select(MqttMessage.ts, MqttMessage.topic, MqttMessage.payload_json)
-                .where(MqttMessage.session_id == session_id)
-                .order_by(MqttMessage.ts.asc())
-            ).all()
+        async def next_chunk():
+            chunk = await chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            return chunk
 
-        if not rows:
-            return
+        try:
+            chunk = await next_chunk()
+            if not chunk:
+                return
 
-        ssl_ctx = settings.mqtt_ssl_context()
-        async with Client(
-            hostname=settings.mqtt_host,
-            port=settings.mqtt_port,
-            username=settings.mqtt_username or None,
-            password=settings.mqtt_password,
-            client_id=f"{settings.mqtt_client_id}-player",
-            tls_context=ssl_ctx,
-        ) as client:
-            prev_ts = None
-            for ts, topic, payload in rows:
-                if self._stop.is_set():
-                    return
+            async with AsyncExitStack() as stack:
+                windows = []
+                for i in range(self._connections):
+                    client = await stack.enter_async_context(
+                        _mqtt_client(f"{settings.mqtt_client_id}-player-{self.playback_id}-{i}", self._window_size)
+                    )
+                    window = _PublishWindow(client, self._window_size)
+                    stack.push_async_callback(window.close)
+                    windows.append(window)
+                n_windows = len(windows)
+                bucket = _TokenBucket(self._rate) if self._mode == "rate" else None
+                started = loop.time()
+                while chunk:
+                    # In timed mode every message is scheduled against one absolute clock, so publish
+                    # and sleep overheads do not accumulate. Messages already due go out back-to-back.
+                    # Each pass of a loop starts a new clock.
+                    t0 = chunk[0][0]
+                    pass_started = loop.time()
+                    while chunk:
+                        for ts, topic, raw, payload, qos in chunk:
+                            if self._stop.is_set():
+                                return
+
+                            if topics is not None:
+                                out_topic = topics.map(topic)
+                                if out_topic is None:
+                                    status["skipped"] += 1
+                                    continue
+                            else:
+                                out_topic = topic
+
+                            if timed:
+                                delay = pass_started + (ts - t0).total_seconds() / speed - loop.time()
+                                if delay > 0:
+                                    await asyncio.sleep(delay)
+                                    status["lag_s"] = 0.0
+                                    record_lag(0.0, lag_attrs)
+                                else:
+                                    status["lag_s"] = -delay
+                                    if -delay > status["max_lag_s"]:
+                                        status["max_lag_s"] = -delay
+                                    record_lag(-delay, lag_attrs)
+                            elif bucket is not None:
+                                await bucket.acquire()
+
+                            # Ordering is per connection, so each output topic sticks to one of them.
+                            window = windows[hash(out_topic) % n_windows] if n_windows > 1 else windows[0]
+                            if prefix:
+                                out_topic = f"{prefix}{out_topic}"
+                            await window.publish(out_topic, encode_payload(raw, payload), qos)
+                            status["published"] += 1
+
+                        chunk = await next_chunk()
+                    # End of a pass: with loop the next one follows, unless it was empty.
+                    if self._loop:
+                        chunk = await next_chunk()
+                        if chunk:
+                            status["passes"] += 1
+
+                for window in windows:
+                    await window.drain()
+                duration = loop.time() - started
+                status["duration_s"] = round(duration, 3)
+                status["msgs_per_s"] = round(status["published"] / duration, 1) if duration > 0 else None
+                logger.info("Playback finished", extra=status)
+        finally:
+            reader.cancel()
+            try:
+                await reader
+            except BaseException:
+                pass
+
+
+class PlaybackService:
+    """Concurrent playbacks, each with independent MQTT connections.
+
+    Finished playbacks keep their status until ``PLAYBACK_MAX_CONCURRENT``
+    newer ones have finished.
+    """
+
+    def __init__(self):
+        self._playbacks: dict[str, _Playback] = {}
+
+    def is_running(self) -> bool:
+        return any(p.is_running() for p in self._playbacks.values())
+
+    def get(self, playback_id: str) -> _Playback | None:
+        return self._playbacks.get(playback_id)
+
+    def status(self) -> list[dict]:
+        return [p.status() for p in self._playbacks.values()]
+
+    def start(
+        self,
+        session_id: str,
+        speed: float = 1.0,
+        topic_prefix: str | None = "replay/",
+        mode: str = "timed",
+        rate: float | None = None,
+        window: int | None = None,
+        archive: str | Path | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        topics: list[str] | None = None,
+        connections: int = 1,
+        loop: bool = False,
+    ) -> str:
+        """Start replaying a session and return the playback id.
+
+        Modes: ``timed`` follows the recorded timestamps scaled by ``speed``,
+        ``max`` ignores timestamps and publishes as fast as the publish window
+        allows, ``rate`` caps output at ``rate`` msgs/s. With ``archive`` the
+        messages are read from that archive file instead of the database.
+        Only messages in [``start``, ``end``) are replayed; ``topics`` are
+        ``TopicMapper`` rules applied before ``topic_prefix``. ``window`` is
+        per connection.
+        """
+        if mode not in ("timed", "max", "rate"):
+            raise ValueError("mode must be one of: timed, max, rate")
+        if mode == "rate" and (rate is None or rate <= 0):
+            raise ValueError("rate mode requires rate > 0")
+        if window is not None and window < 1:
+            raise ValueError("window must be >= 1")
+        if not 1 <= connections <= settings.playback_max_connections:
+            raise ValueError(f"connections must be between 1 and {settings.playback_max_connections}")
+        if start is not None and end is not None and end <= start:
+            raise ValueError("end must be after start")
+        mapper = TopicMapper(topics) if topics else None
+        if archive is not None and not Path(archive).is_file():
+            raise FileNotFoundError(f"Archive not found: {archive}")
+        running = [p for p in self._playbacks.values() if p.is_running()]
+        if len(running) >= settings.playback_max_concurrent:
+            raise RuntimeError(f"{len(running)} playbacks already running (PLAYBACK_MAX_CONCURRENT)")
+
+        if archive is not None:
+            open_rows = lambda: stream_archive(archive, start, end)  # noqa: E731
+        else:
+            keep = mapper.keep_filters() if mapper is not None else None
+            open_rows = lambda: _stream_rows(session_id, settings.playback_chunk_size, start, end, keep)  # noqa: E731
+
+        playback_id = uuid.uuid4().hex[:12]
+        status = {
+            "playback_id": playback_id,
+            "session_id": session_id,
+            "source": "archive" if archive is not None else "db",
+            "mode": mode,
+            "speed": speed,
+            "rate": rate,
+            "start": start.isoformat() if start is not None else None,
+            "end": end.isoformat() if end is not None else None,
+            "loop": loop,
+            "connections": connections,
+            "passes": 1,
+            "published": 0,
+            "skipped": 0,
+            "lag_s": 0.0,
+            "max_lag_s": 0.0,
+        }
+        self._prune()
+        self._playbacks[playback_id] = _Playback(
+            playback_id, session_id, open_rows, status, speed, topic_prefix, mapper, mode, rate,
+            window or settings.playback_publish_window, connections, loop,
+        )
+        return playback_id
 
-                if prev_ts is not None:
-                    delta = (ts - prev_ts).total_seconds() / speed
-                    if delta > 0:
-                        await asyncio.sleep(delta)
+    async def stop(self, playback_id: str | None = None, session_id: str | None = None) -> int:
+        """Stop one playback, those of a session, or all of them; returns how many were running."""
+        targets = [
+            p for p in self._playbacks.values()
+            if (playback_id is None or p.playback_id == playback_id)
+            and (session_id is None or p.session_id == session_id)
+        ]
+        stopped = sum(p.is_running() for p in targets)
+        await asyncio.gather(*(p.stop() for p in targets))
+        return stopped
 
-                out_topic = f"{topic_prefix}{topic}" if topic_prefix else topic
-                await client.publish(out_topic, payload=json.dumps(payload).encode("utf-8"))
-                prev_ts = ts
+    def _prune(self):
+        finished = [pid for pid, p in self._playbacks.items() if not p.is_running()]
+        for pid in finished[: max(0, len(finished) - settings.playback_max_concurrent + 1)]:
+            del self._playbacks[pid]
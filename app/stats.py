@@ -0,0 +1,202 @@
+"""Per-topic aggregates of a recording session, kept in memory and upserted to session_topic_stats.
+
+The recorder hands every committed batch to ``committed()``, which counts its
+rows and upserts the topics that changed, so ``GET /sessions/{id}/stats``
+never has to scan mqtt_message and rows that are spilled, dropped or replayed
+from the journal are counted exactly once, when they are stored. Upserts add what changed since the previous
+flush, so several cluster nodes can record shares of one session.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import Connection, delete, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+
+from .db import engine
+from .models import SessionTopicStats
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the message-interval histogram; the last bucket counts everything above.
+INTERVAL_BOUNDS_S = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0)
+_RATE_WINDOW_S = 10.0
+
+
+class _TopicStats:
+    __slots__ = ("count", "bytes", "first_ts", "last_ts", "intervals")
+
+    def __init__(self, first_ts: datetime):
+        self.count = 0
+        self.bytes = 0
+        self.first_ts = first_ts
+        self.last_ts = first_ts
+        self.intervals = [0] * (len(INTERVAL_BOUNDS_S) + 1)
+
+
+def _histogram(intervals: list[int]) -> dict[str, int]:
+    return {**{f"{b:g}": n for b, n in zip(INTERVAL_BOUNDS_S, intervals)}, "+Inf": intervals[-1]}
+
+
+def _additive_upsert():
+    stmt = insert(SessionTopicStats)
+    table, excluded = SessionTopicStats.__table__.c, stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[SessionTopicStats.session_id, SessionTopicStats.topic],
+        set_={
+            "message_count": table.message_count + excluded.message_count,
+            "payload_bytes": table.payload_bytes + excluded.payload_bytes,
+            "first_ts": func.least(table.first_ts, excluded.first_ts),
+            "last_ts": func.greatest(table.last_ts, excluded.last_ts),
+            "interval_hist": literal_column(
+                "ARRAY(SELECT a + b FROM unnest(session_topic_stats.interval_hist, excluded.interval_hist) AS u(a, b))"
+            ),
+        },
+    )
+
+
+_UPSERT = _additive_upsert()
+
+
+class SessionStats:
+    def __init__(self, session_id: uuid.UUID):
+        self.session_id = session_id
+        self._topics: dict[str, _TopicStats] = {}
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()  # committed() on concurrent writer threads vs. snapshot() on the event loop
+        self._flush_lock = threading.Lock()  # keeps upserts of the same topic in order
+        self._history: deque[tuple[float, dict[str, int]]] = deque()
+        # count, bytes and interval histogram per topic as of the last successful flush
+        self._flushed: dict[str, tuple[int, int, list[int]]] = {}
+
+    def load(self) -> None:
+        """Continue from what earlier recordings of this session stored."""
+        with engine.connect() as conn:
+            rows = conn.execute(select(SessionTopicStats).where(SessionTopicStats.session_id == self.session_id)).all()
+        with self._lock:
+            for r in rows:
+                s = _TopicStats(r.first_ts)
+                s.count, s.bytes, s.last_ts = r.message_count, r.payload_bytes, r.last_ts
+                s.intervals = list(r.interval_hist)
+                self._topics[r.topic] = s
+                self._flushed[r.topic] = (s.count, s.bytes, list(s.intervals))
+
+    def observe(self, topic: str, ts: datetime, size: int) -> None:
+        with self._lock:
+            self._add(topic, ts, size)
+
+    def committed(self, rows: list[dict], sizes: list[int]) -> None:
+        """Count the rows of a committed batch and upsert the topics they changed."""
+        with self._lock:
+            for row, size in zip(rows, sizes):
+                self._add(row["topic"], row["ts"], size)
+        self.flush()
+
+    def _add(self, topic: str, ts: datetime, size: int) -> None:
+        s = self._topics.get(topic)
+        if s is None:
+            s = self._topics[topic] = _TopicStats(ts)
+        elif ts < s.first_ts:
+            s.first_ts = ts
+        # Batches commit concurrently; a row older than the newest one counted adds no interval.
+        if s.count and ts >= s.last_ts:
+            s.intervals[bisect_left(INTERVAL_BOUNDS_S, (ts - s.last_ts).total_seconds())] += 1
+        s.count += 1
+        s.bytes += size
+        if ts > s.last_ts:
+            s.last_ts = ts
+        self._dirty.add(topic)
+
+    def flush(self) -> None:
+        # Never raises: the batch itself is already committed and the topics stay dirty for the next try.
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                current = {}
+                for t in dirty:
+                    s = self._topics[t]
+                    current[t] = (s.count, s.bytes, list(s.intervals), s.first_ts, s.last_ts)
+            self._remember()
+            if not current:
+                return
+            values = []
+            for t, (count, size, intervals, first_ts, last_ts) in sorted(current.items()):
+                f_count, f_size, f_intervals = self._flushed.get(t, (0, 0, [0] * len(intervals)))
+                values.append(
+                    {
+                        "session_id": self.session_id,
+                        "topic": t,
+                        "message_count": count - f_count,
+                        "payload_bytes": size - f_size,
+                        "first_ts": first_ts,
+                        "last_ts": last_ts,
+                        "interval_hist": [a - b for a, b in zip(intervals, f_intervals)],
+                    }
+                )
+            try:
+                with engine.begin() as conn:
+                    conn.execute(_UPSERT, values)
+            except Exception:
+                logger.exception("Failed to store topic stats", extra={"session_id": str(self.session_id)})
+                with self._lock:
+                    self._dirty |= dirty
+                return
+            for t, (count, size, intervals, _, _) in current.items():
+                self._flushed[t] = (count, size, intervals)
+
+    def _remember(self) -> None:
+        """Keep per-topic counts of the last few seconds for live rates."""
+        now = time.monotonic()
+        if self._history and now - self._history[-1][0] < 1.0:
+            return
+        with self._lock:
+            counts = {t: s.count for t, s in self._topics.items()}
+        self._history.append((now, counts))
+        while len(self._history) > 1 and now - self._history[1][0] >= _RATE_WINDOW_S:
+            self._history.popleft()
+
+    def snapshot(self) -> list[dict]:
+        """Current aggregates including msgs/s over roughly the last ten seconds."""
+        with self._flush_lock:
+            self._remember()
+            since, base = self._history[0]
+        elapsed = time.monotonic() - since
+        with self._lock:
+            topics = [
+                (t, s.count, s.bytes, s.first_ts, s.last_ts, list(s.intervals)) for t, s in self._topics.items()
+            ]
+        out = []
+        for topic, count, size, first_ts, last_ts, intervals in topics:
+            item = _topic_out(topic, count, size, first_ts, last_ts, intervals)
+            item["rate_per_s"] = round((count - base.get(topic, 0)) / elapsed, 2) if elapsed >= 1.0 else None
+            out.append(item)
+        return out
+
+
+def _topic_out(topic, count, size, first_ts, last_ts, intervals) -> dict:
+    return {
+        "topic": topic,
+        "count": count,
+        "bytes": size,
+        "first_ts": first_ts.isoformat(),
+        "last_ts": last_ts.isoformat(),
+        "interval_hist_s": _histogram(intervals),
+    }
+
+
+def stored_stats(conn: Connection, session_id: str | uuid.UUID) -> list[dict]:
+    rows = conn.execute(select(SessionTopicStats).where(SessionTopicStats.session_id == session_id)).all()
+    return [
+        _topic_out(r.topic, r.message_count, r.payload_bytes, r.first_ts, r.last_ts, r.interval_hist) for r in rows
+    ]
+
+
+def delete_session_stats(session_id: str | uuid.UUID) -> None:
+    with engine.begin() as conn:
+        conn.execute(delete(SessionTopicStats).where(SessionTopicStats.session_id == session_id))
@@ -0,0 +1,108 @@
+"""Live tail of a recording session, streamed from the recorder instead of the database.
+
+While a session has viewers, the receive loop appends every message to a
+``TailBuffer``: one deque append, however many viewers there are. Each viewer
+polls the ring from its own cursor every ``TAIL_POLL_INTERVAL_S``, filters,
+samples and decodes on its own time. A viewer that falls more than
+``TAIL_BUFFER_SIZE`` messages behind skips ahead and is told how many it
+missed; nothing a viewer does can slow down ingestion.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import TYPE_CHECKING, AsyncIterator
+
+from .config import settings
+from .payloads import decode_payload
+from .topics import TopicTrie
+
+if TYPE_CHECKING:
+    from .services import RecorderService
+
+# (ts, topic, raw payload, qos, retained)
+TailEntry = tuple[datetime, str, bytes, int, bool]
+
+
+class TailBuffer:
+    """Ring of the most recent messages of a session; written and read on the event loop only."""
+
+    def __init__(self, size: int):
+        self._ring: deque[TailEntry] = deque(maxlen=size)
+        self.seq = 0  # sequence number of the next message
+        self.viewers = 0
+
+    def append(self, entry: TailEntry) -> None:
+        self._ring.append(entry)
+        self.seq += 1
+
+    def read(self, cursor: int) -> tuple[list[TailEntry], int, int]:
+        """Messages from ``cursor`` on; returns them, the next cursor and how many were already overwritten."""
+        oldest = self.seq - len(self._ring)
+        dropped = max(0, oldest - cursor)
+        # Read from the newest end so the cost is the number of new messages, not the ring size.
+        entries = list(islice(reversed(self._ring), self.seq - max(cursor, oldest)))
+        entries.reverse()
+        return entries, self.seq, dropped
+
+
+def _message(entry: TailEntry) -> dict:
+    ts, topic, raw, qos, retained = entry
+    return {"ts": ts.isoformat(), "topic": topic, "payload": decode_payload(raw), "qos": qos, "retained": retained}
+
+
+async def follow(
+    rec: RecorderService,
+    topic_filters: list[str] | None = None,
+    sample: int = 1,
+    max_rate: float | None = None,
+    coalesce: bool = False,
+) -> AsyncIterator[dict]:
+    """Batches of new messages of ``rec`` as ``{"messages": [...], "dropped": n}``, until it stops recording.
+
+    ``sample`` keeps every n-th matching message, ``coalesce`` only the latest
+    per topic in each poll, and ``max_rate`` caps messages/s by spreading the
+    kept ones evenly over each poll. Everything left out counts as dropped.
+    An empty batch is yielded at least every ``TAIL_KEEPALIVE_S``.
+    """
+    trie: TopicTrie[bool] | None = None
+    if topic_filters:
+        trie = TopicTrie()
+        for f in topic_filters:
+            trie.add(f, True)
+    tail = rec.open_tail()
+    cursor = tail.seq
+    seen = 0
+    interval = settings.tail_poll_interval_s
+    allowance = 0.0
+    idle = 0.0
+    try:
+        while rec.is_running():
+            await asyncio.sleep(interval)
+            entries, cursor, dropped = tail.read(cursor)
+            if trie is not None:
+                entries = [e for e in entries if trie.match(e[1])]
+            kept = entries
+            if sample > 1:
+                kept = [e for i, e in enumerate(kept, seen) if i % sample == 0]
+                seen += len(entries)
+            if coalesce:
+                kept = list({e[1]: e for e in kept}.values())
+            if max_rate:
+                # Token bucket holding at most one second's worth, so slow rates still get single messages.
+                allowance = min(allowance + max_rate * interval, max(max_rate, 1.0))
+                budget = int(allowance)
+                if len(kept) > budget:
+                    step = len(kept) / budget if budget else 0
+                    kept = [kept[int(i * step)] for i in range(budget)]
+                allowance -= len(kept)
+            dropped += len(entries) - len(kept)
+            if kept or dropped or idle >= settings.tail_keepalive_s:
+                idle = 0.0
+                yield {"messages": [_message(e) for e in kept], "dropped": dropped}
+            else:
+                idle += interval
+    finally:
+        rec.close_tail()
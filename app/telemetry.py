@@ -1,9 +1,13 @@
 from __future__ import annotations
 
+import gzip
 import json
 import logging
 import os
+import shutil
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Sequence
@@ -18,60 +22,167 @@ from opentelemetry.sdk._logs.export import (
 
 from .config import settings
 
+try:
+    import orjson
+except ImportError:  # optional, see the "fast" extra in pyproject.toml
+    orjson = None
+
+
+if orjson is not None:
+    def _dumps(obj: dict) -> bytes:
+        return orjson.dumps(obj, default=str)
+else:
+    def _dumps(obj: dict) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
 
 class FileLogExporter(LogExporter):
-    def __init__(self, file_path: str):
-        self._file_path = file_path
+    """Writes one JSON object per log record to a file that is kept open.
+
+    The file is rotated once it reaches ``max_bytes`` or is older than
+    ``rotate_interval_s`` (0 disables either); rotated files are gzipped on a
+    background thread and only the newest ``backups`` are kept.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        max_bytes: int = 0,
+        rotate_interval_s: float = 0,
+        backups: int = 10,
+    ):
+        self._file_path = Path(file_path)
+        self._max_bytes = max_bytes
+        self._rotate_interval_s = rotate_interval_s
+        self._backups = backups
         self._lock = threading.Lock()
+        self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="otel-log-gzip")
+        self._second = -1
+        self._second_iso = ""
+        self._file = None
+        self._open()
+
+    def _open(self) -> None:
+        self._file = self._file_path.open("ab", buffering=1 << 16)
+        self._size = self._file.tell()
+        self._opened_at = time.monotonic()
+
+    def _iso(self, ts_ns: int) -> str:
+        # Records of one export mostly share their second; format it once.
+        second, ns = divmod(ts_ns, 1_000_000_000)
+        if second != self._second:
+            self._second = second
+            self._second_iso = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        return f"{self._second_iso}.{ns // 1000:06d}+00:00"
 
     def export(self, batch: Sequence) -> LogExportResult:
         try:
-            lines: list[str] = []
+            lines: list[bytes] = []
             for item in batch:
                 record = item.log_record
                 severity = getattr(record.severity_text, "value", None) or str(record.severity_text)
                 body = record.body
                 if not isinstance(body, str):
                     body = str(body)
-                attrs = {}
-                if record.attributes:
-                    attrs = {str(k): v for k, v in record.attributes.items()}
-
-                ts_ns = getattr(record, "timestamp", None)
-                if isinstance(ts_ns, int) and ts_ns > 0:
-                    ts = datetime.fromtimestamp(ts_ns / 1_000_000_000, tz=timezone.utc).isoformat()
-                else:
-                    ts = datetime.now(timezone.utc).isoformat()
-
-                payload = {
-                    "ts": ts,
-                    "severity": severity,
-                    "body": body,
-                    "attributes": attrs,
-                }
-                lines.append(json.dumps(payload, ensure_ascii=False))
+                ts_ns = record.timestamp
+                if not isinstance(ts_ns, int) or ts_ns <= 0:
+                    ts_ns = time.time_ns()
+                lines.append(
+                    _dumps(
+                        {
+                            "ts": self._iso(ts_ns),
+                            "severity": severity,
+                            "body": body,
+                            "attributes": dict(record.attributes) if record.attributes else {},
+                        }
+                    )
+                )
 
             if not lines:
                 return LogExportResult.SUCCESS
 
+            data = b"\n".join(lines) + b"\n"
             with self._lock:
-                with open(self._file_path, "a", encoding="utf-8") as f:
-                    f.write("\n".join(lines) + "\n")
+                if self._file is None:
+                    return LogExportResult.FAILURE
+                if self._should_rotate(len(data)):
+                    self._rotate()
+                self._file.write(data)
+                # One write per exported batch keeps the file tail-able without a syscall per record.
+                self._file.flush()
+                self._size += len(data)
             return LogExportResult.SUCCESS
         except Exception:
             return LogExportResult.FAILURE
 
+    def _should_rotate(self, incoming: int) -> bool:
+        if self._size == 0:
+            return False
+        if self._max_bytes and self._size + incoming > self._max_bytes:
+            return True
+        return bool(self._rotate_interval_s) and time.monotonic() - self._opened_at >= self._rotate_interval_s
+
+    def _rotate(self) -> None:
+        self._file.close()
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        rotated = self._file_path.with_name(f"{self._file_path.name}.{stamp}")
+        os.replace(self._file_path, rotated)
+        self._open()
+        self._compressor.submit(self._compress, rotated)
+
+    def _compress(self, path: Path) -> None:
+        try:
+            target = path.with_name(path.name + ".gz")
+            with path.open("rb") as src, gzip.open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            path.unlink()
+            if self._backups > 0:
+                old = sorted(self._file_path.parent.glob(f"{self._file_path.name}.*.gz"))
+                for stale in old[: -self._backups]:
+                    stale.unlink(missing_ok=True)
+        except Exception:
+            # Never log from here: it would feed back into this exporter.
+            pass
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        return True
+
     def shutdown(self):
-        return None
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+        self._compressor.shutdown(wait=True)
+
+
+_provider: LoggerProvider | None = None
 
 
 def setup_observability() -> None:
+    global _provider
     log_path = Path(settings.otel_log_file)
     log_path.parent.mkdir(parents=True, exist_ok=True)
 
     resource = Resource.create({"service.name": settings.otel_service_name})
     provider = LoggerProvider(resource=resource)
-    provider.add_log_record_processor(BatchLogRecordProcessor(FileLogExporter(str(log_path))))
+    provider.add_log_record_processor(
+        BatchLogRecordProcessor(
+            FileLogExporter(
+                str(log_path),
+                max_bytes=settings.otel_log_max_bytes,
+                rotate_interval_s=settings.otel_log_rotate_interval_s,
+                backups=settings.otel_log_backups,
+            )
+        )
+    )
+    if _provider is not None:
+        _provider.shutdown()
+    _provider = provider
 
     handler = LoggingHandler(level=logging.NOTSET, logger_provider=provider)
 
@@ -93,3 +204,11 @@ def setup_observability() -> None:
             "log_level": settings.log_level.upper(),
         },
     )
+
+
+def shutdown_observability() -> None:
+    """Export pending log records and close the log file."""
+    global _provider
+    if _provider is not None:
+        _provider.shutdown()
+        _provider = None
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import re
+from typing import Generic, Hashable, Iterable, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+_CACHE_SIZE = 10_000
+
+
+def validate_topic_filter(topic_filter: str) -> None:
+    if not topic_filter:
+        raise ValueError("Topic filter must not be empty")
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if "#" in level and (level != "#" or i != len(levels) - 1):
+            raise ValueError(f"'#' must be the last level on its own: {topic_filter!r}")
+        if "+" in level and level != "+":
+            raise ValueError(f"'+' must occupy an entire level: {topic_filter!r}")
+
+
+def filter_covers(general: str, specific: str) -> bool:
+    """True if every topic matched by ``specific`` is also matched by ``general``."""
+    g_levels = general.split("/")
+    s_levels = specific.split("/")
+    for i, g in enumerate(g_levels):
+        dollar = i == 0 and s_levels[0].startswith("$")
+        if g == "#":
+            return not dollar
+        if i >= len(s_levels) or s_levels[i] == "#":
+            return False
+        if g == "+":
+            if dollar:
+                return False
+        elif g != s_levels[i]:
+            return False
+    return len(g_levels) == len(s_levels)
+
+
+def minimal_cover(topic_filters: Iterable[str]) -> set[str]:
+    """Drop filters that are covered by another one.
+
+    Brokers may deliver one copy of a message per matching subscription, so
+    subscribing to e.g. both ``a/#`` and ``a/b`` would record duplicates.
+    """
+    filters = sorted(set(topic_filters))
+    return {f for f in filters if not any(g != f and filter_covers(g, f) for g in filters)}
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children: dict[str, _Node] = {}
+        self.values: set = set()
+
+
+class TopicTrie(Generic[T]):
+    """MQTT topic filters compiled into a level trie.
+
+    ``match()`` walks one trie level per topic level, so its cost depends on the
+    topic depth rather than on the number of filters. Results are cached per
+    topic until the filter set changes.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._filters: dict[str, set[T]] = {}
+        self._cache: dict[str, frozenset[T]] = {}
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def filters(self) -> set[str]:
+        return set(self._filters)
+
+    def add(self, topic_filter: str, value: T) -> None:
+        validate_topic_filter(topic_filter)
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.values.add(value)
+        self._filters.setdefault(topic_filter, set()).add(value)
+        self._cache.clear()
+
+    def add_many(self, topic_filters: Iterable[str], value: T) -> None:
+        for f in topic_filters:
+            self.add(f, value)
+
+    def remove(self, topic_filter: str, value: T) -> None:
+        values = self._filters.get(topic_filter)
+        if not values or value not in values:
+            return
+        values.discard(value)
+        if not values:
+            del self._filters[topic_filter]
+
+        path = [self._root]
+        for level in topic_filter.split("/"):
+            path.append(path[-1].children[level])
+        path[-1].values.discard(value)
+        # Prune nodes that no longer lead to any filter.
+        for parent, level, node in zip(reversed(path[:-1]), reversed(topic_filter.split("/")), reversed(path[1:])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+        self._cache.clear()
+
+    def remove_many(self, topic_filters: Iterable[str], value: T) -> None:
+        for f in topic_filters:
+            self.remove(f, value)
+
+    def match(self, topic: str) -> frozenset[T]:
+        hit = self._cache.get(topic)
+        if hit is not None:
+            return hit
+        hit = self._match(topic)
+        if len(self._cache) >= _CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = hit
+        return hit
+
+    def _match(self, topic: str) -> frozenset[T]:
+        result: set[T] = set()
+        # Wildcards at the first level must not match topics starting with '$' (e.g. $SYS).
+        wild = not topic.startswith("$")
+        nodes = [self._root]
+        for level in topic.split("/"):
+            nxt: list[_Node] = []
+            for node in nodes:
+                children = node.children
+                if wild:
+                    multi = children.get("#")
+                    if multi is not None:
+                        result.update(multi.values)
+                    single = children.get("+")
+                    if single is not None:
+                        nxt.append(single)
+                exact = children.get(level)
+                if exact is not None:
+                    nxt.append(exact)
+            if not nxt:
+                return frozenset(result)
+            nodes = nxt
+            wild = True
+
+        for node in nodes:
+            result.update(node.values)
+            # "a/#" also matches the parent level "a".
+            multi = node.children.get("#")
+            if multi is not None:
+                result.update(multi.values)
+        return frozenset(result)
+
+
+class TopicMapper:
+    """Filter and rename topics with ordered MQTT wildcard rules.
+
+    Each rule is ``filter`` (keep matching topics), ``!filter`` (drop them) or
+    ``filter=target`` (rename them). In a target, ``{1}``, ``{2}``, ... stand
+    for what the filter's 1st, 2nd, ... wildcard matched, e.g.
+    ``plant/+/temp/#=rig/{1}/{2}``. The first rule that matches a topic
+    decides; topics no rule matches are dropped, unless all rules are drops.
+    """
+
+    def __init__(self, rules: Iterable[str]):
+        self._rules: list[tuple[str, str | None, bool]] = []
+        self._trie: TopicTrie[int] = TopicTrie()
+        for rule in rules:
+            drop = rule.startswith("!")
+            topic_filter, sep, target = rule.lstrip("!").partition("=")
+            if drop and sep:
+                raise ValueError(f"A drop rule cannot rename: {rule!r}")
+            if sep:
+                wildcards = sum(level in ("+", "#") for level in topic_filter.split("/"))
+                for ref in re.findall(r"\{(\d+)\}", target):
+                    if not 1 <= int(ref) <= wildcards:
+                        raise ValueError(f"{{{ref}}} does not refer to a wildcard of {topic_filter!r}")
+                if not target or "+" in target or "#" in target:
+                    raise ValueError(f"Rename target must be a topic name: {rule!r}")
+            self._trie.add(topic_filter, len(self._rules))
+            self._rules.append((topic_filter, target if sep else None, drop))
+        self._default_keep = all(drop for _, _, drop in self._rules)
+        self._cache: dict[str, str | None] = {}
+
+    def keep_filters(self) -> list[str] | None:
+        """Filters a topic must match to be kept at all, or None if unmatched topics are kept."""
+        if self._default_keep:
+            return None
+        return [f for f, _, drop in self._rules if not drop]
+
+    def map(self, topic: str) -> str | None:
+        """The topic to publish under, or None to skip the message."""
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        hits = self._trie.match(topic)
+        if not hits:
+            out = topic if self._default_keep else None
+        else:
+            topic_filter, target, drop = self._rules[min(hits)]
+            if drop:
+                out = None
+            elif target is None:
+                out = topic
+            else:
+                out = _render(target, _captures(topic_filter, topic), topic_filter.endswith("#"))
+        if len(self._cache) >= _CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = out
+        return out
+
+
+def _captures(topic_filter: str, topic: str) -> list[str]:
+    levels = topic.split("/")
+    out = []
+    for i, level in enumerate(topic_filter.split("/")):
+        if level == "+":
+            out.append(levels[i])
+        elif level == "#":
+            out.append("/".join(levels[i:]))
+    return out
+
+
+def _render(target: str, captures: list[str], multi: bool) -> str:
+    if multi and not captures[-1]:
+        # The '#' matched only the parent level; its separator goes as well.
+        target = target.replace(f"/{{{len(captures)}}}", "")
+    return re.sub(r"\{(\d+)\}", lambda m: captures[int(m.group(1)) - 1], target)
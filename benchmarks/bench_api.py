@@ -0,0 +1,159 @@
+"""API latency under concurrent requests while a session is recording.
+
+Starts benchmarks.broker and the API (uvicorn subprocess, same DB_* settings
+as the API), records one session that receives ``--rate`` msgs/s and then
+runs ``--concurrency`` clients issuing a mix of read requests for
+``--seconds``. Reports requests/s and p50/p95/p99 latency per endpoint, plus
+the message rate the recorder kept up with during the run.
+
+    pip install ".[bench]"
+    python -m benchmarks.bench_api --concurrency 32 --rate 2000
+
+``--app-dir`` serves the API from another checkout (e.g. a ``git worktree``
+of an older revision) to compare against a baseline.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+from aiomqtt import Client
+
+TOPIC_PREFIX = "bench/api"
+
+
+async def _publish(port: int, rate: float, stop: threading.Event) -> int:
+    sent = 0
+    async with Client("127.0.0.1", port, client_id="bench-api-pub") as client:
+        start = time.perf_counter()
+        while not stop.is_set():
+            due = int((time.perf_counter() - start) * rate)
+            while sent < due:
+                await client.publish(f"{TOPIC_PREFIX}/{sent % 20}", json.dumps({"seq": sent, "v": sent % 97}).encode())
+                sent += 1
+            await asyncio.sleep(0.005)
+    return sent
+
+
+async def _wait_ready(http: httpx.AsyncClient, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"API exited with {proc.returncode}")
+        try:
+            await http.get("/sessions")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("API did not come up")
+
+
+async def _client(http: httpx.AsyncClient, paths: list[tuple[str, str]], stop: asyncio.Event, out: dict) -> None:
+    rnd = random.Random()
+    while not stop.is_set():
+        name, path = rnd.choice(paths)
+        t0 = time.perf_counter()
+        resp = await http.get(path)
+        elapsed = time.perf_counter() - t0
+        if resp.status_code != 200:
+            out.setdefault("errors", []).append(f"{name}: {resp.status_code}")
+            continue
+        out.setdefault(name, []).append(elapsed)
+
+
+def _ms(v: float) -> float:
+    return round(v * 1e3, 2)
+
+
+async def _run(args: argparse.Namespace, broker_port: int) -> dict:
+    env = {**os.environ, "MQTT_HOST": "127.0.0.1", "MQTT_PORT": str(broker_port)}
+    cmd = [
+        sys.executable, "-m", "uvicorn", "app.main:app", "--app-dir", args.app_dir,
+        "--port", str(args.port), "--log-level", "warning",
+    ]
+    api = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}/v1", limits=limits, timeout=30) as http:
+        try:
+            await _wait_ready(http, api)
+            sid = (await http.post("/sessions", json={"node": "bench-api", "topic_filters": [f"{TOPIC_PREFIX}/#"]})).json()["id"]
+            (await http.post(f"/sessions/{sid}/record/start")).raise_for_status()
+            await asyncio.sleep(1)
+
+            # Own thread and event loop, so the load generator cannot starve it.
+            stop = threading.Event()
+            publisher = asyncio.get_running_loop().run_in_executor(
+                None, asyncio.run, _publish(broker_port, args.rate, stop)
+            )
+            await asyncio.sleep(2)  # let the recorder reach a steady state
+            received_before = (await http.get("/recorder")).json()["pipelines"][0]["received"]
+            paths = [
+                ("list_sessions", "/sessions"),
+                ("messages", f"/sessions/{sid}/messages?limit=50"),
+                ("query", f"/sessions/{sid}/messages/query?topic={TOPIC_PREFIX}/%2B&limit=50"),
+                ("stats", f"/sessions/{sid}/stats?limit=20"),
+                ("recorder", "/recorder"),
+            ]
+            latencies: dict = {}
+            clients_stop = asyncio.Event()
+            clients = [asyncio.create_task(_client(http, paths, clients_stop, latencies)) for _ in range(args.concurrency)]
+            started = time.perf_counter()
+            await asyncio.sleep(args.seconds)
+            clients_stop.set()
+            await asyncio.gather(*clients)
+            elapsed = time.perf_counter() - started
+            received = (await http.get("/recorder")).json()["pipelines"][0]["received"] - received_before
+            stop.set()
+            await publisher
+
+            await http.post(f"/sessions/{sid}/record/stop")
+            await http.delete(f"/sessions/{sid}")
+        finally:
+            api.terminate()
+            api.wait()
+
+    errors = latencies.pop("errors", [])
+    endpoints = {}
+    for name, values in sorted(latencies.items()):
+        q = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+        endpoints[name] = {"requests": len(values), "p50_ms": _ms(q[49]), "p95_ms": _ms(q[94]), "p99_ms": _ms(q[98])}
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "concurrency": args.concurrency,
+        "requests_per_s": round(total / elapsed, 1),
+        "errors": len(errors),
+        "recorder_msgs_per_s": round(received / elapsed, 1),
+        "publish_rate": args.rate,
+        "endpoints": endpoints,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seconds", type=float, default=15)
+    ap.add_argument("--rate", type=float, default=2000, help="messages/s published to the recorded session")
+    ap.add_argument("--port", type=int, default=8150)
+    ap.add_argument("--app-dir", default=".")
+    args = ap.parse_args()
+
+    broker = subprocess.Popen([sys.executable, "-m", "benchmarks.broker", "--port", "0"], stdout=subprocess.PIPE)
+    try:
+        broker_port = int(broker.stdout.readline().decode().rsplit(":", 1)[1])
+        print(json.dumps(asyncio.run(_run(args, broker_port)), indent=2))
+    finally:
+        broker.terminate()
+        broker.wait()
+
+
+if __name__ == "__main__":
+    main()
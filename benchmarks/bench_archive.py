@@ -0,0 +1,82 @@
+"""Size and read throughput of session archives (app/archive.py), no database needed.
+
+Writes synthetic JSON telemetry to an archive with every available codec and
+reports bytes per message, compression ratio against the raw payloads, write
+rate, the rate at which playback rows are decoded and the time to seek to the
+middle of the session.
+
+    python -m benchmarks.bench_archive --n 500000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from app.archive import CODEC_ZLIB, CODEC_ZSTD, ArchiveReader, ArchiveWriter, zstandard
+
+
+def _messages(n: int, topics: int):
+    rnd = random.Random(1)
+    ts = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    names = [f"plant/{i % 7}/line/{i}/status" for i in range(topics)]
+    for i in range(n):
+        ts += timedelta(microseconds=rnd.randint(50, 2000))
+        payload = json.dumps(
+            {"seq": i, "temp": round(20 + rnd.random() * 5, 2), "ok": rnd.random() > 0.01, "unit": "C"}
+        ).encode()
+        yield ts, names[i % topics], payload, 1, False
+
+
+def _bench(codec: int, n: int, topics: int, chunk_rows: int, directory: Path) -> dict:
+    path = directory / f"bench-{codec}.mqa"
+    writer = ArchiveWriter(path, {"session_id": "bench"}, chunk_rows=chunk_rows, codec=codec)
+    payload_bytes = 0
+    t0 = time.perf_counter()
+    for ts, topic, payload, qos, retained in _messages(n, topics):
+        writer.append(ts, topic, payload, qos, retained)
+        payload_bytes += len(payload)
+    meta = writer.close()
+    write_s = time.perf_counter() - t0
+    size = path.stat().st_size
+
+    with ArchiveReader(path) as reader:
+        t0 = time.perf_counter()
+        rows = sum(len(chunk) for chunk in reader.iter_chunks())
+        read_s = time.perf_counter() - t0
+        middle = datetime.fromisoformat(meta["first_ts"]) + (
+            datetime.fromisoformat(meta["last_ts"]) - datetime.fromisoformat(meta["first_ts"])
+        ) / 2
+        t0 = time.perf_counter()
+        next(reader.iter_chunks(middle))
+        seek_ms = (time.perf_counter() - t0) * 1e3
+    assert rows == n
+    return {
+        "codec": meta["codec"],
+        "bytes_per_msg": round(size / n, 2),
+        "ratio_vs_payloads": round(payload_bytes / size, 2),
+        "write_msgs_per_s": round(n / write_s),
+        "read_msgs_per_s": round(n / read_s),
+        "seek_ms": round(seek_ms, 2),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=200_000)
+    ap.add_argument("--topics", type=int, default=50)
+    ap.add_argument("--chunk-rows", type=int, default=10_000)
+    args = ap.parse_args()
+
+    codecs = [CODEC_ZLIB] + ([CODEC_ZSTD] if zstandard is not None else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in codecs:
+            print(json.dumps(_bench(codec, args.n, args.topics, args.chunk_rows, Path(tmp))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Cluster mode on one machine: several API processes recording through the broker stand-in.
+
+Starts benchmarks.broker and ``--nodes`` uvicorn processes with
+``CLUSTER_MODE=true`` (distinct ports and node ids, same DB_* settings as the
+API), then records two sessions over the same topics:
+
+- ``split``: started with ``shares=<nodes>``, every node takes one slot and the
+  broker hands each message to one of them (``$share`` subscriptions);
+- ``single``: ``shares=1``, recorded by one node.
+
+While publishing at ``--rate`` it prints the per-node ingest rates from
+``GET /v1/cluster`` and, after ``--kill-after`` seconds, SIGKILLs the node that
+records ``single`` to show another node taking it over once the lease expired.
+At the end it compares the rows stored per session with what was published;
+the gap of ``single`` is what was published between the kill and the takeover.
+
+    python -m benchmarks.bench_cluster --nodes 3 --rate 2000 --seconds 20
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from aiomqtt import Client
+from sqlalchemy import func, select
+
+from app.db import engine
+from app.models import MqttMessage
+
+TOPIC_PREFIX = "bench/cluster"
+
+
+def _api(port: int, method: str, path: str, body: dict | None = None) -> dict:
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/v1{path}",
+        method=method,
+        data=json.dumps(body).encode() if body is not None else None,
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def _wait_ready(port: int, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"API on port {port} exited with {proc.returncode}")
+        try:
+            _api(port, "GET", "/cluster")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"API on port {port} did not come up")
+
+
+def _wait_for(predicate, timeout: float, interval: float = 0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if result := predicate():
+            return result
+        time.sleep(interval)
+    raise TimeoutError("condition not met in time")
+
+
+async def _publish(broker_port: int, rate: float, seconds: float, topics: int) -> int:
+    sent = 0
+    async with Client("127.0.0.1", broker_port, client_id="bench-cluster-pub") as client:
+        start = time.perf_counter()
+        while (elapsed := time.perf_counter() - start) < seconds:
+            due = int(elapsed * rate)
+            while sent < due:
+                await client.publish(f"{TOPIC_PREFIX}/{sent % topics}", json.dumps({"seq": sent}).encode(), qos=0)
+                sent += 1
+            await asyncio.sleep(0.005)
+    return sent
+
+
+def _count(session_id: str) -> int:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(MqttMessage).where(MqttMessage.session_id == session_id)
+        ).scalar_one()
+
+
+def _print_nodes(status: dict, elapsed: float) -> None:
+    nodes = ", ".join(
+        f"{n['node_id']}={n.get('rate_per_s', 0)}/s" + ("" if n["alive"] else " (dead)") for n in status["nodes"]
+    )
+    holders = {}
+    for lease in status["leases"]:
+        holders.setdefault(lease["session_id"], []).append(lease["node_id"])
+    print(f"t={elapsed:5.1f}s  {nodes}  leases={sum(len(v) for v in holders.values())}", flush=True)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--nodes", type=int, default=3)
+    ap.add_argument("--base-port", type=int, default=8100)
+    ap.add_argument("--rate", type=float, default=2000, help="messages/s published")
+    ap.add_argument("--seconds", type=float, default=20)
+    ap.add_argument("--topics", type=int, default=20)
+    ap.add_argument("--kill-after", type=float, default=6, help="seconds; 0 disables the failover demo")
+    ap.add_argument("--heartbeat", type=float, default=1.0)
+    ap.add_argument("--lease-ttl", type=float, default=3.0)
+    args = ap.parse_args()
+
+    broker = subprocess.Popen([sys.executable, "-m", "benchmarks.broker", "--port", "0"], stdout=subprocess.PIPE)
+    broker_port = int(broker.stdout.readline().decode().rsplit(":", 1)[1])
+    ports = [args.base_port + i for i in range(args.nodes)]
+    nodes: dict[str, tuple[int, subprocess.Popen]] = {}
+    try:
+        for i, port in enumerate(ports):
+            env = {
+                **os.environ,
+                "CLUSTER_MODE": "true",
+                "CLUSTER_NODE_ID": f"node{i}",
+                "CLUSTER_HEARTBEAT_S": str(args.heartbeat),
+                "CLUSTER_LEASE_TTL_S": str(args.lease_ttl),
+                "MQTT_HOST": "127.0.0.1",
+                "MQTT_PORT": str(broker_port),
+            }
+            cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"]
+            nodes[f"node{i}"] = (port, subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for port, proc in nodes.values():
+            _wait_ready(port, proc)
+
+        api = ports[0]
+        sessions = {}
+        for name, shares in (("split", args.nodes), ("single", 1)):
+            sid = _api(api, "POST", "/sessions", {"node": f"bench-{name}", "topic_filters": [f"{TOPIC_PREFIX}/#"]})["id"]
+            _api(api, "POST", f"/sessions/{sid}/record/start?shares={shares}")
+            sessions[name] = sid
+        slots = args.nodes + 1
+        _wait_for(lambda: len(_api(api, "GET", "/cluster")["leases"]) == slots, timeout=10 * args.heartbeat + 10)
+        time.sleep(1)  # subscriptions are made right after the claims
+
+        pool = ThreadPoolExecutor(1)
+        publisher = pool.submit(asyncio.run, _publish(broker_port, args.rate, args.seconds, args.topics))
+        start = time.monotonic()
+        killed = None
+        while not publisher.done():
+            elapsed = time.monotonic() - start
+            if args.kill_after and killed is None and elapsed >= args.kill_after:
+                status = _api(api, "GET", "/cluster")
+                killed = next(l["node_id"] for l in status["leases"] if l["session_id"] == sessions["single"])
+                if nodes[killed][0] == api:
+                    api = next(p for n, (p, _) in nodes.items() if n != killed)
+                nodes[killed][1].send_signal(signal.SIGKILL)
+                print(f"t={elapsed:5.1f}s  killed {killed}, which recorded 'single'", flush=True)
+            _print_nodes(_api(api, "GET", "/cluster"), elapsed)
+            wait([publisher], timeout=1)
+        published = publisher.result()
+        pool.shutdown()
+
+        time.sleep(2 * args.heartbeat)
+        for sid in sessions.values():
+            _api(api, "POST", f"/sessions/{sid}/record/stop")
+        _wait_for(lambda: not _api(api, "GET", "/cluster")["leases"], timeout=10 * args.heartbeat + 10)
+        time.sleep(2 * args.heartbeat)  # owners flush while stopping
+        print(json.dumps({
+            "nodes": args.nodes,
+            "published": published,
+            "killed": killed,
+            "recorded": {name: _count(sid) for name, sid in sessions.items()},
+            "sessions": sessions,
+        }))
+    finally:
+        for _, proc in nodes.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for _, proc in nodes.values():
+            proc.wait()
+        broker.terminate()
+        broker.wait()
+
+
+if __name__ == "__main__":
+    main()
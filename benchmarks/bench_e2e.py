@@ -0,0 +1,457 @@
+"""End-to-end recorder and playback benchmark against a local broker stand-in.
+
+Starts benchmarks.broker (in-process or as a subprocess), records synthetic
+load through RecorderManager into a pluggable sink and, with the ``db`` sink,
+replays the recording with PlaybackService:
+
+- ``--sink memory``: batches are dropped after an optional simulated commit
+  time (``--sink-latency-ms``); no database needed.
+- ``--sink db``: the configured Postgres (same DB_* settings as the API).
+
+Per scenario it reports recorder msgs/s, publish-to-commit latency p50/p99,
+peak RSS, and for ``db`` playback timing error (timed mode) and max-mode
+throughput. Results are written as JSON; pass an earlier file as
+``--baseline`` to print the change per scenario.
+
+    python -m benchmarks.bench_e2e --sink memory --out e2e.json
+    python -m benchmarks.bench_e2e --sink db --scenario small_json_steady --baseline e2e.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from aiomqtt import Client
+from sqlalchemy import Table, delete, select
+
+from app.config import settings
+from app.ingest import RowWriter, row_writer
+from app.models import MqttMessage, PayloadBlob
+from app.payloads import dumps_json, payload_for_api
+from app.services import PlaybackService, RecorderManager
+from benchmarks.broker import Broker
+
+_BINARY = struct.Struct("<cId")  # marker, seq, sent (perf_counter)
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    messages: int
+    size: int  # payload bytes
+    topics: int  # distinct topics the load is spread over
+    payload: str = "json"  # json | binary
+    rate: float = 0  # msgs/s, 0 = as fast as possible
+    burst: int = 1  # messages published back-to-back per tick of the rate clock
+    sessions: int = 1  # recording sessions every message is routed to
+    qos: int = 0
+
+
+SCENARIOS = {
+    s.name: s
+    for s in (
+        Scenario("small_json_steady", 20_000, 100, 10, rate=5_000),
+        Scenario("small_json_max", 50_000, 100, 10),
+        Scenario("large_json_max", 10_000, 8_192, 10),
+        Scenario("binary_1k_max", 20_000, 1_024, 10, payload="binary"),
+        Scenario("topic_fanout_1000", 20_000, 200, 1_000),
+        Scenario("session_fanout_4", 20_000, 200, 10, sessions=4),
+        Scenario("bursty", 20_000, 200, 10, rate=5_000, burst=1_000),
+        Scenario("qos1_steady", 10_000, 200, 10, rate=2_000, qos=1),
+    )
+}
+
+
+def _payload_factory(s: Scenario) -> Callable[[int], bytes]:
+    if s.payload == "binary":
+        pad = os.urandom(max(0, s.size - _BINARY.size))
+        return lambda seq: _BINARY.pack(b"\x00", seq, time.perf_counter()) + pad
+
+    filler = "x" * max(0, s.size - 48)
+
+    def make(seq: int) -> bytes:
+        return dumps_json({"seq": seq, "sent": time.perf_counter(), "pad": filler})
+
+    return make
+
+
+def _sent_at(raw: bytes | None, payload_json: Any) -> float:
+    obj = payload_for_api(raw, payload_json)
+    if "sent" in obj:
+        return obj["sent"]
+    return _BINARY.unpack_from(raw if raw is not None else base64.b64decode(obj["_raw_b64"]))[2]
+
+
+def _stored_payloads(rows: list[dict]) -> list[tuple[bytes | None, Any]]:
+    """(payload_raw, payload_json) of committed rows; with PAYLOAD_DEDUP they only carry a hash into payload_blob."""
+    hashes = {r["payload_hash"] for r in rows if "payload_hash" in r}
+    blobs = {}
+    if hashes:
+        from app.db import SessionLocal
+
+        with SessionLocal() as db:
+            found = db.execute(
+                select(PayloadBlob.hash, PayloadBlob.payload_raw, PayloadBlob.payload_json).where(
+                    PayloadBlob.hash.in_(hashes)
+                )
+            )
+            blobs = {h: (raw, obj) for h, raw, obj in found}
+    return [
+        blobs[r["payload_hash"]] if "payload_hash" in r else (r.get("payload_raw"), r.get("payload_json"))
+        for r in rows
+    ]
+
+
+class _Sink:
+    """writer_factory for RecorderManager that measures publish-to-commit latency."""
+
+    def __init__(self, kind: str, latency_ms: float):
+        self.kind = kind
+        self.latency_s = latency_ms / 1000
+        self.latencies: list[float] = []
+        self.last_commit = 0.0
+
+    def __call__(self, table: Table) -> RowWriter:
+        write = row_writer(table) if self.kind == "db" else self._discard
+        if table is not MqttMessage.__table__:
+            return write
+
+        def measured(rows: list[dict]) -> None:
+            write(rows)
+            now = time.perf_counter()
+            self.latencies.extend([now - _sent_at(raw, obj) for raw, obj in _stored_payloads(rows)])
+            self.last_commit = now
+
+        return measured
+
+    def _discard(self, rows: list[dict]) -> None:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+
+class _RssSampler:
+    """Peak resident set size of this process (and the broker subprocess) while a scenario runs."""
+
+    def __init__(self, pids: list[int]):
+        self.pids = pids
+        self.peak = {pid: 0 for pid in pids}
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def _rss(pid: int) -> int:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # No procfs: fall back to the lifetime peak of this process.
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if pid == os.getpid() else 0
+
+    async def _run(self):
+        while True:
+            for pid in self.pids:
+                self.peak[pid] = max(self.peak[pid], self._rss(pid))
+            await asyncio.sleep(0.05)
+
+    def __enter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        for pid in self.pids:
+            self.peak[pid] = max(self.peak[pid], self._rss(pid))
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _ms(v: float | None) -> float | None:
+    return round(v * 1000, 3) if v is not None else None
+
+
+async def _publish(s: Scenario, prefix: str) -> float:
+    make = _payload_factory(s)
+    topics = [f"{prefix}/line{i % 16}/dev{i}" for i in range(s.topics)]
+    loop = asyncio.get_running_loop()
+    async with Client(settings.mqtt_host, settings.mqtt_port, client_id=f"bench-pub-{uuid.uuid4().hex[:8]}") as client:
+        started = loop.time()
+        for seq in range(s.messages):
+            if s.rate and seq % s.burst == 0:
+                # Absolute schedule: bursts of `burst` messages, `burst / rate` seconds apart.
+                delay = started + seq / s.rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await client.publish(topics[seq % s.topics], make(seq), qos=s.qos)
+            if not s.rate and seq % 1000 == 999:
+                await asyncio.sleep(0)  # let the recorder's receive loop run
+        return loop.time() - started
+
+
+async def _record(s: Scenario, sink: _Sink, timeout: float) -> dict:
+    recorder = RecorderManager(writer_factory=sink)
+    prefix = f"bench/{uuid.uuid4().hex[:8]}"
+    session_ids = [str(uuid.uuid4()) for _ in range(s.sessions)]
+    if sink.kind == "db":
+        _create_sessions(session_ids, prefix)
+    for session_id in session_ids:
+        await recorder.start(session_id, [f"{prefix}/#"])
+    await asyncio.sleep(0.3)  # subscription in place
+
+    sink.latencies.clear()
+    expected = s.messages * s.sessions
+    started = time.perf_counter()
+    publish_s = await _publish(s, prefix)
+    deadline = time.monotonic() + timeout
+    while len(sink.latencies) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.02)
+    committed = len(sink.latencies)
+    elapsed = (sink.last_commit or time.perf_counter()) - started
+    await recorder.stop_all()
+
+    lat = sink.latencies
+    return {
+        "session_ids": session_ids,
+        "published": s.messages,
+        "committed": committed,
+        "lost": expected - committed,
+        "publish_s": round(publish_s, 3),
+        "msgs_per_s": round(committed / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": _ms(_percentile(lat, 0.50)),
+            "p99": _ms(_percentile(lat, 0.99)),
+            "max": _ms(max(lat) if lat else None),
+        },
+    }
+
+
+def _create_sessions(session_ids: list[str], prefix: str) -> None:
+    from app.db import SessionLocal
+    from app.models import RecordingSession
+
+    with SessionLocal() as db:
+        for session_id in session_ids:
+            db.add(RecordingSession(id=session_id, node="bench", topic_filters=[f"{prefix}/#"], state="BENCH"))
+        db.commit()
+
+
+def _drop_sessions(session_ids: list[str]) -> None:
+    from app.db import SessionLocal
+    from app.models import RecordingSession
+
+    with SessionLocal() as db:
+        db.execute(delete(MqttMessage).where(MqttMessage.session_id.in_(session_ids)))
+        db.execute(delete(RecordingSession).where(RecordingSession.id.in_(session_ids)))
+        db.commit()
+
+
+async def _playback(session_id: str, mode: str, speed: float, timeout: float) -> dict:
+    from app.db import SessionLocal
+
+    with SessionLocal() as db:
+        ts = db.execute(
+            select(MqttMessage.ts).where(MqttMessage.session_id == session_id).order_by(MqttMessage.ts, MqttMessage.id)
+        ).scalars().all()
+    prefix = f"replay-{uuid.uuid4().hex[:8]}/"
+    arrivals: list[float] = []
+    player = PlaybackService()
+    loop = asyncio.get_running_loop()
+
+    async with Client(settings.mqtt_host, settings.mqtt_port, client_id=f"bench-sub-{uuid.uuid4().hex[:8]}") as client:
+        async with client.messages() as messages:
+            await client.subscribe(f"{prefix}#")
+
+            async def collect():
+                async for _ in messages:
+                    arrivals.append(loop.time())
+                    if len(arrivals) == len(ts):
+                        return
+
+            collector = asyncio.create_task(collect())
+            playback_id = player.start(session_id, speed=speed, topic_prefix=prefix, mode=mode)
+            try:
+                await asyncio.wait_for(collector, timeout)
+            except asyncio.TimeoutError:
+                pass
+            status = player.get(playback_id).status()
+            await player.stop()
+
+    result = {
+        "mode": mode,
+        "expected": len(ts),
+        "received": len(arrivals),
+        "max_lag_ms": _ms(status.get("max_lag_s")),
+    }
+    if len(arrivals) > 1:
+        actual = arrivals[-1] - arrivals[0]
+        result["duration_s"] = round(actual, 3)
+        result["msgs_per_s"] = round(len(arrivals) / actual, 1) if actual > 0 else None
+    if mode == "timed" and arrivals:
+        n = len(arrivals)
+        errors = [
+            abs((arrivals[i] - arrivals[0]) - (ts[i] - ts[0]).total_seconds() / speed) for i in range(n)
+        ]
+        result["expected_duration_s"] = round((ts[n - 1] - ts[0]).total_seconds() / speed, 3)
+        result["timing_error_ms"] = {
+            "p50": _ms(_percentile(errors, 0.50)),
+            "p99": _ms(_percentile(errors, 0.99)),
+            "max": _ms(max(errors)),
+        }
+    return result
+
+
+async def _start_broker(kind: str) -> tuple[Callable, int | None]:
+    if kind == "inproc":
+        broker = Broker("127.0.0.1", 0)
+        settings.mqtt_port = await broker.start()
+        return broker.stop, None
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.broker", "--port", "0", stdout=subprocess.PIPE
+    )
+    line = (await proc.stdout.readline()).decode()
+    settings.mqtt_port = int(line.rsplit(":", 1)[1])
+
+    async def stop():
+        proc.terminate()
+        await proc.wait()
+
+    return stop, proc.pid
+
+
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results: list[dict], baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["scenario"]["name"]: r for r in json.load(f)["results"]}
+    print(f"{'scenario':<22} {'msgs/s':>10} {'vs base':>8} {'p99 ms':>9} {'vs base':>8}")
+    for r in results:
+        name = r["scenario"]["name"]
+        rate, p99 = r["recorder"]["msgs_per_s"], r["recorder"]["latency_ms"]["p99"]
+        base = baseline.get(name)
+        rate_delta = p99_delta = ""
+        if base:
+            b_rate, b_p99 = base["recorder"]["msgs_per_s"], base["recorder"]["latency_ms"]["p99"]
+            if rate and b_rate:
+                rate_delta = f"{(rate / b_rate - 1) * 100:+.1f}%"
+            if p99 and b_p99:
+                p99_delta = f"{(p99 / b_p99 - 1) * 100:+.1f}%"
+        print(f"{name:<22} {rate or 0:>10.0f} {rate_delta:>8} {p99 or 0:>9.2f} {p99_delta:>8}")
+
+
+async def run(args) -> dict:
+    settings.mqtt_host = "127.0.0.1"
+    settings.mqtt_username = None
+    settings.mqtt_password_file = None
+    settings.mqtt_tls = False
+    settings.recorder_journal_dir = tempfile.mkdtemp(prefix="bench-journal-")
+    if args.payload_storage:
+        settings.payload_storage = args.payload_storage
+    if args.sink == "memory":
+        settings.recorder_topic_stats = False  # would upsert to session_topic_stats after every batch
+    if args.sink == "db":
+        from app.db import engine
+        from app.models import Base
+
+        Base.metadata.create_all(bind=engine)
+
+    names = args.scenario or list(SCENARIOS)
+    stop_broker, broker_pid = await _start_broker(args.broker)
+    results = []
+    try:
+        for name in names:
+            s = SCENARIOS[name]
+            if args.messages:
+                s = Scenario(**{**asdict(s), "messages": args.messages})
+            sink = _Sink(args.sink, args.sink_latency_ms)
+            pids = [os.getpid()] + ([broker_pid] if broker_pid else [])
+            with _RssSampler(pids) as rss:
+                rec = await _record(s, sink, args.timeout)
+                playback = []
+                if args.sink == "db" and not args.no_playback:
+                    playback.append(await _playback(rec["session_ids"][0], "timed", args.speed, args.timeout))
+                    playback.append(await _playback(rec["session_ids"][0], "max", 1.0, args.timeout))
+            if args.sink == "db":
+                _drop_sessions(rec.pop("session_ids"))
+            else:
+                rec.pop("session_ids")
+            result = {
+                "scenario": asdict(s),
+                "recorder": rec,
+                "playback": playback,
+                "peak_rss_mb": round(rss.peak[os.getpid()] / 2**20, 1),
+            }
+            if broker_pid:
+                result["broker_peak_rss_mb"] = round(rss.peak[broker_pid] / 2**20, 1)
+            results.append(result)
+            print(json.dumps({"scenario": name, **rec, "playback": playback}), flush=True)
+    finally:
+        await stop_broker()
+
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_rev": _git_rev(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "sink": args.sink,
+            "sink_latency_ms": args.sink_latency_ms,
+            "broker": args.broker,
+            "ingest_backend": settings.ingest_backend,
+            "payload_storage": settings.payload_storage,
+            "recorder_batch_size": settings.recorder_batch_size,
+            "recorder_pipeline_depth": settings.recorder_pipeline_depth,
+            "playback_speed": args.speed,
+        },
+        "results": results,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="repeatable; default: all")
+    ap.add_argument("--messages", type=int, help="override the message count of every scenario")
+    ap.add_argument("--sink", choices=("memory", "db"), default="memory")
+    ap.add_argument("--sink-latency-ms", type=float, default=0.0, help="simulated commit time of the memory sink")
+    ap.add_argument("--broker", choices=("inproc", "subprocess"), default="subprocess")
+    ap.add_argument("--payload-storage", choices=("json", "raw", "both"))
+    ap.add_argument("--speed", type=float, default=1.0, help="timed playback speed")
+    ap.add_argument("--no-playback", action="store_true")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--out", help="write results as JSON to this file")
+    ap.add_argument("--baseline", help="earlier results file to compare against")
+    args = ap.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        _compare(report["results"], args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compare INSERT vs COPY ingest into mqtt_message against a local Postgres.
+
+Uses the same DB_* settings as the API, e.g.:
+
+    DB_HOST=localhost DB_PASSWORD_FILE=secrets/postgres_password.txt \
+        python -m benchmarks.bench_ingest --rows 200000 --batch-size 500
+
+Reports rows/s and client CPU per row for each backend. If ``psutil`` is
+installed and the server runs on this host, server CPU per row is reported too.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+from sqlalchemy import delete
+
+from app.db import SessionLocal, engine
+from app.ingest import copy_rows, insert_rows
+from app.models import Base, MqttMessage, RecordingSession
+
+try:
+    import psutil
+except ImportError:  # optional
+    psutil = None
+
+
+def _server_cpu() -> float | None:
+    if psutil is None:
+        return None
+    total = 0.0
+    for proc in psutil.process_iter(["name", "cpu_times"]):
+        if proc.info["name"] and proc.info["name"].startswith("postgres") and proc.info["cpu_times"]:
+            total += proc.info["cpu_times"].user + proc.info["cpu_times"].system
+    return total or None
+
+
+def _make_rows(session_id: uuid.UUID, count: int, payload_fields: int) -> list[dict]:
+    t0 = datetime.now(timezone.utc)
+    rows = []
+    for i in range(count):
+        payload = {f"f{j}": i * j * 0.5 for j in range(payload_fields)}
+        payload["status"] = "ok" if i % 7 else "warn"
+        rows.append(
+            {
+                "session_id": session_id,
+                "ts": t0 + timedelta(microseconds=i * 50),
+                "topic": f"plant/line{i % 16}/sensor{i % 64}",
+                "payload_json": payload,
+                "qos": i % 2,
+                "retained": False,
+            }
+        )
+    return rows
+
+
+def _run(name: str, write, rows: list[dict], batch_size: int) -> dict:
+    srv0 = _server_cpu()
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        write(rows[i : i + batch_size])
+    wall = time.perf_counter() - wall0
+    cpu = time.process_time() - cpu0
+    srv1 = _server_cpu()
+    result = {
+        "backend": name,
+        "rows": len(rows),
+        "rows_per_s": round(len(rows) / wall),
+        "client_cpu_us_per_row": round(cpu / len(rows) * 1e6, 2),
+    }
+    if srv0 is not None and srv1 is not None:
+        result["server_cpu_us_per_row"] = round((srv1 - srv0) / len(rows) * 1e6, 2)
+    return result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=100_000)
+    ap.add_argument("--batch-size", type=int, default=500)
+    ap.add_argument("--payload-fields", type=int, default=8)
+    ap.add_argument("--rounds", type=int, default=1)
+    args = ap.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    session_id = uuid.uuid4()
+    with SessionLocal() as db:
+        db.add(RecordingSession(id=session_id, node="bench", topic_filters=["#"], state="BENCH"))
+        db.commit()
+
+    rows = _make_rows(session_id, args.rows, args.payload_fields)
+    backends = {
+        "insert": insert_rows,
+        "copy_text": partial(copy_rows, binary=False),
+        "copy_binary": partial(copy_rows, binary=True),
+    }
+    results = []
+    try:
+        for _ in range(args.rounds):
+            for name, write in backends.items():
+                results.append(_run(name, write, rows, args.batch_size))
+                with SessionLocal() as db:
+                    db.execute(delete(MqttMessage).where(MqttMessage.session_id == session_id))
+                    db.commit()
+    finally:
+        with SessionLocal() as db:
+            db.execute(delete(MqttMessage).where(MqttMessage.session_id == session_id))
+            db.execute(delete(RecordingSession).where(RecordingSession.id == session_id))
+            db.commit()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Per-message ingest cost of the recorder's payload handling.
+
+Compares the original decode path (UTF-8 decode, NUL scan, stdlib json, base64
+for binary) with app.payloads.decode_payload (orjson when installed) and with
+PAYLOAD_STORAGE=raw, which keeps the bytes and skips parsing entirely. Each
+variant also builds the row dict the recorder queues, so the numbers reflect
+the hot-loop cost per message.
+
+    python -m benchmarks.bench_payload_decode --n 200000
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app.payloads import decode_payload, orjson
+
+
+def legacy_decode(raw_payload: bytes) -> dict:
+    try:
+        text_payload = raw_payload.decode("utf-8")
+        if "\x00" in text_payload:
+            raise ValueError("NUL byte in UTF-8 payload")
+        payload_obj = json.loads(text_payload)
+    except Exception:
+        payload_obj = {"_raw_b64": base64.b64encode(raw_payload).decode("ascii"), "_encoding": "base64"}
+    return payload_obj if isinstance(payload_obj, dict) else {"value": payload_obj}
+
+
+PAYLOADS = {
+    "small_json": json.dumps({"temp": 21.5, "unit": "C", "ok": True}).encode(),
+    "large_json": json.dumps(
+        {"line": "L4", "values": [i * 0.25 for i in range(200)], "meta": {"fw": "1.2.3", "tags": ["a"] * 20}}
+    ).encode(),
+    "scalar": b"42.125",
+    "binary_1k": os.urandom(1024),
+}
+
+
+def _bench(fn, raw: bytes, n: int) -> float:
+    session_id = uuid.uuid4()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(raw, session_id)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def _legacy_row(raw, session_id):
+    return {
+        "session_id": session_id,
+        "ts": datetime.now(timezone.utc),
+        "topic": "plant/l1/s1",
+        "payload_json": legacy_decode(raw),
+        "qos": 0,
+        "retained": False,
+    }
+
+
+def _json_row(raw, session_id):
+    return {
+        "session_id": session_id,
+        "ts": datetime.now(timezone.utc),
+        "topic": "plant/l1/s1",
+        "payload_json": decode_payload(raw),
+        "qos": 0,
+        "retained": False,
+    }
+
+
+def _raw_row(raw, session_id):
+    return {
+        "session_id": session_id,
+        "ts": datetime.now(timezone.utc),
+        "topic": "plant/l1/s1",
+        "payload_raw": raw,
+        "qos": 0,
+        "retained": False,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=100_000)
+    args = ap.parse_args()
+
+    print(f"orjson: {'yes' if orjson is not None else 'no (stdlib json fallback)'}")
+    print(f"{'payload':<12} {'legacy us':>10} {'json us':>10} {'raw us':>10}")
+    for name, raw in PAYLOADS.items():
+        legacy = _bench(_legacy_row, raw, args.n)
+        new_json = _bench(_json_row, raw, args.n)
+        raw_only = _bench(_raw_row, raw, args.n)
+        print(f"{name:<12} {legacy:>10.2f} {new_json:>10.2f} {raw_only:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
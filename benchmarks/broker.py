@@ -0,0 +1,246 @@
+"""Minimal MQTT 3.1.1 broker for benchmarks, in-process or as a subprocess.
+
+Supports CONNECT, PUBLISH (QoS 0-2 inbound, delivered with at most QoS 1),
+SUBSCRIBE/UNSUBSCRIBE with wildcards and shared subscriptions
+(``$share/<group>/<filter>``, round-robin within a group), PINGREQ and
+DISCONNECT. No retained messages, sessions, authentication or TLS; it only has
+to be fast enough not to be the bottleneck of what is measured.
+
+    python -m benchmarks.broker --port 1883
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import struct
+
+from app.topics import TopicTrie
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+_U16 = struct.Struct("!H")
+
+
+def _remaining_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        n, digit = divmod(n, 128)
+        out.append(digit | 0x80 if n else digit)
+        if not n:
+            return bytes(out)
+
+
+def _packet(first: int, body: bytes) -> bytes:
+    return bytes((first,)) + _remaining_length(len(body)) + body
+
+
+def _string(data: bytes, pos: int) -> tuple[str, int]:
+    (n,) = _U16.unpack_from(data, pos)
+    return data[pos + 2:pos + 2 + n].decode("utf-8"), pos + 2 + n
+
+
+class _Client:
+    __slots__ = ("writer", "client_id", "filters", "max_qos", "_next_id")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = ""
+        self.filters: dict[str, int] = {}
+        self.max_qos = 0
+        self._next_id = 0
+
+    def packet_id(self) -> int:
+        self._next_id = self._next_id % 65535 + 1
+        return self._next_id
+
+
+class _ShareGroup:
+    """Members of one ``$share/<group>/<filter>``; each message goes to the next member in turn."""
+
+    __slots__ = ("members", "max_qos", "_next")
+
+    def __init__(self):
+        self.members: list[_Client] = []
+        self.max_qos = 1
+        self._next = 0
+
+    def pick(self) -> _Client:
+        self._next = (self._next + 1) % len(self.members)
+        return self.members[self._next]
+
+
+def _split_share(topic_filter: str) -> tuple[tuple[str, str] | None, str]:
+    """((group, filter), filter) for a shared subscription, (None, filter) otherwise."""
+    if not topic_filter.startswith("$share/"):
+        return None, topic_filter
+    _, group, real = topic_filter.split("/", 2)
+    return (group, real), real
+
+
+class Broker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self._trie: TopicTrie[_Client | _ShareGroup] = TopicTrie()
+        self._groups: dict[tuple[str, str], _ShareGroup] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self.received = 0
+        self.delivered = 0
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = _Client(writer)
+        try:
+            while True:
+                first = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    if not byte & 0x80:
+                        break
+                    shift += 7
+                body = await reader.readexactly(length) if length else b""
+                kind = first >> 4
+                if kind == PUBLISH:
+                    self._publish(client, first, body)
+                elif kind == CONNECT:
+                    self._connect(client, body)
+                elif kind == SUBSCRIBE:
+                    self._subscribe(client, body)
+                elif kind == UNSUBSCRIBE:
+                    self._unsubscribe(client, body)
+                elif kind == PUBREL:
+                    writer.write(_packet(PUBCOMP << 4, body[:2]))
+                elif kind == PINGREQ:
+                    writer.write(bytes((PINGRESP << 4, 0)))
+                elif kind == DISCONNECT:
+                    break
+                # PUBACK/PUBREC/PUBCOMP for our own deliveries need no bookkeeping here.
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic_filter in list(client.filters):
+                self._remove(client, topic_filter)
+            writer.close()
+
+    def _connect(self, client: _Client, body: bytes) -> None:
+        _, pos = _string(body, 0)  # protocol name
+        pos += 4  # level, flags, keep alive
+        client.client_id, _ = _string(body, pos)
+        client.writer.write(bytes((CONNACK << 4, 2, 0, 0)))
+
+    def _subscribe(self, client: _Client, body: bytes) -> None:
+        packet_id = body[:2]
+        pos = 2
+        granted = bytearray()
+        while pos < len(body):
+            topic_filter, pos = _string(body, pos)
+            qos = min(body[pos] & 0x03, 1)
+            pos += 1
+            share, real = _split_share(topic_filter)
+            if topic_filter not in client.filters:
+                if share is None:
+                    self._trie.add(real, client)
+                else:
+                    group = self._groups.get(share)
+                    if group is None:
+                        group = self._groups[share] = _ShareGroup()
+                        self._trie.add(real, group)
+                    group.members.append(client)
+            client.filters[topic_filter] = qos
+            granted.append(qos)
+        client.max_qos = max(client.filters.values(), default=0)
+        client.writer.write(_packet((SUBACK << 4), packet_id + bytes(granted)))
+
+    def _unsubscribe(self, client: _Client, body: bytes) -> None:
+        packet_id = body[:2]
+        pos = 2
+        while pos < len(body):
+            topic_filter, pos = _string(body, pos)
+            self._remove(client, topic_filter)
+        client.max_qos = max(client.filters.values(), default=0)
+        client.writer.write(_packet((UNSUBACK << 4), packet_id))
+
+    def _remove(self, client: _Client, topic_filter: str) -> None:
+        if client.filters.pop(topic_filter, None) is None:
+            return
+        share, real = _split_share(topic_filter)
+        if share is None:
+            self._trie.remove(real, client)
+            return
+        group = self._groups[share]
+        group.members.remove(client)
+        if not group.members:
+            del self._groups[share]
+            self._trie.remove(real, group)
+
+    def _publish(self, client: _Client, first: int, body: bytes) -> None:
+        qos = (first >> 1) & 0x03
+        (n,) = _U16.unpack_from(body, 0)
+        topic_end = 2 + n
+        topic = body[2:topic_end].decode("utf-8")
+        payload_start = topic_end + 2 if qos else topic_end
+        if qos == 1:
+            client.writer.write(_packet(PUBACK << 4, body[topic_end:payload_start]))
+        elif qos == 2:
+            client.writer.write(_packet(PUBREC << 4, body[topic_end:payload_start]))
+        self.received += 1
+
+        targets = self._trie.match(topic)
+        if not targets:
+            return
+        topic_part = body[:topic_end]
+        payload = body[payload_start:]
+        qos0 = None
+        for target in targets:
+            if isinstance(target, _ShareGroup):
+                target = target.pick()
+            out_qos = min(qos, target.max_qos)
+            if out_qos == 0:
+                if qos0 is None:
+                    qos0 = _packet(PUBLISH << 4, topic_part + payload)
+                target.writer.write(qos0)
+            else:
+                pid = _U16.pack(target.packet_id())
+                target.writer.write(_packet((PUBLISH << 4) | 0x02, topic_part + pid + payload))
+            self.delivered += 1
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=1883)
+    args = ap.parse_args()
+
+    async def serve() -> None:
+        broker = Broker(args.host, args.port)
+        await broker.start()
+        print(f"broker listening on {broker.host}:{broker.port}", flush=True)
+        await broker.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -19,13 +19,6 @@ $createBody = @{
     topic_filters = @($TopicFilter)
 } | ConvertTo-Json -Compress
 
-$sessions = Invoke-RestMethod -Method Get -Uri "$BaseUrl/sessions"
-$running = @($sessions | Where-Object { $_.state -eq "RECORDING" })
-if ($running.Count -gt 0) {
-    $ids = ($running | ForEach-Object { $_.id }) -join ", "
-    throw "Recorder already running for session(s): $ids. Stop them first or run a single recorder at a time."
-}
-
 if ($PublishToLocalHiveMq) {
     $BrokerHost = "hivemq"
     $BrokerPort = 1883
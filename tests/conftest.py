@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# app.db creates its engines at import time and needs a password; the unit tests never connect.
+if not os.environ.get("DB_PASSWORD_FILE"):
+    _fd, _path = tempfile.mkstemp(prefix="test-db-password-")
+    os.write(_fd, b"test")
+    os.close(_fd)
+    os.environ["DB_PASSWORD_FILE"] = _path
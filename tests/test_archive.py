@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.archive import (
+    _CHUNK_HEADER,
+    _FILE_HEADER,
+    CODEC_ZLIB,
+    CODEC_ZSTD,
+    ArchiveReader,
+    ArchiveWriter,
+    stream_archive,
+    zstandard,
+)
+
+T0 = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+CODECS = [CODEC_ZLIB, pytest.param(CODEC_ZSTD, marks=pytest.mark.skipif(zstandard is None, reason="needs zstandard"))]
+
+
+def _messages(n: int) -> list[tuple]:
+    return [
+        (
+            T0 + timedelta(milliseconds=250 * i),
+            f"plant/{i % 3}/temp",
+            b"" if i % 5 == 0 else f'{{"seq":{i}}}'.encode() + b"\x00" * (i % 2),
+            i % 3,
+            i % 4 == 0,
+        )
+        for i in range(n)
+    ]
+
+
+def _write(path, messages, chunk_rows=4, codec=CODEC_ZLIB) -> dict:
+    writer = ArchiveWriter(path, {"session_id": "s"}, chunk_rows=chunk_rows, codec=codec)
+    for m in messages:
+        writer.append(*m)
+    return writer.close()
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_roundtrip(tmp_path, codec):
+    messages = _messages(11)
+    meta = _write(tmp_path / "s.mqa", messages, codec=codec)
+    assert meta["messages"] == 11
+    assert meta["first_ts"] == messages[0][0].isoformat()
+    assert meta["last_ts"] == messages[-1][0].isoformat()
+
+    with ArchiveReader(tmp_path / "s.mqa") as reader:
+        assert reader.meta == meta
+        assert len(reader.index) == 3
+        assert [m for chunk in reader.iter_messages() for m in chunk] == messages
+
+
+def test_empty_archive(tmp_path):
+    meta = _write(tmp_path / "s.mqa", [])
+    assert meta["messages"] == 0 and meta["first_ts"] is None
+    assert list(stream_archive(tmp_path / "s.mqa")) == []
+
+
+def test_file_appears_only_on_close(tmp_path):
+    writer = ArchiveWriter(tmp_path / "s.mqa", {}, chunk_rows=2)
+    for m in _messages(5):
+        writer.append(*m)
+    assert not (tmp_path / "s.mqa").exists()
+    writer.abort()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        (None, None),
+        (2, None),  # inside the first chunk
+        (4, 9),  # chunk boundaries
+        (5, 7),  # within one chunk
+        (None, 3),
+        (10, 11),
+        (11, None),  # past the last message
+    ],
+)
+def test_seek_returns_messages_in_range(tmp_path, start, end):
+    messages = _messages(11)
+    _write(tmp_path / "s.mqa", messages)
+    start_ts = messages[0][0] + timedelta(milliseconds=250 * start) if start is not None else None
+    end_ts = messages[0][0] + timedelta(milliseconds=250 * end) if end is not None else None
+
+    rows = [r for chunk in stream_archive(tmp_path / "s.mqa", start_ts, end_ts) for r in chunk]
+    expected = [
+        (ts, topic, payload, None, qos)
+        for ts, topic, payload, qos, _ in messages[start or 0:end if end is not None else len(messages)]
+    ]
+    assert rows == expected
+
+
+def test_seek_between_messages(tmp_path):
+    messages = _messages(11)
+    _write(tmp_path / "s.mqa", messages)
+    start = messages[3][0] + timedelta(milliseconds=100)
+    rows = [r for chunk in stream_archive(tmp_path / "s.mqa", start) for r in chunk]
+    assert [r[0] for r in rows] == [m[0] for m in messages[4:]]
+
+
+def test_rejects_truncated_and_corrupt_files(tmp_path):
+    path = tmp_path / "s.mqa"
+    _write(path, _messages(8))
+    data = path.read_bytes()
+
+    path.write_bytes(data[:-5])
+    with pytest.raises(ValueError):
+        ArchiveReader(path)
+
+    corrupt = bytearray(data)
+    corrupt[_FILE_HEADER.size + _CHUNK_HEADER.size + 2] ^= 0xFF  # inside the body of the first chunk
+    path.write_bytes(bytes(corrupt))
+    with ArchiveReader(path) as reader, pytest.raises(ValueError):
+        list(reader.iter_messages())
@@ -0,0 +1,43 @@
+import base64
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.export import decode_cursor, encode_cursor
+
+
+@pytest.mark.parametrize(
+    "ts, row_id",
+    [
+        (datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc), 1),
+        (datetime(2024, 5, 1, 12, 0, 0, 123456, tzinfo=timezone.utc), 2**62),
+        (datetime(2024, 5, 1, 14, 0, tzinfo=timezone(timedelta(hours=2))), 42),
+    ],
+)
+def test_cursor_roundtrip(ts, row_id):
+    cursor = encode_cursor(ts, row_id)
+    assert decode_cursor(cursor) == (ts, row_id)
+    assert decode_cursor(cursor)[0].utcoffset() == ts.utcoffset()
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(datetime(2024, 5, 1, tzinfo=timezone.utc), 123456789)
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "",
+        "not base64!",
+        base64.urlsafe_b64encode(b"2024-05-01T00:00:00").decode(),  # no id
+        base64.urlsafe_b64encode(b"2024-05-01T00:00:00|x").decode(),
+        base64.urlsafe_b64encode(b"yesterday|1").decode(),
+        base64.urlsafe_b64encode(b"2024-05-01|1|2").decode(),
+        base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+        "ä",
+    ],
+)
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
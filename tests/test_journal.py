@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from app.journal import Journal, prepare_journal_root
+
+
+def _rows(start: int, n: int) -> list[dict]:
+    ts = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    return [{"ts": ts, "topic": f"t/{i}", "payload_raw": bytes([i % 256]) * 10} for i in range(start, start + n)]
+
+
+def _drain(journal: Journal) -> list[dict]:
+    out = []
+    while (rows := journal.read_head()) is not None:
+        out.extend(rows)
+        journal.ack()
+    return out
+
+
+def test_append_splits_into_frames_and_replays_in_order(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    journal.append(_rows(0, 5), frame_rows=2)
+    journal.append(_rows(5, 3), frame_rows=2)
+    assert journal.pending_rows == 8
+
+    assert journal.read_head() == _rows(0, 2)
+    assert journal.read_head() == _rows(0, 2)  # unchanged until acknowledged
+    assert _drain(journal) == _rows(0, 8)
+    assert journal.pending_rows == 0
+    assert journal.read_head() is None
+
+
+def test_ack_deletes_replayed_segments(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1)  # every frame starts a new segment
+    journal.append(_rows(0, 3), frame_rows=1)
+    assert journal.segments == 3
+
+    journal.read_head()
+    journal.ack()
+    assert journal.segments == 2
+    assert len(list((tmp_path / "j").glob("*.seg"))) == 2
+
+    _drain(journal)
+    assert journal.segments == 0
+    assert journal.size_bytes == 0
+    assert list((tmp_path / "j").glob("*.seg")) == []
+    journal.close()
+    assert not (tmp_path / "j").exists()
+
+
+def test_reopen_continues_with_unacknowledged_frames(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    journal.append(_rows(0, 6), frame_rows=2)
+    journal.read_head()
+    journal.ack()
+    journal.close()
+
+    reopened = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    # The acknowledged frame is already committed and must not be replayed again.
+    assert reopened.pending_rows == 4
+    reopened.append(_rows(6, 2), frame_rows=2)
+    assert _drain(reopened) == _rows(2, 6)
+
+
+def test_acks_survive_a_crash(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=64)
+    journal.append(_rows(0, 8), frame_rows=2)
+    for _ in range(3):
+        journal.read_head()
+        journal.ack()
+    # No close(): the process died in the middle of the replay.
+
+    reopened = Journal(tmp_path / "j", segment_bytes=64)
+    assert reopened.pending_rows == 2
+    assert _drain(reopened) == _rows(6, 2)
+    reopened.close()
+    assert not (tmp_path / "j").exists()
+
+
+def test_new_segments_follow_acked_ones(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    journal.append(_rows(0, 2), frame_rows=2)
+    journal.read_head()
+    journal.ack()
+    # Crash after the last ack: the segment is gone, the ack file still points into it.
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    assert journal.pending_rows == 0
+    journal.append(_rows(2, 2), frame_rows=2)
+
+    assert Journal(tmp_path / "j", segment_bytes=1 << 20).pending_rows == 2
+
+
+def test_reopen_cuts_off_a_torn_tail(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    journal.append(_rows(0, 4), frame_rows=2)
+    journal.close()
+    (segment,) = (tmp_path / "j").glob("*.seg")
+    size = segment.stat().st_size
+    with segment.open("r+b") as f:
+        f.truncate(size - 3)
+
+    reopened = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    assert reopened.pending_rows == 2
+    assert _drain(reopened) == _rows(0, 2)
+
+
+def test_corrupt_frame_is_reported(tmp_path):
+    journal = Journal(tmp_path / "j", segment_bytes=1 << 20)
+    journal.append(_rows(0, 2), frame_rows=2)
+    (segment,) = (tmp_path / "j").glob("*.seg")
+    with segment.open("r+b") as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 0xFF]))
+    with pytest.raises(ValueError):
+        journal.read_head()
+
+
+def test_prepare_journal_root(tmp_path):
+    assert prepare_journal_root(tmp_path / "a" / "b") == tmp_path / "a" / "b"
+    (tmp_path / "file").write_text("")
+    with pytest.raises(RuntimeError, match="RECORDER_JOURNAL_DIR"):
+        prepare_journal_root(tmp_path / "file" / "journal")
@@ -0,0 +1,115 @@
+import re
+
+import pytest
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BooleanClauseList
+
+from app.query import like_prefix, topic_filter_condition
+from app.topics import TopicTrie
+
+FILTERS = [
+    "#",
+    "a/b",
+    "a/+",
+    "a/+/c",
+    "a/#",
+    "+/b",
+    "+/+",
+    "+/#",
+    "a/+/#",
+    "$SYS/#",
+    "$SYS/+/load",
+    "a.b/+",
+    "a_%/#",
+    "x\\y/+",
+    "a/b/c/#",
+]
+
+TOPICS = [
+    "a",
+    "a/",
+    "a/b",
+    "a/c",
+    "a/b/c",
+    "a/x/c",
+    "a/b/c/d",
+    "ab",
+    "ab/c",
+    "/b",
+    "b",
+    "x/b",
+    "$SYS/broker/load",
+    "$SYS",
+    "$share/g/a/b",
+    "a.b/c",
+    "axb/c",
+    "a_%/z",
+    "ab%/z",
+    "a_%",
+    "x\\y/1",
+    "x\\\\y/1",
+]
+
+
+def _like(pattern: str, value: str) -> bool:
+    # Postgres LIKE with the default backslash escape.
+    regex = ""
+    chars = iter(pattern)
+    for ch in chars:
+        if ch == "\\":
+            regex += re.escape(next(chars))
+        elif ch == "%":
+            regex += ".*"
+        elif ch == "_":
+            regex += "."
+        else:
+            regex += re.escape(ch)
+    return re.fullmatch(regex, value, re.S) is not None
+
+
+def _evaluate(condition, topic: str) -> bool:
+    """Evaluate the predicates topic_filter_condition builds against one topic."""
+    if isinstance(condition, BooleanClauseList):
+        results = [_evaluate(c, topic) for c in condition.clauses]
+        return all(results) if condition.operator is operators.and_ else any(results)
+    assert isinstance(condition, BinaryExpression)
+    value = condition.right.value
+    if condition.operator is operators.eq:
+        return topic == value
+    if condition.operator is operators.like_op:
+        assert condition.modifiers.get("escape") is None
+        return _like(value, topic)
+    if condition.operator is operators.regexp_match_op:
+        return re.search(value, topic) is not None
+    if condition.operator is operators.not_startswith_op:
+        return not topic.startswith(value)
+    raise AssertionError(f"unexpected operator {condition.operator}")
+
+
+@pytest.mark.parametrize("topic_filter", FILTERS)
+def test_sql_condition_matches_like_the_trie(topic_filter):
+    trie = TopicTrie()
+    trie.add(topic_filter, topic_filter)
+    condition = topic_filter_condition(topic_filter)
+    for topic in TOPICS:
+        assert _evaluate(condition, topic) == bool(trie.match(topic)), topic
+
+
+@pytest.mark.parametrize("topic_filter", ["a/+", "a/#", "a/b/c/#", "a_%/#"])
+def test_wildcards_after_the_first_level_use_a_like_prefix(topic_filter):
+    condition = topic_filter_condition(topic_filter)
+    assert isinstance(condition, BooleanClauseList)
+    like = condition.clauses[0]
+    assert like.operator is operators.like_op
+    assert like.right.value == like_prefix(topic_filter.rsplit("/", 1)[0] + ("/" if topic_filter.endswith("+") else ""))
+
+
+def test_like_prefix_escapes_wildcards():
+    assert like_prefix("a_%\\b") == "a\\_\\%\\\\b%"
+    assert _like(like_prefix("a_%"), "a_%/x")
+    assert not _like(like_prefix("a_%"), "abc/x")
+
+
+def test_invalid_filter_is_rejected():
+    with pytest.raises(ValueError):
+        topic_filter_condition("a/#/b")
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.rollups import _MAX_POINTS, resolve_resolution, rollup_plan
+
+
+def _t(s: str) -> datetime:
+    return datetime.fromisoformat(s).replace(tzinfo=timezone.utc)
+
+
+def _names(plan):
+    return [(table.name, lo, hi) for table, lo, hi in plan]
+
+
+def test_aligned_range_reads_only_the_coarsest_level():
+    plan = rollup_plan(_t("2024-05-01 00:00:00"), _t("2024-05-02 00:00:00"), 3600)
+    assert _names(plan) == [("rollup_1h", _t("2024-05-01 00:00:00"), _t("2024-05-02 00:00:00"))]
+
+
+def test_unaligned_range_reads_edges_from_finer_levels():
+    start, end = _t("2024-05-01 10:30:15"), _t("2024-05-01 14:10:20")
+    plan = rollup_plan(start, end, 3600)
+    assert _names(plan) == [
+        ("rollup_1s", _t("2024-05-01 10:30:15"), _t("2024-05-01 10:31:00")),
+        ("rollup_1m", _t("2024-05-01 10:31:00"), _t("2024-05-01 11:00:00")),
+        ("rollup_1h", _t("2024-05-01 11:00:00"), _t("2024-05-01 14:00:00")),
+        ("rollup_1m", _t("2024-05-01 14:00:00"), _t("2024-05-01 14:10:00")),
+        ("rollup_1s", _t("2024-05-01 14:10:00"), _t("2024-05-01 14:10:20")),
+    ]
+    # Contiguous, within [start, end), and every range lies on its level's bucket boundaries.
+    assert plan[0][1] == start and plan[-1][2] == end
+    for (_, _, hi), (_, lo, _) in zip(plan, plan[1:]):
+        assert hi == lo
+    widths = {"rollup_1s": 1, "rollup_1m": 60, "rollup_1h": 3600}
+    for table, lo, hi in plan:
+        w = widths[table.name]
+        assert lo.timestamp() % w == 0 and hi.timestamp() % w == 0
+
+
+def test_plan_only_uses_levels_dividing_the_resolution():
+    plan = rollup_plan(_t("2024-05-01 10:00:00"), _t("2024-05-01 12:00:30"), 90)
+    assert {table.name for table, _, _ in plan} == {"rollup_1s"}
+
+
+def test_sub_second_bounds_count_buckets_starting_in_range():
+    start = _t("2024-05-01 10:00:00") + timedelta(milliseconds=500)
+    plan = rollup_plan(start, _t("2024-05-01 10:00:03") + timedelta(milliseconds=1), 1)
+    assert _names(plan) == [("rollup_1s", _t("2024-05-01 10:00:01"), _t("2024-05-01 10:00:04"))]
+
+
+def test_short_range_inside_one_bucket():
+    assert rollup_plan(_t("2024-05-01 10:00:00.2"), _t("2024-05-01 10:00:00.7"), 60) == []
+
+
+def test_resolve_resolution_defaults_to_a_level_multiple():
+    assert resolve_resolution(_t("2024-05-01"), _t("2024-05-08"), None) == 1260  # 1210 s rounded up to whole minutes
+    assert resolve_resolution(_t("2024-05-01"), _t("2025-05-01"), None) == 3600 * 18
+    assert resolve_resolution(_t("2024-05-01 00:00"), _t("2024-05-01 01:00"), None) == 8
+    assert resolve_resolution(_t("2024-05-01"), _t("2024-05-02"), 60) == 60
+
+
+@pytest.mark.parametrize(
+    "start,end,resolution",
+    [("2024-05-02", "2024-05-01", 60), ("2024-05-01", "2024-05-01", 60), ("2024-05-01", "2024-05-02", 0)],
+)
+def test_resolve_resolution_rejects_bad_input(start, end, resolution):
+    with pytest.raises(ValueError):
+        resolve_resolution(_t(start), _t(end), resolution)
+
+
+def test_resolve_resolution_limits_points():
+    end = _t("2024-05-01") + timedelta(seconds=_MAX_POINTS + 1)
+    with pytest.raises(ValueError):
+        resolve_resolution(_t("2024-05-01"), end, 1)
@@ -0,0 +1,44 @@
+import pytest
+
+from app.topics import TopicMapper
+
+
+def test_first_matching_rule_decides():
+    mapper = TopicMapper(["!plant/1/debug/#", "plant/+/temp/#=rig/{1}/{2}", "plant/#"])
+    assert mapper.map("plant/1/debug/x") is None
+    assert mapper.map("plant/2/temp/a/b") == "rig/2/a/b"
+    assert mapper.map("plant/2/humidity") == "plant/2/humidity"
+    assert mapper.map("other/topic") is None
+
+
+def test_multi_level_capture_of_parent_level_drops_separator():
+    mapper = TopicMapper(["plant/+/temp/#=rig/{1}/{2}"])
+    assert mapper.map("plant/3/temp") == "rig/3"
+
+
+def test_only_drop_rules_keep_everything_else():
+    mapper = TopicMapper(["!$SYS/#", "!noise/+"])
+    assert mapper.keep_filters() is None
+    assert mapper.map("noise/a") is None
+    assert mapper.map("$SYS/broker/load") is None
+    assert mapper.map("data/a") == "data/a"
+
+
+def test_keep_filters_lists_keep_and_rename_rules():
+    mapper = TopicMapper(["!a/secret", "a/#", "b/+=c/{1}"])
+    assert mapper.keep_filters() == ["a/#", "b/+"]
+
+
+@pytest.mark.parametrize(
+    "rule",
+    [
+        "!a/+=b",  # drop rules cannot rename
+        "a/+=b/{2}",  # only one wildcard
+        "a/+=b/+",  # target must be a topic name
+        "a/+=",
+        "a/b+",  # invalid filter
+    ],
+)
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        TopicMapper([rule])
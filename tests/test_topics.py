@@ -0,0 +1,98 @@
+import pytest
+
+from app.topics import TopicTrie, filter_covers, minimal_cover, validate_topic_filter
+
+
+@pytest.mark.parametrize("topic_filter", ["a", "a/b", "+", "#", "a/+/c", "a/#", "+/+/#", "$share/g/a/#"])
+def test_valid_filters(topic_filter):
+    validate_topic_filter(topic_filter)
+
+
+@pytest.mark.parametrize("topic_filter", ["", "a/#/b", "a#", "a/b+", "+a/b", "#/a"])
+def test_invalid_filters(topic_filter):
+    with pytest.raises(ValueError):
+        validate_topic_filter(topic_filter)
+
+
+def _trie(*filters):
+    trie = TopicTrie()
+    for f in filters:
+        trie.add(f, f)
+    return trie
+
+
+@pytest.mark.parametrize(
+    "topic, expected",
+    [
+        ("a/b/c", {"a/b/c", "a/+/c", "a/#", "#", "+/b/#"}),
+        ("a/x/c", {"a/+/c", "a/#", "#"}),
+        ("a", {"a/#", "#"}),  # '#' also matches the parent level
+        ("a/b", {"a/#", "#", "+/b/#"}),
+        ("b/b", {"#", "+/b/#"}),
+        ("a/b/c/d", {"a/#", "#", "+/b/#"}),
+    ],
+)
+def test_trie_matches_wildcards(topic, expected):
+    trie = _trie("a/b/c", "a/+/c", "a/#", "#", "+/b/#")
+    assert trie.match(topic) == expected
+
+
+@pytest.mark.parametrize("topic", ["$SYS/broker/load", "$share/group/a/b"])
+def test_first_level_wildcards_skip_dollar_topics(topic):
+    trie = _trie("#", "+/broker/load", "+/group/a/b")
+    assert trie.match(topic) == frozenset()
+
+
+def test_dollar_topics_match_explicit_filters():
+    trie = _trie("$SYS/#", "$SYS/+/load", "$share/group/a/+")
+    assert trie.match("$SYS/broker/load") == {"$SYS/#", "$SYS/+/load"}
+    assert trie.match("$share/group/a/b") == {"$share/group/a/+"}
+
+
+def test_trie_remove_prunes_and_invalidates_cache():
+    trie = TopicTrie()
+    trie.add("a/+", 1)
+    trie.add("a/+", 2)
+    trie.add("a/b/#", 1)
+    assert trie.match("a/b") == {1, 2}
+
+    trie.remove("a/+", 1)
+    assert trie.match("a/b") == {1, 2}  # 2 still has a/+, 1 still has a/b/#
+    trie.remove("a/b/#", 1)
+    assert trie.match("a/b") == {2}
+    trie.remove("a/+", 2)
+    assert trie.match("a/b") == frozenset()
+    assert len(trie) == 0
+    assert trie._root.children == {}
+
+
+def test_trie_remove_unknown_is_noop():
+    trie = _trie("a/b")
+    trie.remove("a/c", "a/c")
+    trie.remove("a/b", "other")
+    assert trie.filters() == {"a/b"}
+
+
+@pytest.mark.parametrize(
+    "general, specific, covers",
+    [
+        ("#", "a/b", True),
+        ("a/#", "a", True),
+        ("a/#", "a/+/c", True),
+        ("a/+", "a/b", True),
+        ("a/+", "a/#", False),
+        ("a/+", "a/b/c", False),
+        ("a/b", "a/+", False),
+        ("+/+", "a/b", True),
+        ("#", "$SYS/#", False),
+        ("+/group/a", "$share/group/a", False),
+        ("$share/group/#", "$share/group/a/b", True),
+    ],
+)
+def test_filter_covers(general, specific, covers):
+    assert filter_covers(general, specific) is covers
+
+
+def test_minimal_cover_drops_covered_filters():
+    assert minimal_cover(["a/b", "a/#", "a/+/c", "b/+", "b/c", "$SYS/#", "#"]) == {"#", "$SYS/#"}
+    assert minimal_cover(["a/b", "a/b", "c/+"]) == {"a/b", "c/+"}